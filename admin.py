@@ -0,0 +1,55 @@
+# Maintenance commands for the object store metadata
+#
+#   python admin.py rebuild_key_index $ACCOUNT_ID $BUCKET
+#   python admin.py recompute_bucket_stats $ACCOUNT_ID $BUCKET
+#   python admin.py set_bucket_compression $ACCOUNT_ID $BUCKET zlib|zstd|none
+import asyncio
+import sys
+
+import compression
+import model
+
+
+async def rebuild_key_index(*args):
+    account_id = args[0]
+    buckets = args[1:] or await model.list_bucket_names(account_id)
+    for bucket in buckets:
+        count = await model.rebuild_key_index(bucket, account_id)
+        print(f"Indexed {count} keys of {account_id}/{bucket}")
+
+
+async def recompute_bucket_stats(*args):
+    account_id = args[0]
+    buckets = args[1:] or await model.list_bucket_names(account_id)
+    for bucket in buckets:
+        before = await model.get_bucket_stats(bucket, account_id)
+        after = await model.recompute_bucket_stats(bucket, account_id)
+        print(
+            f"{account_id}/{bucket}: {after['keys']} keys, {after['bytes']} bytes"
+            f" (counters were {before['keys']} keys, {before['bytes']} bytes)"
+        )
+
+
+# Objects written to the bucket from now on are stored with the codec; those
+# already stored keep theirs
+async def set_bucket_compression(account_id, bucket, codec):
+    if codec == "none":
+        codec = None
+    elif codec not in compression.CODECS:
+        sys.exit(f"Unknown codec {codec}; available: {', '.join(compression.CODECS)}")
+    await model.set_bucket_compression(bucket, codec, account_id)
+    print(f"{account_id}/{bucket}: compression {codec or 'none'}")
+
+
+async def run(cmd, args):
+    try:
+        await globals()[cmd](*args)
+    finally:
+        await model.close()
+
+
+if __name__ == "__main__":
+    cmd = sys.argv[1]
+    args = sys.argv[2:]
+    print(f"Executing {cmd} with args {args}")
+    asyncio.run(run(cmd, args))
@@ -0,0 +1,105 @@
+# A minimal in-process ASGI client. Requests are delivered straight to the
+# application callable, so no sockets or HTTP parsing sit between the
+# benchmark and the code being measured.
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class Result:
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = {k.decode().lower(): v.decode() for k, v in headers}
+        self.body = body
+
+    def __repr__(self):
+        return f"<Result {self.status} {len(self.body)} bytes>"
+
+
+# Run an application's startup and shutdown handlers around a block
+class Lifespan:
+    def __init__(self, app):
+        self.app = app
+        self._events = None
+        self._replies = None
+        self._task = None
+
+    async def __aenter__(self):
+        self._events = asyncio.Queue()
+        self._replies = asyncio.Queue()
+        scope = {"type": "lifespan", "asgi": {"version": "3.0"}, "state": {}}
+        self._task = asyncio.ensure_future(
+            self.app(scope, self._events.get, self._replies.put)
+        )
+        await self._events.put({"type": "lifespan.startup"})
+        reply = await self._replies.get()
+        if reply["type"] != "lifespan.startup.complete":
+            raise RuntimeError(f"Application startup failed: {reply}")
+        return self.app
+
+    async def __aexit__(self, *exc_info):
+        await self._events.put({"type": "lifespan.shutdown"})
+        await self._replies.get()
+        await self._task
+
+
+async def request(
+    app,
+    method: str,
+    url: str,
+    headers: Optional[Dict[str, str]] = None,
+    body=b"",
+    chunk_size: int = 64 * 1024,
+) -> Result:
+    parts = urlsplit(url)
+    raw_headers = [(b"host", b"bench")]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), str(value).encode()))
+    if isinstance(body, (bytes, bytearray)):
+        if "content-length" not in {k.decode() for k, _ in raw_headers}:
+            raw_headers.append((b"content-length", str(len(body)).encode()))
+        chunks = [bytes(body[i : i + chunk_size]) for i in range(0, len(body), chunk_size)]
+    else:
+        chunks = list(body)
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": parts.path,
+        "raw_path": parts.path.encode(),
+        "query_string": parts.query.encode(),
+        "root_path": "",
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+
+    messages = [
+        {"type": "http.request", "body": c, "more_body": True} for c in chunks
+    ]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+    response = {"status": None, "headers": [], "body": bytearray()}
+    finished = asyncio.Event()
+
+    # Once the body is delivered the client stays connected until the
+    # response is complete, as a real client would
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    return Result(response["status"], response["headers"], bytes(response["body"]))
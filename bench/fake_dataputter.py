@@ -0,0 +1,99 @@
+# An in-memory stand-in for data-putter, speaking the object_store framing.
+#
+# The router takes an 8-byte big-endian length followed by that many bytes and
+# replies with a new 8-byte object id, or takes "0DEL0DEL" + id + token and
+# echoes the id once the object is gone. The object server takes an 8-byte
+# object id, sends the object and closes the connection.
+import asyncio
+import os
+
+OBJECT_ID_SIZE = 8
+DELETE_COMMAND = b"0DEL0DEL"
+DELETE_AUTHENTICITY_TOKEN_SIZE = 16
+# Bytes written per send while serving an object
+SEND_SIZE = 256 * 1024
+
+
+class FakeDataPutter:
+    def __init__(self, latency: float = 0):
+        self.objects = {}
+        self.latency = latency
+        self.router = None
+        self.object_server = None
+        self.puts = 0
+        self.deletes = 0
+        self.reads = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def router_endpoint(self):
+        return self.router.sockets[0].getsockname()[:2]
+
+    @property
+    def object_server_endpoint(self):
+        return self.object_server.sockets[0].getsockname()[:2]
+
+    async def start(
+        self, host: str = "127.0.0.1", router_port: int = 0, object_port: int = 0
+    ):
+        self.router = await asyncio.start_server(self._route, host, router_port)
+        self.object_server = await asyncio.start_server(
+            self._serve_object, host, object_port
+        )
+        return self
+
+    async def stop(self):
+        for server in (self.router, self.object_server):
+            server.close()
+            await server.wait_closed()
+
+    def new_object_id(self) -> bytes:
+        while True:
+            object_id = os.urandom(OBJECT_ID_SIZE // 2).hex().encode()
+            if object_id not in self.objects:
+                return object_id
+
+    # Connections to the router are kept open by the pool and carry any
+    # number of requests
+    async def _route(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(8)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if header == DELETE_COMMAND:
+                    object_id = await reader.readexactly(OBJECT_ID_SIZE)
+                    await reader.readexactly(DELETE_AUTHENTICITY_TOKEN_SIZE)
+                    self.objects.pop(object_id, None)
+                    self.deletes += 1
+                    writer.write(object_id)
+                else:
+                    size = int.from_bytes(header, "big")
+                    data = await reader.readexactly(size)
+                    object_id = self.new_object_id()
+                    self.objects[object_id] = data
+                    self.puts += 1
+                    self.bytes_in += size
+                    writer.write(object_id)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_object(self, reader, writer):
+        try:
+            object_id = await reader.readexactly(OBJECT_ID_SIZE)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            data = memoryview(self.objects.get(object_id, b""))
+            self.reads += 1
+            for offset in range(0, len(data), SEND_SIZE):
+                writer.write(data[offset : offset + SEND_SIZE])
+                await writer.drain()
+            self.bytes_out += len(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,512 @@
+# An in-memory stand-in for Redis speaking RESP2 and RESP3, covering the
+# commands the model uses. It is single-threaded and runs on the benchmark's event loop.
+import asyncio
+import fnmatch
+import hashlib
+
+from bench import lua
+
+SCRIPT_HANDLERS = {}
+
+
+class CommandError(Exception):
+    pass
+
+
+# Out-of-band messages such as pub/sub deliveries; RESP3 pushes, RESP2 arrays
+class Push(list):
+    pass
+
+
+def _int(value) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError("ERR value is not an integer or out of range")
+
+
+def _lex_bound(bound: bytes):
+    if bound == b"-":
+        return None, True, -1
+    if bound == b"+":
+        return None, True, 1
+    if bound[:1] == b"[":
+        return bound[1:], True, 0
+    if bound[:1] == b"(":
+        return bound[1:], False, 0
+    raise CommandError("ERR min or max not valid string range item")
+
+
+def _after_min(member: bytes, bound) -> bool:
+    value, inclusive, infinity = bound
+    if infinity:
+        return infinity < 0
+    return member > value or (inclusive and member == value)
+
+
+def _before_max(member: bytes, bound) -> bool:
+    value, inclusive, infinity = bound
+    if infinity:
+        return infinity > 0
+    return member < value or (inclusive and member == value)
+
+
+class FakeRedis:
+    def __init__(self, lua_scripts: bool = True):
+        self.data = {}
+        self.scripts = {}
+        self.subscribers = {}
+        self.lua = None
+        if lua_scripts and lua.available():
+            self.lua = lua.LuaScripts(self.call)
+
+    # Run a command given as its name and arguments. Redis errors are raised
+    # as CommandError
+    def call(self, args):
+        name = args[0].decode().lower()
+        if name == "del":
+            name = "delete"
+        handler = getattr(self, name, None)
+        if handler is None or name.startswith("_") or name == "call":
+            raise CommandError(f"ERR unknown command '{name}'")
+        try:
+            return handler(*args[1:])
+        except TypeError:
+            raise CommandError(f"ERR wrong number of arguments for '{name}' command")
+
+    # Keyspace helpers
+
+    def _get(self, key, kind):
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise CommandError(
+                "WRONGTYPE Operation against a key holding the wrong kind of value"
+            )
+        return value
+
+    def _setdefault(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self.data[key] = kind()
+        return value
+
+    def _drop_if_empty(self, key):
+        if key in self.data and len(self.data[key]) == 0:
+            del self.data[key]
+
+    # Commands
+
+    def ping(self, *args):
+        return "+PONG"
+
+    def hello(self, protover=b"2", *args):
+        if protover not in (b"2", b"3"):
+            raise CommandError("NOPROTO unsupported protocol version")
+        return {b"server": b"redis", b"version": b"7.0.0", b"proto": int(protover)}
+
+    def client(self, *args):
+        return "+OK"
+
+    def select(self, db):
+        return "+OK"
+
+    def info(self, *args):
+        return b"# Server\r\nredis_version:7.0.0\r\n"
+
+    def flushdb(self, *args):
+        self.data.clear()
+        return "+OK"
+
+    def get(self, key):
+        return self._get(key, bytes)
+
+    def mget(self, *keys):
+        return [
+            v if isinstance(v, bytes) else None for v in (self.data.get(k) for k in keys)
+        ]
+
+    def set(self, key, value, *args):
+        self.data[key] = value
+        return "+OK"
+
+    def incrby(self, key, amount):
+        value = _int(self._get(key, bytes) or b"0") + _int(amount)
+        self.data[key] = str(value).encode()
+        return value
+
+    def incr(self, key):
+        return self.incrby(key, b"1")
+
+    def decrby(self, key, amount):
+        return self.incrby(key, str(-_int(amount)).encode())
+
+    def decr(self, key):
+        return self.incrby(key, b"-1")
+
+    def delete(self, *keys):
+        return sum(1 for k in keys if self.data.pop(k, None) is not None)
+
+    def exists(self, *keys):
+        return sum(1 for k in keys if k in self.data)
+
+    def type(self, key):
+        kinds = {bytes: "string", set: "set", dict: "hash", list: "list"}
+        value = self.data.get(key)
+        if value is None:
+            return "+none"
+        if isinstance(value, ZSet):
+            return "+zset"
+        return "+" + kinds[type(value)]
+
+    def keys(self, pattern):
+        pattern = pattern.decode()
+        return [k for k in self.data if fnmatch.fnmatchcase(k.decode(), pattern)]
+
+    def scan(self, cursor, *args):
+        options = _scan_options(args)
+        keys = sorted(self.data)
+        if options["match"] is not None:
+            keys = [k for k in keys if fnmatch.fnmatchcase(k.decode(), options["match"])]
+        return _scan_page(keys, cursor, options["count"])
+
+    def sadd(self, key, *members):
+        members_set = self._setdefault(key, set)
+        before = len(members_set)
+        members_set.update(members)
+        return len(members_set) - before
+
+    def srem(self, key, *members):
+        members_set = self._get(key, set) or set()
+        removed = sum(1 for m in members if m in members_set)
+        members_set.difference_update(members)
+        self._drop_if_empty(key)
+        return removed
+
+    def smembers(self, key):
+        return set(self._get(key, set) or ())
+
+    def sismember(self, key, member):
+        return int(member in (self._get(key, set) or ()))
+
+    def smismember(self, key, *members):
+        members_set = self._get(key, set) or ()
+        return [int(m in members_set) for m in members]
+
+    def scard(self, key):
+        return len(self._get(key, set) or ())
+
+    def sscan(self, key, cursor, *args):
+        options = _scan_options(args)
+        members = sorted(self._get(key, set) or ())
+        if options["match"] is not None:
+            members = [
+                m for m in members if fnmatch.fnmatchcase(m.decode(), options["match"])
+            ]
+        return _scan_page(members, cursor, options["count"])
+
+    def zadd(self, key, *args):
+        zset = self._setdefault(key, ZSet)
+        added = 0
+        for i in range(0, len(args), 2):
+            added += zset.add(args[i + 1], float(args[i]))
+        return added
+
+    def zrem(self, key, *members):
+        zset = self._get(key, ZSet) or ZSet()
+        removed = sum(zset.remove(m) for m in members)
+        self._drop_if_empty(key)
+        return removed
+
+    def zcard(self, key):
+        return len(self._get(key, ZSet) or ())
+
+    def zscore(self, key, member):
+        zset = self._get(key, ZSet) or ZSet()
+        score = zset.scores.get(member)
+        return None if score is None else repr(score).encode()
+
+    def zrangebylex(self, key, low, high, *args):
+        zset = self._get(key, ZSet) or ZSet()
+        low, high = _lex_bound(low), _lex_bound(high)
+        members = [
+            m for m in zset.ordered() if _after_min(m, low) and _before_max(m, high)
+        ]
+        if len(args) == 3 and args[0].upper() == b"LIMIT":
+            offset, count = _int(args[1]), _int(args[2])
+            members = members[offset:] if count < 0 else members[offset : offset + count]
+        return members
+
+    def hset(self, key, *args):
+        hash_ = self._setdefault(key, dict)
+        added = 0
+        for i in range(0, len(args), 2):
+            added += args[i] not in hash_
+            hash_[args[i]] = args[i + 1]
+        return added
+
+    def hsetnx(self, key, field, value):
+        hash_ = self._setdefault(key, dict)
+        if field in hash_:
+            return 0
+        hash_[field] = value
+        return 1
+
+    def hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def hmget(self, key, *fields):
+        hash_ = self._get(key, dict) or {}
+        return [hash_.get(f) for f in fields]
+
+    def hgetall(self, key):
+        return dict(self._get(key, dict) or {})
+
+    def hdel(self, key, *fields):
+        hash_ = self._get(key, dict) or {}
+        removed = sum(1 for f in fields if hash_.pop(f, None) is not None)
+        self._drop_if_empty(key)
+        return removed
+
+    def hincrby(self, key, field, amount):
+        hash_ = self._setdefault(key, dict)
+        value = _int(hash_.get(field, b"0")) + _int(amount)
+        hash_[field] = str(value).encode()
+        return value
+
+    def hlen(self, key):
+        return len(self._get(key, dict) or {})
+
+    def rpush(self, key, *values):
+        list_ = self._setdefault(key, list)
+        list_.extend(values)
+        return len(list_)
+
+    def lrange(self, key, start, stop):
+        list_ = self._get(key, list) or []
+        start, stop = _int(start), _int(stop)
+        if stop < 0:
+            stop = len(list_) + stop
+        return list_[start : stop + 1]
+
+    def llen(self, key):
+        return len(self._get(key, list) or [])
+
+    def publish(self, channel, message):
+        receivers = self.subscribers.get(channel, [])
+        for writer, protocol in list(receivers):
+            writer.write(_encode(Push([b"message", channel, message]), protocol))
+        return len(receivers)
+
+    def script(self, subcommand, *args):
+        subcommand = subcommand.upper()
+        if subcommand == b"LOAD":
+            sha = hashlib.sha1(args[0]).hexdigest()
+            self.scripts[sha] = args[0]
+            return sha.encode()
+        if subcommand == b"EXISTS":
+            return [int(a.decode() in self.scripts) for a in args]
+        if subcommand == b"FLUSH":
+            self.scripts.clear()
+            return "+OK"
+        raise CommandError(f"ERR unknown SCRIPT subcommand {subcommand!r}")
+
+    def evalsha(self, sha, numkeys, *args):
+        sha = sha.decode()
+        if sha not in self.scripts:
+            raise CommandError("NOSCRIPT No matching script. Please use EVAL.")
+        return self._run_script(self.scripts[sha], numkeys, args)
+
+    def eval(self, script, numkeys, *args):
+        self.scripts[hashlib.sha1(script).hexdigest()] = script
+        return self._run_script(script, numkeys, args)
+
+    # Scripts run as Lua when lupa is installed. Without it they are emulated
+    # by Python functions registered against the exact script source in
+    # SCRIPT_HANDLERS
+    def _run_script(self, script, numkeys, args):
+        numkeys = _int(numkeys)
+        keys, args = list(args[:numkeys]), list(args[numkeys:])
+        if self.lua is not None:
+            try:
+                return self.lua.run(script, keys, args)
+            except lua.ScriptError as e:
+                raise CommandError(f"ERR Error running script: {e}")
+        handler = SCRIPT_HANDLERS.get(script)
+        if handler is None:
+            raise CommandError("ERR fake redis cannot run unregistered scripts")
+        return handler(self, keys, args)
+
+
+class ZSet:
+    def __init__(self):
+        self.scores = {}
+        self._ordered = None
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score) -> int:
+        added = member not in self.scores
+        self.scores[member] = score
+        self._ordered = None
+        return int(added)
+
+    def remove(self, member) -> int:
+        if self.scores.pop(member, None) is None:
+            return 0
+        self._ordered = None
+        return 1
+
+    def ordered(self):
+        if self._ordered is None:
+            self._ordered = sorted(self.scores, key=lambda m: (self.scores[m], m))
+        return self._ordered
+
+
+def _scan_options(args):
+    options = {"match": None, "count": 10}
+    for i in range(0, len(args) - 1, 2):
+        name = args[i].upper()
+        if name == b"MATCH":
+            options["match"] = args[i + 1].decode()
+        elif name == b"COUNT":
+            options["count"] = _int(args[i + 1])
+    return options
+
+
+def _scan_page(items, cursor, count):
+    start = _int(cursor)
+    page = items[start : start + count]
+    next_cursor = start + count if start + count < len(items) else 0
+    return [str(next_cursor).encode(), page]
+
+
+def _encode(value, protocol: int = 2) -> bytes:
+    if value is None:
+        return b"_\r\n" if protocol == 3 else b"$-1\r\n"
+    if isinstance(value, str):
+        return value.encode() + b"\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, CommandError):
+        return b"-" + str(value).encode() + b"\r\n"
+    if isinstance(value, dict):
+        if protocol == 3:
+            return b"%%%d\r\n" % len(value) + b"".join(
+                _encode(k, protocol) + _encode(v, protocol) for k, v in value.items()
+            )
+        value = [item for pair in value.items() for item in pair]
+    if isinstance(value, (set, frozenset)):
+        if protocol == 3:
+            return b"~%d\r\n" % len(value) + b"".join(
+                _encode(v, protocol) for v in value
+            )
+        value = list(value)
+    if isinstance(value, Push) and protocol == 3:
+        return b">%d\r\n" % len(value) + b"".join(_encode(v, protocol) for v in value)
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(_encode(v, protocol) for v in value)
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+async def _read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if line[:1] != b"*":
+        return line.strip().split()
+    args = []
+    for _ in range(int(line[1:])):
+        size = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+
+# Serves a FakeRedis over TCP. `latency` seconds are added to every round-trip
+# (each batch of commands read before replying) to mimic a networked Redis
+class FakeRedisServer:
+    def __init__(self, db: FakeRedis = None, latency: float = 0):
+        self.db = db or FakeRedis()
+        self.latency = latency
+        self.server = None
+        self.commands = 0
+        self.round_trips = 0
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def execute(self, args):
+        self.commands += 1
+        try:
+            return self.db.call(args)
+        except CommandError as e:
+            return e
+
+    async def _handle(self, reader, writer):
+        queued = None
+        protocol = 2
+        try:
+            while True:
+                args = await _read_command(reader)
+                if args is None:
+                    break
+                name = args[0].upper()
+                if name == b"MULTI":
+                    queued = []
+                    writer.write(b"+OK\r\n")
+                elif name == b"EXEC":
+                    results = [self.execute(a) for a in queued or []]
+                    queued = None
+                    writer.write(_encode(results, protocol))
+                elif name == b"DISCARD":
+                    queued = None
+                    writer.write(b"+OK\r\n")
+                elif queued is not None:
+                    queued.append(args)
+                    writer.write(b"+QUEUED\r\n")
+                elif name == b"SUBSCRIBE":
+                    for channel in args[1:]:
+                        receivers = self.db.subscribers.setdefault(channel, [])
+                        receivers.append((writer, protocol))
+                        writer.write(
+                            _encode(Push([b"subscribe", channel, 1]), protocol)
+                        )
+                elif name == b"UNSUBSCRIBE":
+                    self._unsubscribe(writer)
+                    for channel in args[1:]:
+                        writer.write(
+                            _encode(Push([b"unsubscribe", channel, 0]), protocol)
+                        )
+                else:
+                    result = self.execute(args)
+                    if name == b"HELLO" and isinstance(result, dict):
+                        protocol = result[b"proto"]
+                    writer.write(_encode(result, protocol))
+                # A round-trip ends once the client has nothing more buffered
+                if len(reader._buffer) == 0:
+                    self.round_trips += 1
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._unsubscribe(writer)
+            writer.close()
+
+    def _unsubscribe(self, writer):
+        for channel, receivers in self.db.subscribers.items():
+            self.db.subscribers[channel] = [r for r in receivers if r[0] is not writer]
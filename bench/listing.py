@@ -0,0 +1,143 @@
+# Listing latency against bucket size, before and after pipelining.
+#
+# Runs against an in-process fake Redis, optionally with added round-trip
+# latency, and compares model.get_bucket / model.list_buckets with the
+# previous one-request-per-key implementations.
+#
+#   python -m bench.listing --keys 10 100 1000 10000 --latency-ms 0.2
+import argparse
+import asyncio
+import json
+import os
+import socket
+import time
+
+from bench import fake_redis
+
+ACCOUNT_ID = "benchac"
+BUCKET = "listing-bench"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# The N+1 implementations these benchmarks were written against
+async def naive_get_bucket(model, bucket, account_id):
+    bucket_keys = []
+    display_name = await model.get_account_display_name(account_id)
+    for key in await model.redis.smembers(f"/keys/{account_id}/{bucket}"):
+        key = key.decode("UTF-8")
+        size_key = f"/keys/{account_id}/{bucket}/{key}/size"
+        bucket_keys.append(
+            {
+                "display_name": display_name,
+                "id": account_id,
+                "size": (await model.redis.get(size_key)).decode("UTF-8"),
+                "key": key,
+            }
+        )
+    return bucket_keys
+
+
+async def naive_list_buckets(model, account_id):
+    buckets = []
+    for bucket_name in await model.list_bucket_names(account_id):
+        key = f"/buckets/{account_id}/{bucket_name}/creationDate"
+        buckets.append(
+            {
+                "name": bucket_name,
+                "creation_date": (await model.redis.get(key)).decode("UTF-8"),
+            }
+        )
+    return buckets
+
+
+def populate(db: fake_redis.FakeRedis, key_count: int):
+    db.flushdb()
+    db.set(f"/accounts/{ACCOUNT_ID}/name".encode(), ACCOUNT_ID.encode())
+    buckets = [f"{BUCKET}-{i}".encode() for i in range(key_count)]
+    db.sadd(f"/accounts/{ACCOUNT_ID}/buckets".encode(), *buckets)
+    for bucket in buckets:
+        key = f"/buckets/{ACCOUNT_ID}/{bucket.decode()}/creationDate".encode()
+        db.set(key, b"2020-11-20 09:03:20.903719")
+    keys = [f"object-{i:08d}".encode() for i in range(key_count)]
+    db.sadd(f"/keys/{ACCOUNT_ID}/{BUCKET}".encode(), *keys)
+    for key in keys:
+        db.set(f"/keys/{ACCOUNT_ID}/{BUCKET}/{key.decode()}/size".encode(), b"1024")
+
+
+async def measure(server, repeat: int, call):
+    round_trips = server.round_trips
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await call()
+    elapsed = (time.perf_counter() - start) / repeat
+    return {
+        "ms": round(elapsed * 1000, 3),
+        "round_trips": (server.round_trips - round_trips) // repeat,
+    }
+
+
+async def run(args):
+    port = free_port()
+    server = await fake_redis.FakeRedisServer(latency=args.latency_ms / 1000).start(
+        port=port
+    )
+    os.environ["SOS_REDIS_PORT"] = str(port)
+    import model
+
+    results = []
+    for key_count in args.keys:
+        populate(server.db, key_count)
+        cases = {
+            "get_bucket": (
+                lambda: naive_get_bucket(model, BUCKET, ACCOUNT_ID),
+                lambda: model.get_bucket(BUCKET, ACCOUNT_ID),
+            ),
+            "list_buckets": (
+                lambda: naive_list_buckets(model, ACCOUNT_ID),
+                lambda: model.list_buckets(ACCOUNT_ID),
+            ),
+        }
+        for name, (before, after) in cases.items():
+            result = {
+                "operation": name,
+                "keys": key_count,
+                "before": await measure(server, args.repeat, before),
+                "after": await measure(server, args.repeat, after),
+            }
+            results.append(result)
+            print(
+                f"{name:<13} keys={key_count:<6} "
+                f"before={result['before']['ms']:>10.3f}ms "
+                f"({result['before']['round_trips']} round-trips) "
+                f"after={result['after']['ms']:>8.3f}ms "
+                f"({result['after']['round_trips']} round-trips)"
+            )
+
+    await model.close()
+    await server.stop()
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0.2,
+        help="Latency added to every Redis round-trip",
+    )
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Runs Redis Lua scripts against a FakeRedis with lupa, so the fake executes
+# model's scripts themselves instead of their Python equivalents. Redis embeds
+# Lua 5.1, so lupa's Lua 5.1 runtime is used. Replies are converted between
+# Redis and Lua the way Redis does it: nil bulk replies become false, status
+# replies {ok = ...} tables, and a table returned by a script is an array up to
+# its first nil.
+# https://redis.io/docs/latest/develop/interact/programmability/lua-api/
+try:
+    import lupa.lua51 as lupa
+except ImportError:
+    lupa = None
+
+# Raised by a script which fails other than through a Redis error
+ScriptError = lupa.LuaError if lupa is not None else Exception
+
+
+def available() -> bool:
+    return lupa is not None
+
+
+class LuaScripts:
+    # `call` runs a command given as a list of bytes arguments, raising on a
+    # Redis error
+    def __init__(self, call):
+        self.call = call
+        self.runtime = lupa.LuaRuntime(encoding=None, unpack_returned_tuples=False)
+        redis = self.runtime.table()
+        redis[b"call"] = self._call
+        self.runtime.globals()[b"redis"] = redis
+        self._functions = {}
+
+    def run(self, script: bytes, keys, args):
+        function = self._functions.get(script)
+        if function is None:
+            function = self.runtime.eval(b"function(KEYS, ARGV)\n" + script + b"\nend")
+            self._functions[script] = function
+        result = function(self.runtime.table_from(keys), self.runtime.table_from(args))
+        return self._to_redis(result)
+
+    def _call(self, *args):
+        return self._to_lua(self.call([_argument(a) for a in args]))
+
+    def _to_lua(self, reply):
+        if reply is None:
+            return False
+        if isinstance(reply, str):
+            return self.runtime.table_from({b"ok": reply.lstrip("+").encode()})
+        if isinstance(reply, (list, tuple, set)):
+            return self.runtime.table_from([self._to_lua(r) for r in reply])
+        return reply
+
+    def _to_redis(self, value):
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, float):
+            return int(value)
+        if lupa.lua_type(value) == "table":
+            if value[b"ok"] is not None:
+                return "+" + value[b"ok"].decode()
+            items = []
+            while value[len(items) + 1] is not None:
+                items.append(self._to_redis(value[len(items) + 1]))
+            return items
+        return value
+
+
+# Redis sends Lua numbers passed to commands as their decimal text
+def _argument(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).encode()
@@ -0,0 +1,91 @@
+# Python equivalents of model's Lua scripts, for the fake Redis when lupa is
+# not installed to run the Lua itself. Each takes the fake's data and the
+# script's KEYS and ARGV. python -m bench.scripts checks them against the Lua.
+from bench import fake_redis
+
+
+def write_key(db: fake_redis.FakeRedis, keys, args):
+    bucket_keys, index, stats, objects, size, parts, etag, last_modified = keys[:8]
+    storage = keys[8]
+    key, key_size, key_etag, key_last_modified, key_storage, count = args[:6]
+    count = int(count)
+    previous = list(db.smembers(objects))
+    previous_size = int(db.get(size) or 0)
+    db.delete(objects, parts)
+    if count > 0:
+        db.sadd(objects, *args[6 : 6 + count])
+    if len(args) > 6 + count:
+        db.rpush(parts, *args[6 + count :])
+    db.set(size, key_size)
+    db.set(etag, key_etag)
+    db.set(last_modified, key_last_modified)
+    if key_storage == b"":
+        db.delete(storage)
+    else:
+        db.set(storage, key_storage)
+    if len(keys) > 9:
+        db.delete(*keys[9:])
+    added = db.sadd(bucket_keys, key)
+    db.zadd(index, b"0", key)
+    if added == 1:
+        previous_size = 0
+    db.hincrby(stats, b"keys", str(added).encode())
+    db.hincrby(stats, b"bytes", str(int(key_size) - previous_size).encode())
+    return previous
+
+
+def delete_keys(db: fake_redis.FakeRedis, keys, args):
+    bucket_keys, index, stats = keys[:3]
+    removed = 0
+    size = 0
+    for i, key in enumerate(args):
+        key_keys = keys[3 + 6 * i : 9 + 6 * i]
+        if db.srem(bucket_keys, key) == 1:
+            removed += 1
+            size += int(db.get(key_keys[1]) or 0)
+        db.delete(*key_keys)
+    db.zrem(index, *args)
+    db.hincrby(stats, b"keys", str(-removed).encode())
+    db.hincrby(stats, b"bytes", str(-size).encode())
+    return removed
+
+
+def delete_bucket(db: fake_redis.FakeRedis, keys, args):
+    if db.scard(keys[0]) > 0:
+        return 0
+    db.srem(keys[1], args[0])
+    db.delete(*keys[2:])
+    return 1
+
+
+def reference_digest(db: fake_redis.FakeRedis, keys, args):
+    if db.exists(keys[0]):
+        db.hincrby(keys[0], b"refs", b"1")
+        return db.hmget(keys[0], b"objectID", b"storage")
+    if len(args) > 0:
+        db.hset(keys[0], b"objectID", args[0], b"storage", args[1], b"refs", b"1")
+        db.set(keys[1], keys[0])
+    return None
+
+
+def release_object(db: fake_redis.FakeRedis, keys, args):
+    if db.get(keys[0]) != keys[1]:
+        return 1
+    if db.hincrby(keys[1], b"refs", b"-1") > 0:
+        return 0
+    db.delete(keys[0], keys[1])
+    return 1
+
+
+# Register the handlers against model's script sources
+def install():
+    import model
+
+    for source, handler in (
+        (model.WRITE_KEY_SCRIPT, write_key),
+        (model.DELETE_KEYS_SCRIPT, delete_keys),
+        (model.DELETE_BUCKET_SCRIPT, delete_bucket),
+        (model.REFERENCE_DIGEST_SCRIPT, reference_digest),
+        (model.RELEASE_OBJECT_SCRIPT, release_object),
+    ):
+        fake_redis.SCRIPT_HANDLERS[source.encode()] = handler
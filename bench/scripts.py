@@ -0,0 +1,174 @@
+# Checks model's Lua scripts against their Python equivalents in
+# bench/model_scripts.py, which the fakes fall back to without lupa.
+#
+# Runs the same sequence of model calls twice against an in-process fake
+# Redis, once executing the real Lua scripts through lupa and once through
+# the Python equivalents, and compares each call's result and the keyspace it
+# leaves behind. Exits non-zero on the first difference.
+#
+#   pip install -r bench/requirements.txt
+#   python -m bench.scripts
+import argparse
+import asyncio
+import os
+import sys
+
+from bench import fake_redis, lua, model_scripts
+from bench.listing import free_port
+
+ACCOUNT_ID = "AKIABEN"
+BUCKET = "scripts"
+UPLOAD_ID = "upload"
+LAST_MODIFIED = "2020-11-20T00:00:00.000Z"
+
+
+# Model calls covering every script: new, overwritten and compressed keys, a
+# completed multipart upload, deletes of present and missing keys, deleting a
+# bucket with and without keys, and deduplicated object references
+def scenario(model):
+    upload = model.upload_prefix(BUCKET, UPLOAD_ID, ACCOUNT_ID)
+    return [
+        ("create bucket", lambda: model.create_bucket(BUCKET, ACCOUNT_ID)),
+        (
+            "put new key",
+            lambda: model.put_key(
+                BUCKET, "a", "o1", 10, "e1", LAST_MODIFIED, ACCOUNT_ID
+            ),
+        ),
+        (
+            "overwrite key with storage",
+            lambda: model.put_key(
+                BUCKET, "a", "o2", 25, "e2", LAST_MODIFIED, ACCOUNT_ID, "zlib:10"
+            ),
+        ),
+        (
+            "overwrite key without storage",
+            lambda: model.put_key(
+                BUCKET, "a", "o3", 7, "e3", LAST_MODIFIED, ACCOUNT_ID
+            ),
+        ),
+        (
+            "put second key",
+            lambda: model.put_key(
+                BUCKET, "b", "o4", 5, "e4", LAST_MODIFIED, ACCOUNT_ID
+            ),
+        ),
+        ("create upload", lambda: model.redis.set(upload, "big")),
+        (
+            "upload part",
+            lambda: model.set_upload_part(BUCKET, UPLOAD_ID, 1, "p1", 3, ACCOUNT_ID),
+        ),
+        (
+            "complete upload",
+            lambda: model.complete_upload(
+                BUCKET,
+                "big",
+                UPLOAD_ID,
+                [("p1", 3), ("p2", 4)],
+                "e5-2",
+                LAST_MODIFIED,
+                ACCOUNT_ID,
+            ),
+        ),
+        ("bucket stats", lambda: model.get_bucket_stats(BUCKET, ACCOUNT_ID)),
+        (
+            "delete present and missing keys",
+            lambda: model.delete_keys(BUCKET, ["a", "missing"], ACCOUNT_ID),
+        ),
+        ("delete bucket with keys", lambda: model.delete_bucket(BUCKET, ACCOUNT_ID)),
+        (
+            "delete remaining keys",
+            lambda: model.delete_keys(BUCKET, ["b", "big"], ACCOUNT_ID),
+        ),
+        (
+            "bucket stats after deletes",
+            lambda: model.get_bucket_stats(BUCKET, ACCOUNT_ID),
+        ),
+        ("delete empty bucket", lambda: model.delete_bucket(BUCKET, ACCOUNT_ID)),
+        (
+            "reference new digest",
+            lambda: model.reference_digest("d1", ACCOUNT_ID, "o5", "zlib:9"),
+        ),
+        (
+            "reference digest again",
+            lambda: model.reference_digest("d1", ACCOUNT_ID, "o6"),
+        ),
+        ("look up digest", lambda: model.reference_digest("d1", ACCOUNT_ID)),
+        ("look up missing digest", lambda: model.reference_digest("d2", ACCOUNT_ID)),
+        ("release shared object", lambda: model.release_objects(["o5"])),
+        (
+            "release last reference and unshared object",
+            lambda: model.release_objects(["o5", "o7"]),
+        ),
+    ]
+
+
+# The keyspace as plain values, so two fakes' data can be compared
+def snapshot(db: fake_redis.FakeRedis):
+    keyspace = {}
+    for key, value in db.data.items():
+        if isinstance(value, fake_redis.ZSet):
+            value = sorted(value.scores.items())
+        elif isinstance(value, set):
+            value = sorted(value)
+        elif isinstance(value, (dict, list)):
+            value = value.copy()
+        keyspace[key] = value
+    return keyspace
+
+
+async def run_scenario(server, model):
+    steps = []
+    for name, call in scenario(model):
+        result = await call()
+        if isinstance(result, list):
+            result = sorted(result)
+        steps.append((name, result, snapshot(server.db)))
+    return steps
+
+
+async def run(args):
+    if not lua.available():
+        sys.exit("lupa is not installed: pip install -r bench/requirements.txt")
+    server = await fake_redis.FakeRedisServer().start(port=free_port())
+    os.environ["SOS_REDIS_PORT"] = str(server.port)
+    import model
+
+    model_scripts.install()
+    runs = []
+    for lua_scripts in (True, False):
+        server.db = fake_redis.FakeRedis(lua_scripts=lua_scripts)
+        model.metadata_cache.clear()
+        runs.append(await run_scenario(server, model))
+
+    await model.close()
+    await server.stop()
+    failed = False
+    for (name, result, keyspace), (_, expected, expected_keyspace) in zip(*runs):
+        if result != expected:
+            print(f"{name:<32} result {result!r}, Python gives {expected!r}")
+            failed = True
+        elif keyspace != expected_keyspace:
+            print(f"{name:<32} keyspace differs")
+            for key in sorted(set(keyspace) | set(expected_keyspace)):
+                if keyspace.get(key) != expected_keyspace.get(key):
+                    print(
+                        f"  {key.decode()}: {keyspace.get(key)!r}, "
+                        f"Python gives {expected_keyspace.get(key)!r}"
+                    )
+            failed = True
+        elif args.verbose:
+            print(f"{name:<32} ok")
+        if failed:
+            sys.exit(1)
+    print(f"{len(runs[0])} script calls match their Python equivalents")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--verbose", action="store_true", help="List every call")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# ListObjectsV2 and ListBuckets rendering time, dict2xml against the
+# streaming serializer.
+#
+#   python -m bench.serializer --entries 1000 10000 100000
+import argparse
+import json
+import time
+from datetime import datetime
+
+from dict2xml import dict2xml
+
+import serializer
+
+
+# The dict2xml rendering the streaming serializer replaced
+def dict2xml_list_bucket_objects(bucket, objects, config):
+    contents = [
+        {
+            "ETag": "eTag",
+            "Key": o.get("key"),
+            "LastModified": str(datetime.now()),
+            "Owner": {"DisplayName": o.get("display_name"), "ID": o.get("id")},
+            "Size": o.get("size"),
+            "StorageClass": "standard",
+        }
+        for o in objects
+    ]
+    return dict2xml(
+        {
+            "ListBucketResult": {
+                "@": {"xmlns": "http://doc.s3.amazonaws.com/2006-03-01/"},
+                "IsTruncated": False,
+                "KeyCount": len(objects),
+                "MaxKeys": config.get("max-keys") or 1000,
+                "Name": bucket,
+                "Prefix": config.get("prefix") or "",
+                "Contents": contents,
+            }
+        }
+    )
+
+
+def dict2xml_list_buckets(buckets, owner):
+    return dict2xml(
+        {
+            "ListAllMyBucketsResult": {
+                "Buckets": [
+                    {
+                        "Bucket": {
+                            "Name": b.get("name"),
+                            "CreationDate": b.get("creation_date"),
+                        }
+                    }
+                    for b in buckets
+                ],
+                "Owner": {"DisplayName": owner["display_name"], "ID": owner["id"]},
+            }
+        }
+    )
+
+
+def timed(call, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 3)
+
+
+def first_fragment(fragments):
+    next(iter(fragments))
+
+
+def run(args):
+    owner = {"display_name": "benchac", "id": "benchac"}
+    config = {"max-keys": 1000, "prefix": ""}
+    results = []
+    for count in args.entries:
+        objects = [
+            {
+                "key": f"logs/2020/11/20/object-{i:08d}.json",
+                "size": str(1024 + i),
+                "display_name": "benchac",
+                "id": "benchac",
+            }
+            for i in range(count)
+        ]
+        buckets = [
+            {"name": f"bucket-{i:08d}", "creation_date": "2020-11-20 09:03:20.903719"}
+            for i in range(count)
+        ]
+        cases = {
+            "list_bucket_objects": (
+                lambda: dict2xml_list_bucket_objects("bench", objects, config),
+                lambda: serializer.list_bucket_objects("bench", objects, config),
+                lambda: serializer.iter_list_bucket_objects("bench", objects, config),
+            ),
+            "list_buckets": (
+                lambda: dict2xml_list_buckets(buckets, owner),
+                lambda: serializer.list_buckets(buckets, owner),
+                lambda: serializer.iter_list_buckets(buckets, owner),
+            ),
+        }
+        for name, (before, after, streamed) in cases.items():
+            result = {
+                "operation": name,
+                "entries": count,
+                "dict2xml_ms": timed(before, args.repeat),
+                "serializer_ms": timed(after, args.repeat),
+                "first_fragment_ms": timed(
+                    lambda: first_fragment(streamed()), args.repeat
+                ),
+            }
+            result["speedup"] = round(result["dict2xml_ms"] / result["serializer_ms"], 1)
+            results.append(result)
+            print(
+                f"{name:<20} entries={count:<7} "
+                f"dict2xml={result['dict2xml_ms']:>10.3f}ms "
+                f"serializer={result['serializer_ms']:>9.3f}ms "
+                f"({result['speedup']}x) "
+                f"first fragment={result['first_fragment_ms']:.3f}ms"
+            )
+
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--entries", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
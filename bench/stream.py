@@ -0,0 +1,156 @@
+# Object download throughput from a local fake object server.
+#
+# Compares the per-MTU reads object_store.stream started with and the
+# StreamReader reads it used before pooled buffers, with the pooled-buffer
+# protocol at several chunk sizes. Each is measured reading objects directly
+# and through main:api's /api/{object_id}/stream.
+#
+#   python -m bench.stream --object-mb 64 --chunk-kb 64 256 1024
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from bench import asgi, fake_dataputter, fake_redis
+from bench.listing import free_port
+
+
+# object_store.stream as it was, reading with the given size from a StreamReader
+def stream_reader(object_store, read_size: int):
+    async def stream(object_id):
+        endpoint = object_store.object_servers.choose()
+        reader, writer = await asyncio.open_connection(*endpoint.address)
+        try:
+            writer.write(object_id.encode())
+            while True:
+                chunk = await reader.read(read_size)
+                if len(chunk) == 0:
+                    break
+                yield chunk
+        finally:
+            writer.close()
+
+    return stream
+
+
+def pooled_protocol(object_store, stream, chunk_size: int):
+    object_store.stream_buffers = object_store.BufferPool(
+        chunk_size, object_store.STREAM_FREE_BUFFERS
+    )
+    return stream
+
+
+async def measure_direct(stream, object_id: str, repeat: int):
+    chunks = 0
+    size = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        async for chunk in stream(object_id):
+            chunks += 1
+            size += len(chunk)
+    return size, chunks, time.perf_counter() - started
+
+
+async def measure_api(api, object_id: str, repeat: int):
+    size = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = await asgi.request(api, "GET", f"/api/{object_id}/stream")
+        size += len(result.body)
+    return size, None, time.perf_counter() - started
+
+
+# Serve the fake object server from another process, so its work is not
+# counted against the reader being measured. Returns the process, the object
+# server's endpoint and the id of an object of `size` random bytes
+def start_object_server(size: int):
+    parent, child = multiprocessing.Pipe()
+
+    def serve():
+        async def main():
+            dataputter = await fake_dataputter.FakeDataPutter().start()
+            object_id = dataputter.new_object_id()
+            dataputter.objects[object_id] = os.urandom(size)
+            child.send((dataputter.object_server_endpoint, object_id.decode()))
+            await asyncio.Event().wait()
+
+        asyncio.run(main())
+
+    process = multiprocessing.get_context("fork").Process(target=serve, daemon=True)
+    process.start()
+    endpoint, object_id = parent.recv()
+    return process, tuple(endpoint), object_id
+
+
+async def run(args):
+    process, endpoint, object_id = start_object_server(args.object_mb * 1024 * 1024)
+    redis_server = await fake_redis.FakeRedisServer().start(port=free_port())
+    os.environ["SOS_REDIS_PORT"] = str(redis_server.port)
+    import main
+    import object_store
+
+    object_store.object_servers = object_store.EndpointSet([endpoint])
+    original_stream = object_store.stream_from_server
+
+    cases = [
+        ("mtu_reads", lambda: stream_reader(object_store, 1500)),
+        ("stream_reader_64k", lambda: stream_reader(object_store, 64 * 1024)),
+    ]
+    for chunk_kb in args.chunk_kb:
+        cases.append(
+            (
+                f"pooled_{chunk_kb}k",
+                lambda kb=chunk_kb: pooled_protocol(
+                    object_store, original_stream, kb * 1024
+                ),
+            )
+        )
+
+    results = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        async with asgi.Lifespan(main.api) as api:
+            for name, make_stream in cases:
+                stream = make_stream()
+                object_store.stream = stream
+                for path, measure in (
+                    ("direct", lambda: measure_direct(stream, object_id, args.repeat)),
+                    ("api", lambda: measure_api(api, object_id, args.repeat)),
+                ):
+                    size, chunks, elapsed = await measure()
+                    result = {
+                        "case": name,
+                        "path": path,
+                        "mb_per_s": round(size / elapsed / 1024 / 1024, 1),
+                        "chunks_per_object": chunks // args.repeat
+                        if chunks is not None
+                        else None,
+                    }
+                    results.append(result)
+                    line = f"{name:<18} {path:<7} {result['mb_per_s']:>8.1f} MB/s"
+                    if chunks is not None:
+                        line += f" ({result['chunks_per_object']} chunks)"
+                    print(line, file=sys.__stdout__, flush=True)
+            object_store.stream = original_stream
+
+    await redis_server.stop()
+    process.terminate()
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--object-mb", type=int, default=64)
+    parser.add_argument("--chunk-kb", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+# End-to-end throughput and latency of the S3 and UI APIs.
+#
+# Starts an in-process fake Redis and fake data-putter, then drives main:s3
+# and main:api through their ASGI interfaces with concurrent clients. Each
+# operation reports requests per second and p50/p99 latency; --output writes
+# the results as JSON and --compare prints the change against such a file.
+#
+#   python -m bench.suite --requests 500 --concurrency 16 \
+#       --bucket-sizes 100 1000 10000 --output bench.json
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List
+
+from bench import asgi, fake_dataputter, fake_redis, model_scripts
+from bench.listing import free_port
+
+AUTH = {
+    "Authorization": "AWS4-HMAC-SHA256 "
+    "Credential=AKIABENCHMARK/20201120/us-east-1/s3/aws4_request, "
+    "SignedHeaders=host, Signature=bench"
+}
+BUCKET = "bench"
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    if len(ordered) == 0:
+        return 0.0
+    index = min(int(fraction * len(ordered)), len(ordered) - 1)
+    return ordered[index]
+
+
+# Send `requests` requests from `concurrency` clients, each waiting for its
+# response before sending the next
+async def measure(
+    operation: str,
+    send: Callable,
+    requests: int,
+    concurrency: int,
+    params: Dict = None,
+) -> Dict:
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in pending:
+            started = time.perf_counter()
+            result = await send(i)
+            latencies.append(time.perf_counter() - started)
+            if result.status >= 300:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "operation": operation,
+        "params": params or {},
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(requests / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "errors": errors,
+    }
+
+
+def case_name(result: Dict) -> str:
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['operation']}[{params}]" if params else result["operation"]
+
+
+def report(result: Dict, baseline: Dict = None):
+    line = (
+        f"{case_name(result):<36} {result['throughput_rps']:>9.1f} req/s "
+        f"p50={result['p50_ms']:>8.3f}ms p99={result['p99_ms']:>8.3f}ms"
+    )
+    if result["errors"]:
+        line += f" errors={result['errors']}"
+    if baseline is not None:
+        change = result["throughput_rps"] / baseline["throughput_rps"] - 1
+        line += f" ({change:+.1%} req/s, p99 was {baseline['p99_ms']:.3f}ms)"
+    print(line, file=sys.__stdout__, flush=True)
+
+
+# Add keys straight to the fake's data, as PutObject would have recorded them
+def populate_bucket(
+    db: fake_redis.FakeRedis, account_id: str, bucket: str, keys: int
+):
+    names = [f"key-{i:08d}".encode() for i in range(keys)]
+    db.sadd(f"/keys/{account_id}/{bucket}".encode(), *names)
+    index_args = []
+    for name in names:
+        index_args += [b"0", name]
+    db.zadd(f"/keyIndex/{account_id}/{bucket}".encode(), *index_args)
+    for name in names:
+        db.set(f"/keys/{account_id}/{bucket}/{name.decode()}/size".encode(), b"1024")
+
+
+async def run_suite(args, redis_server, s3, api, account_id) -> List:
+    results = []
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as infile:
+            baselines = {case_name(r): r for r in json.load(infile)["results"]}
+
+    async def record(result):
+        results.append(result)
+        report(result, baselines.get(case_name(result)))
+
+    body = os.urandom(args.object_size)
+    size = {"object_size": args.object_size}
+    await asgi.request(s3, "PUT", f"/{BUCKET}", headers=AUTH)
+
+    await record(
+        await measure(
+            "put_object",
+            lambda i: asgi.request(
+                s3, "PUT", f"/{BUCKET}/object-{i}", headers=AUTH, body=body
+            ),
+            args.requests,
+            args.concurrency,
+            size,
+        )
+    )
+    await record(
+        await measure(
+            "get_object",
+            lambda i: asgi.request(s3, "GET", f"/{BUCKET}/object-{i}", headers=AUTH),
+            args.requests,
+            args.concurrency,
+            size,
+        )
+    )
+
+    object_ids = []
+    for i in range(args.requests):
+        key = f"/keys/{account_id}/{BUCKET}/object-{i}".encode()
+        object_ids.append(next(iter(redis_server.db.smembers(key))).decode())
+    await record(
+        await measure(
+            "api_stream",
+            lambda i: asgi.request(api, "GET", f"/api/{object_ids[i]}/stream"),
+            args.requests,
+            args.concurrency,
+            size,
+        )
+    )
+
+    for keys in args.bucket_sizes:
+        bucket = f"{BUCKET}-list-{keys}"
+        await asgi.request(s3, "PUT", f"/{bucket}", headers=AUTH)
+        populate_bucket(redis_server.db, account_id, bucket, keys)
+        await record(
+            await measure(
+                "list_objects_v2",
+                lambda i: asgi.request(
+                    s3, "GET", f"/{bucket}?list-type=2", headers=AUTH
+                ),
+                args.list_requests,
+                args.concurrency,
+                {"keys": keys},
+            )
+        )
+
+    await record(
+        await measure(
+            "list_buckets",
+            lambda i: asgi.request(s3, "GET", "/", headers=AUTH),
+            args.requests,
+            args.concurrency,
+            {"buckets": len(args.bucket_sizes) + 1},
+        )
+    )
+    await record(
+        await measure(
+            "delete_object",
+            lambda i: asgi.request(
+                s3, "DELETE", f"/{BUCKET}/object-{i}", headers=AUTH
+            ),
+            args.requests,
+            args.concurrency,
+            size,
+        )
+    )
+    return results
+
+
+async def run(args):
+    redis_server = await fake_redis.FakeRedisServer(
+        latency=args.redis_latency_ms / 1000
+    ).start(port=free_port())
+    dataputter = await fake_dataputter.FakeDataPutter(
+        latency=args.dataputter_latency_ms / 1000
+    ).start()
+    os.environ["SOS_REDIS_PORT"] = str(redis_server.port)
+    import main
+    import object_store
+    import s3_api
+
+    model_scripts.install()
+    object_store.routers = object_store.EndpointSet([dataputter.router_endpoint])
+    object_store.object_servers = object_store.EndpointSet(
+        [dataputter.object_server_endpoint]
+    )
+
+    # Request logs are written to stdout; keep them out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        account_id = s3_api.simple_aws_account_id(AUTH["Authorization"])
+        async with asgi.Lifespan(main.s3) as s3, asgi.Lifespan(main.api) as api:
+            results = await run_suite(args, redis_server, s3, api, account_id)
+
+    await dataputter.stop()
+    await redis_server.stop()
+    if args.output:
+        with open(args.output, "w") as outfile:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "args": vars(args),
+                    "results": results,
+                },
+                outfile,
+                indent=2,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument(
+        "--list-requests",
+        type=int,
+        default=50,
+        help="Requests per ListObjectsV2 bucket size",
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--object-size", type=int, default=64 * 1024)
+    parser.add_argument(
+        "--bucket-sizes", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument(
+        "--redis-latency-ms",
+        type=float,
+        default=0,
+        help="Latency added to every Redis round-trip",
+    )
+    parser.add_argument(
+        "--dataputter-latency-ms",
+        type=float,
+        default=0,
+        help="Latency added to every data-putter request",
+    )
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="Show changes against a previous --output")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import collections
+import time
+from typing import Any, Hashable, Optional
+
+import metrics
+
+# Returned by TTLCache.get when a key is absent or expired
+MISSING = object()
+
+
+# A bounded in-process cache with per-entry expiry and LRU eviction.
+#
+# `version` changes on every invalidation. A value loaded while an
+# invalidation happened is stale, so `set` drops it when given the version
+# read before loading.
+#
+# Hits, misses, evictions and the number of entries are exported as metrics
+# labelled with the cache's `name`.
+class TTLCache:
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            metrics.cache_misses_total.inc(self.name)
+            return MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._count_entries()
+            metrics.cache_misses_total.inc(self.name)
+            return MISSING
+        self._entries.move_to_end(key)
+        metrics.cache_hits_total.inc(self.name)
+        return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        version: Optional[int] = None,
+        ttl: Optional[float] = None,
+    ):
+        if self.max_entries <= 0:
+            return
+        if version is not None and version != self.version:
+            return
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            metrics.cache_evictions_total.inc(self.name)
+        self._count_entries()
+
+    def invalidate(self, key: Hashable):
+        self.version += 1
+        self._entries.pop(key, None)
+        self._count_entries()
+
+    def clear(self):
+        self.version += 1
+        self._entries.clear()
+        self._count_entries()
+
+    def _count_entries(self):
+        metrics.cache_entries.set(self.name, value=len(self._entries))
@@ -0,0 +1,189 @@
+# Streaming codecs for objects stored compressed, and gzip for responses.
+#
+# A bucket may store its objects compressed with one of CODECS. The codec is
+# recorded with each key, so the bucket's setting can change at any time and
+# keys written before still read back. zstd needs the zstandard package and
+# is offered only when it is installed.
+import asyncio
+import os
+import zlib
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies smaller than this are stored as they are
+MIN_SIZE = int(os.environ.get("SOS_COMPRESSION_MIN_SIZE") or 4096)
+# Bytes from the front of a body compressed to decide whether the rest is
+# worth compressing
+SAMPLE_SIZE = 64 * 1024
+# A sample which compresses to more than this fraction of its size is taken
+# to be incompressible, such as media or data compressed already
+MAX_RATIO = 0.9
+# Largest chunk handed on while decompressing
+OUTPUT_SIZE = 256 * 1024
+# Chunks at least this large are compressed on a worker thread, so the event
+# loop keeps serving other requests; zlib and zstd release the GIL
+OFFLOAD_SIZE = 64 * 1024
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 5
+
+
+class Zlib:
+    name = "zlib"
+
+    def compressor(self):
+        return zlib.compressobj(ZLIB_LEVEL)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+    # Output is handed on in chunks of at most OUTPUT_SIZE bytes, however
+    # well the data compressed
+    def decompress(self, decompressor, data: bytes) -> Iterator[bytes]:
+        while data:
+            output = decompressor.decompress(data, OUTPUT_SIZE)
+            data = decompressor.unconsumed_tail
+            if output:
+                yield output
+
+    def is_complete(self, decompressor) -> bool:
+        return decompressor.eof
+
+
+class Zstd:
+    name = "zstd"
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj(write_size=OUTPUT_SIZE)
+
+    def decompress(self, decompressor, data: bytes) -> Iterator[bytes]:
+        output = decompressor.decompress(data)
+        if output:
+            yield output
+
+    def is_complete(self, decompressor) -> bool:
+        return decompressor.eof
+
+
+CODECS: Dict[str, object] = {"zlib": Zlib()}
+DECODE_ERRORS: Tuple = (zlib.error,)
+if zstandard is not None:
+    CODECS["zstd"] = Zstd()
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+# Stored keys record their codec and stored size as "<codec>:<size>"
+def encode_storage(codec: str, stored_size: int) -> str:
+    return f"{codec}:{stored_size}"
+
+
+def decode_storage(storage: bytes) -> Tuple[str, int]:
+    codec, _, stored_size = storage.decode("UTF-8").partition(":")
+    return codec, int(stored_size)
+
+
+async def _chain(first: bytes, chunks: AsyncIterator[bytes]):
+    if first:
+        yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+# Read at least `size` bytes from the front of `chunks`, unless it ends
+# first. Returns them and an iterator over the whole body, including them
+async def peek(chunks: AsyncIterator[bytes], size: int):
+    sample = bytearray()
+    async for chunk in chunks:
+        sample += chunk
+        if len(sample) >= size:
+            break
+    sample = bytes(sample)
+    return sample, _chain(sample, chunks)
+
+
+def is_compressible(codec_name: str, sample: bytes) -> bool:
+    if len(sample) == 0:
+        return False
+    compressor = CODECS[codec_name].compressor()
+    compressed = len(compressor.compress(sample[:SAMPLE_SIZE]))
+    compressed += len(compressor.flush())
+    return compressed <= MAX_RATIO * min(len(sample), SAMPLE_SIZE)
+
+
+async def _run(function, data: bytes) -> bytes:
+    if len(data) < OFFLOAD_SIZE:
+        return function(data)
+    return await asyncio.get_running_loop().run_in_executor(None, function, data)
+
+
+async def compress(chunks: AsyncIterator[bytes], codec_name: str):
+    compressor = CODECS[codec_name].compressor()
+    async for chunk in chunks:
+        output = await _run(compressor.compress, chunk)
+        if output:
+            yield output
+    output = compressor.flush()
+    if output:
+        yield output
+
+
+class CorruptObject(Exception):
+    pass
+
+
+# Decompress a stored object as it is read. An object which ends part way
+# through its compressed stream raises CorruptObject
+async def decompress(chunks: AsyncIterator[bytes], codec_name: str):
+    codec = CODECS.get(codec_name)
+    if codec is None:
+        raise CorruptObject(f"Stored with codec {codec_name}, which is unavailable")
+    decompressor = codec.decompressor()
+    try:
+        async for chunk in chunks:
+            try:
+                for output in codec.decompress(decompressor, chunk):
+                    yield output
+            except DECODE_ERRORS as e:
+                raise CorruptObject(f"Undecodable {codec_name} data: {e}")
+    finally:
+        await chunks.aclose()
+    if not codec.is_complete(decompressor):
+        raise CorruptObject(f"Object ends part way through its {codec_name} data")
+
+
+# Whether an Accept-Encoding header allows gzip
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    if accept_encoding is None:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, parameters = coding.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = parameters.strip()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+# Compress a response body with gzip as it is sent. The compressor holds
+# output back until it has a block worth sending, which also batches many
+# small fragments into fewer sends
+async def gzip_stream(chunks: AsyncIterator[bytes]):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        output = compressor.compress(chunk)
+        if output:
+            yield output
+    yield compressor.flush()
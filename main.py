@@ -1,16 +1,51 @@
-from fastapi import FastAPI, File, Header, Request, Response
+from fastapi import Body, FastAPI, File, Header, HTTPException, Query, Request
+from fastapi import Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 
-from typing import Optional
+from typing import Dict, List, Optional
+import contextlib
+import json
 import socket
 import os
 
+import metrics
 import model
 import object_store
 import s3_api
+import timing
 
-api = FastAPI()
+
+# Connections opened to Redis and the data-putter router before a worker
+# takes traffic
+WARMUP_CONNECTIONS = int(os.environ.get("SOS_WARMUP_CONNECTIONS") or 8)
+
+# Whether this worker has warmed up and is not shutting down
+ready = False
+
+
+# Open connections before serving, follow metadata cache invalidations from
+# other workers and check data-putter endpoints while serving, and release
+# the Redis and data-putter connection pools on shutdown
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready
+    await model.load_scripts()
+    await model.warm_up(WARMUP_CONNECTIONS)
+    await object_store.warm_up(WARMUP_CONNECTIONS)
+    invalidation_listener = model.start_invalidation_listener()
+    health_checks = object_store.start_health_checks()
+    ready = True
+    yield
+    ready = False
+    for task in (invalidation_listener, health_checks):
+        if task is not None:
+            task.cancel()
+    await model.close()
+    await object_store.close_pools()
+
+
+api = FastAPI(lifespan=lifespan)
 api.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -18,8 +53,10 @@ api.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+api.add_middleware(metrics.MetricsMiddleware, app_name="api")
+api.add_middleware(timing.TimingMiddleware, request_id_header="X-Request-Id")
 
-s3 = FastAPI()
+s3 = FastAPI(lifespan=lifespan)
 s3.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -27,34 +64,131 @@ s3.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+s3.add_middleware(metrics.MetricsMiddleware, app_name="s3")
+s3.add_middleware(timing.TimingMiddleware, request_id_header="x-amz-request-id")
+
+
+# The metrics port of one worker under server.py, so that Prometheus can
+# scrape each worker rather than whichever one accepts the connection
+worker_metrics = FastAPI()
+
+
+# Operational endpoints are served on the UI API, and metrics also on the
+# worker metrics port, but never on the S3 port. There they would take over
+# buckets of the same names and expose metrics publicly
+
+# Prometheus metrics of this worker
+@worker_metrics.get("/metrics")
+@api.get("/metrics")
+async def metrics_index():
+    return Response(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+# Liveness: the worker's event loop is answering
+@api.get("/healthz")
+async def liveness():
+    return Response("ok\n", media_type="text/plain")
+
+
+# Readiness: the worker has warmed up, is not shutting down and can reach
+# Redis
+@api.get("/readyz")
+async def readiness():
+    if ready and await model.ping():
+        return Response("ready\n", media_type="text/plain")
+    return Response("not ready\n", status_code=503, media_type="text/plain")
+
+
 # S3 API
 s3.include_router(s3_api.api)
 
 
 @s3.exception_handler(s3_api.S3ApiException)
 async def s3_api_exception_handler(req: Request, ex: s3_api.S3ApiException):
+    metrics.s3_errors_total.inc(ex.code or "Unknown")
     return Response(ex.body, status_code=ex.status_code, headers=s3_api.XML_HEADERS)
 
 
 # API for UI
+
+# ObjectIDs listed per page. The listing is paged with SSCAN, so a call costs
+# Redis and the client about this much however many objects there are
+API_LIST_LIMIT = int(os.environ.get("SOS_API_LIST_LIMIT") or 1000)
+API_LIST_MAX_LIMIT = 10000
+
+
+# Stream every objectID from `cursor` on as newline-delimited JSON, one page
+# at a time
+async def object_lines(cursor: int, limit: int):
+    while True:
+        object_ids, cursor = await model.list_object_page(cursor, limit)
+        if len(object_ids) > 0:
+            yield "".join(
+                json.dumps({"objectId": object_id}) + "\n" for object_id in object_ids
+            )
+        if cursor == 0:
+            break
+
+
+# A page of objectIDs and the cursor of the next page, null on the last.
+# With ?format=ndjson every objectID from the cursor on is streamed instead
 @api.get("/api")
-def index():
+async def index(
+    limit: int = Query(API_LIST_LIMIT, ge=1, le=API_LIST_MAX_LIMIT),
+    cursor: int = Query(0, ge=0),
+    format: Optional[str] = None,
+):
+    if format == "ndjson":
+        return StreamingResponse(
+            object_lines(cursor, limit), media_type="application/x-ndjson"
+        )
+    object_ids, next_cursor = await model.list_object_page(cursor, limit)
     return {
-        "objects": model.list_objects(),
+        "objects": object_ids,
+        # Cursors are unsigned 64-bit, beyond the integers JSON clients keep
+        "cursor": str(next_cursor) if next_cursor != 0 else None,
     }
 
 
-@api.get("/api/{object_id}")
-def object_index(object_id, query=None):
+# Most objects one batchGet request may name
+API_BATCH_GET_LIMIT = 1000
+
+
+def object_detail(details: Dict) -> Dict:
+    return {
+        "ticketCount": details["ticket_count"],
+        "nodes": details["nodes"],
+        "tickets": details["tickets"],
+        "size": details["size"],
+        "contentType": details["content_type"] or "text/plain",
+    }
+
+
+# Details of many objects from one pipelined Redis round-trip, in the order
+# their ids were given
+@api.post("/api/objects:batchGet")
+async def object_batch_get(
+    object_ids: List[str] = Body(..., embed=True, alias="objectIds")
+):
+    if len(object_ids) > API_BATCH_GET_LIMIT:
+        raise HTTPException(
+            400, f"At most {API_BATCH_GET_LIMIT} objectIds can be requested at once"
+        )
+    details = await model.get_object_details(object_ids)
     return {
-        "ticketCount": model.get_ticket_count(object_id),
-        "nodes": model.get_object_nodes(object_id),
-        "tickets": model.get_object_tickets(object_id),
-        "size": model.get_object_size(object_id),
-        "contentType": model.get_content_type(object_id) or "text/plain",
+        "objects": [
+            {"objectId": object_id, **object_detail(object_details)}
+            for object_id, object_details in zip(object_ids, details)
+        ]
     }
 
 
+@api.get("/api/{object_id}")
+async def object_index(object_id, query=None):
+    (details,) = await model.get_object_details([object_id])
+    return object_detail(details)
+
+
 @api.get("/api/{object_id}/stream")
 async def object_stream(object_id):
     return StreamingResponse(
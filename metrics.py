@@ -0,0 +1,344 @@
+# Process-local counters, gauges and histograms, rendered in the Prometheus
+# text exposition format.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Every metric is a plain dict of label values to numbers, so recording a
+# sample costs a dict update and no locks; the event loop is single threaded.
+# Each worker process keeps its own, so every sample is labelled with the
+# worker it came from and Prometheus sums them across workers.
+import bisect
+import contextlib
+import contextvars
+import functools
+import time
+from typing import Dict, List, Sequence, Tuple
+
+# Upper bounds, in seconds, of latency histogram buckets
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry: List["Metric"] = []
+
+# Index of this worker under server.py, which sets it. Indices are reused by
+# restarted workers, so series do not multiply with restarts
+worker = "0"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.append(f'worker="{worker}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+        registry.append(self)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.label_names, labels), value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    # Each series is [count per bucket..., count above the last bucket, sum]
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                bucket = _labels(self.label_names, labels, f'le="{_number(bound)}"')
+                yield f"{self.name}_bucket", bucket, cumulative
+            label_text = _labels(self.label_names, labels)
+            yield f"{self.name}_sum", label_text, series[-1]
+            yield f"{self.name}_count", label_text, cumulative
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# HTTP requests
+requests_in_flight = Gauge(
+    "sos_http_requests_in_flight", "Requests being served", ["app"]
+)
+requests_total = Counter(
+    "sos_http_requests_total",
+    "Requests served by operation and status",
+    ["app", "operation", "status"],
+)
+request_seconds = Histogram(
+    "sos_http_request_duration_seconds",
+    "Time to serve a request, including its streamed body",
+    ["app", "operation"],
+)
+s3_errors_total = Counter(
+    "sos_s3_errors_total", "S3 error responses by error Code", ["code"]
+)
+
+# Redis, by the model function which issued the commands
+model_call_seconds = Histogram(
+    "sos_model_call_duration_seconds",
+    "Time spent in each model function",
+    ["function"],
+)
+redis_commands_total = Counter(
+    "sos_redis_commands_total",
+    "Redis commands sent, by the model function which sent them",
+    ["function"],
+)
+redis_round_trips_total = Counter(
+    "sos_redis_round_trips_total",
+    "Redis round-trips, a pipeline counting once, by model function",
+    ["function"],
+)
+
+# Data-putter
+dataputter_connect_seconds = Histogram(
+    "sos_dataputter_connect_duration_seconds",
+    "Time to open a connection to a data-putter endpoint",
+    ["endpoint"],
+)
+dataputter_request_seconds = Histogram(
+    "sos_dataputter_request_duration_seconds",
+    "Time to complete a data-putter operation, including transfer",
+    ["operation"],
+)
+dataputter_bytes_total = Counter(
+    "sos_dataputter_bytes_total",
+    "Object bytes sent to or received from data-putter",
+    ["direction"],
+)
+dataputter_errors_total = Counter(
+    "sos_dataputter_errors_total", "Failed data-putter operations", ["operation"]
+)
+dataputter_retries_total = Counter(
+    "sos_dataputter_retries_total",
+    "Data-putter operations retried on another endpoint",
+    ["operation"],
+)
+dataputter_first_byte_seconds = Histogram(
+    "sos_dataputter_first_byte_duration_seconds",
+    "Time from asking an object server for an object to its first byte",
+    ["endpoint"],
+)
+dataputter_hedged_reads_total = Counter(
+    "sos_dataputter_hedged_reads_total",
+    "Reads also sent to a second endpoint because the first was slow",
+)
+dataputter_hedged_read_wins_total = Counter(
+    "sos_dataputter_hedged_read_wins_total",
+    "Hedged reads answered first by the second endpoint",
+)
+dataputter_ejections_total = Counter(
+    "sos_dataputter_ejections_total",
+    "Endpoints taken out of rotation after failing requests in a row",
+    ["endpoint"],
+)
+dataputter_endpoint_up = Gauge(
+    "sos_dataputter_endpoint_up",
+    "Whether a data-putter endpoint is in rotation",
+    ["endpoint"],
+)
+
+# In-process metadata caches
+cache_hits_total = Counter(
+    "sos_cache_hits_total", "Lookups answered from an in-process cache", ["cache"]
+)
+cache_misses_total = Counter(
+    "sos_cache_misses_total",
+    "Lookups an in-process cache could not answer, absent or expired",
+    ["cache"],
+)
+cache_evictions_total = Counter(
+    "sos_cache_evictions_total", "Entries evicted to make room", ["cache"]
+)
+cache_entries = Gauge(
+    "sos_cache_entries", "Entries held by an in-process cache", ["cache"]
+)
+
+# Deduplication of PutObject bodies
+dedup_lookups_total = Counter(
+    "sos_dedup_lookups_total",
+    "PutObject bodies looked up by digest, by whether they were stored already",
+    ["result"],
+)
+dedup_bytes_saved_total = Counter(
+    "sos_dedup_bytes_saved_total",
+    "Bytes of PutObject bodies not stored again because they were stored already",
+)
+
+# Object byte cache
+object_cache_hits_total = Counter(
+    "sos_object_cache_hits_total", "Object reads served from the cache", ["tier"]
+)
+object_cache_misses_total = Counter(
+    "sos_object_cache_misses_total", "Object reads which went to data-putter"
+)
+object_cache_evictions_total = Counter(
+    "sos_object_cache_evictions_total", "Objects evicted to make room", ["tier"]
+)
+object_cache_rejections_total = Counter(
+    "sos_object_cache_rejections_total", "Objects too large to be cached"
+)
+object_cache_bytes = Gauge(
+    "sos_object_cache_bytes", "Bytes of objects held in the cache", ["tier"]
+)
+
+
+# The model function a Redis command is issued for. Nested model calls
+# attribute commands to the innermost function
+model_function = contextvars.ContextVar("model_function", default="other")
+
+
+def count_redis_commands(commands: int):
+    function = model_function.get()
+    redis_commands_total.inc(function, amount=commands)
+    redis_round_trips_total.inc(function)
+
+
+def timed_model_call(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    async def timed(*args, **kwargs):
+        token = model_function.set(name)
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            model_call_seconds.observe(time.perf_counter() - started, name)
+            model_function.reset(token)
+
+    return timed
+
+
+# Routes which serve several S3 operations, such as PutObject and UploadPart,
+# name the one a request ran in its scope for the request metrics
+def set_operation(scope, operation: str):
+    scope["sos.operation"] = operation
+
+
+# ASGI middleware recording in-flight requests and, once the response has
+# been sent, the latency and status of the request's operation: the one its
+# route named with set_operation, otherwise the route function's
+class MetricsMiddleware:
+    def __init__(self, app, app_name: str):
+        self.app = app
+        self.app_name = app_name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        requests_in_flight.inc(self.app_name)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            requests_in_flight.dec(self.app_name)
+            # The router records the matched endpoint in the scope
+            endpoint = scope.get("endpoint")
+            operation = scope.get("sos.operation") or getattr(
+                endpoint, "__name__", "unmatched"
+            )
+            request_seconds.observe(elapsed, self.app_name, operation)
+            requests_total.inc(self.app_name, operation, status["code"])
@@ -1,215 +1,1049 @@
-from redis import Redis
-from typing import List
+import asyncio
+import base64
+import binascii
+import json
+import os
+import uuid
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import RedisError
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 
-redis = Redis(host="127.0.0.1", port=6379,)
+import cache
+import compression
+import metrics
+import object_cache
+import timing
+
+REDIS_HOST = os.environ.get("SOS_REDIS_HOST") or "127.0.0.1"
+REDIS_PORT = int(os.environ.get("SOS_REDIS_PORT") or 6379)
+REDIS_DB = int(os.environ.get("SOS_REDIS_DB") or 0)
+# Connections shared by every request in a worker. Callers wait for a free
+# connection rather than opening more than this
+REDIS_POOL_SIZE = int(os.environ.get("SOS_REDIS_POOL_SIZE") or 64)
+REDIS_POOL_TIMEOUT = float(os.environ.get("SOS_REDIS_POOL_TIMEOUT") or 5)
+
+# Count every command and round-trip against the model function issuing it
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        if len(self.command_stack) > 0:
+            metrics.count_redis_commands(len(self.command_stack))
+        return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    async def execute_command(self, *args, **options):
+        metrics.count_redis_commands(1)
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
 
 
-def list_objects():
-    return redis.smembers("objects")
+pool = BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB,
+    max_connections=REDIS_POOL_SIZE,
+    timeout=REDIS_POOL_TIMEOUT,
+)
+redis = InstrumentedRedis(connection_pool=pool)
+
+
+# Decorates the model coroutines which talk to Redis, timing each by function
+# and counting it as the Redis stage of the request it runs for
+def timed(function):
+    return timing.timed_stage("redis")(metrics.timed_model_call(function))
+
+
+# Metadata writes which touch several keys run as Lua scripts, so each is one
+# round-trip and Redis applies it atomically; a failure part way through
+# cannot leave a key half written.
+#
+# Each bucket's key count and total bytes are kept in a stats hash which
+# the scripts adjust in the same step as the keys themselves.
+#
+# Lua's unpack() is limited to a few thousand values, so long argument lists
+# are passed to commands in batches
+BATCH_FUNCTION = """
+local function call_batched(command, key, values, first, last)
+    for i = first, last, 1000 do
+        redis.call(command, key, unpack(values, i, math.min(i + 999, last)))
+    end
+end
+"""
+
+# KEYS: the bucket's key set, key index and stats, then the six
+# key_metadata_keys of the key, then any keys to delete along with the
+# write. ARGV: key, size, ETag, last-modified time, encoded storage ("" for
+# an uncompressed key), the number of objectIDs, the objectIDs and the key's
+# encoded parts, if it has a parts list. Returns the objectIDs the key had
+# before
+WRITE_KEY_SCRIPT = (
+    BATCH_FUNCTION
+    + """
+local count = tonumber(ARGV[6])
+local previous = redis.call("SMEMBERS", KEYS[4])
+local previous_size = tonumber(redis.call("GET", KEYS[5]) or 0)
+redis.call("DEL", KEYS[4], KEYS[6])
+call_batched("SADD", KEYS[4], ARGV, 7, 6 + count)
+call_batched("RPUSH", KEYS[6], ARGV, 7 + count, #ARGV)
+redis.call("SET", KEYS[5], ARGV[2])
+redis.call("SET", KEYS[7], ARGV[3])
+redis.call("SET", KEYS[8], ARGV[4])
+if ARGV[5] == "" then
+    redis.call("DEL", KEYS[9])
+else
+    redis.call("SET", KEYS[9], ARGV[5])
+end
+if #KEYS > 9 then
+    redis.call("DEL", unpack(KEYS, 10))
+end
+local added = redis.call("SADD", KEYS[1], ARGV[1])
+redis.call("ZADD", KEYS[2], 0, ARGV[1])
+if added == 1 then
+    previous_size = 0
+end
+redis.call("HINCRBY", KEYS[3], "keys", added)
+local growth = tonumber(ARGV[2]) - previous_size
+redis.call("HINCRBY", KEYS[3], "bytes", string.format("%d", growth))
+return previous
+"""
+)
+
+# KEYS: the bucket's key set, key index and stats, then the six
+# key_metadata_keys of each key. ARGV: the keys. Returns how many existed
+DELETE_KEYS_SCRIPT = """
+local removed = 0
+local bytes = 0
+for i = 1, #ARGV do
+    local first = 6 * i - 2
+    if redis.call("SREM", KEYS[1], ARGV[i]) == 1 then
+        removed = removed + 1
+        bytes = bytes + tonumber(redis.call("GET", KEYS[first + 1]) or 0)
+    end
+    redis.call("DEL", unpack(KEYS, first, first + 5))
+end
+redis.call("ZREM", KEYS[2], unpack(ARGV))
+redis.call("HINCRBY", KEYS[3], "keys", -removed)
+redis.call("HINCRBY", KEYS[3], "bytes", string.format("%d", -bytes))
+return removed
+"""
+
+# KEYS: the bucket's key set, the account's bucket set, then the bucket's
+# creation dates and record, key index, stats and compression setting to
+# delete. ARGV: bucket
+DELETE_BUCKET_SCRIPT = """
+if redis.call("SCARD", KEYS[1]) > 0 then
+    return 0
+end
+redis.call("SREM", KEYS[2], ARGV[1])
+redis.call("DEL", unpack(KEYS, 3))
+return 1
+"""
+
+# Deduplicated objects are recorded by the SHA-256 of their bytes, per
+# account, along with the number of keys referring to them.
+#
+# KEYS: the digest's record, then, to register an object, the object's
+# digest key. ARGV: to register, the objectID and its encoded storage. Adds a
+# reference to the object recorded for the digest and returns its objectID
+# and storage. When there is none, the object given is recorded with one
+# reference and nil is returned
+REFERENCE_DIGEST_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("HINCRBY", KEYS[1], "refs", 1)
+    return redis.call("HMGET", KEYS[1], "objectID", "storage")
+end
+if #ARGV > 0 then
+    redis.call("HSET", KEYS[1], "objectID", ARGV[1], "storage", ARGV[2], "refs", 1)
+    redis.call("SET", KEYS[2], KEYS[1])
+end
+return false
+"""
+
+# KEYS: an object's digest key and the digest record it names. Drops a
+# reference to the object, and its record with the last one. Returns 1 when
+# nothing refers to the object any more
+RELEASE_OBJECT_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= KEYS[2] then
+    return 1
+end
+if redis.call("HINCRBY", KEYS[2], "refs", -1) > 0 then
+    return 0
+end
+redis.call("DEL", KEYS[1], KEYS[2])
+return 1
+"""
+
+# Scripts are called by SHA with EVALSHA. A server which does not know a
+# script, after a restart or failover, is sent it again on first use
+write_key_script = redis.register_script(WRITE_KEY_SCRIPT)
+delete_keys_script = redis.register_script(DELETE_KEYS_SCRIPT)
+delete_bucket_script = redis.register_script(DELETE_BUCKET_SCRIPT)
+reference_digest_script = redis.register_script(REFERENCE_DIGEST_SCRIPT)
+release_object_script = redis.register_script(RELEASE_OBJECT_SCRIPT)
+scripts = [
+    write_key_script,
+    delete_keys_script,
+    delete_bucket_script,
+    reference_digest_script,
+    release_object_script,
+]
+
+
+# Load every script at startup, so requests never pay for the fallback. A
+# Redis which is not up yet is sent them on first use instead
+@timed
+async def load_scripts():
+    try:
+        for script in scripts:
+            script.sha = await redis.script_load(script.script)
+    except RedisError as e:
+        timing.log("redis_scripts_not_loaded", error=e)
+
+
+# Ownership, bucket existence and display names change rarely, so each worker
+# keeps them for a short while instead of asking Redis on every request
+METADATA_CACHE_SIZE = int(os.environ.get("SOS_METADATA_CACHE_SIZE") or 10000)
+METADATA_CACHE_TTL = float(os.environ.get("SOS_METADATA_CACHE_TTL") or 30)
+# Negative answers are kept briefly so a bucket created through another
+# worker becomes visible quickly without the invalidation channel
+METADATA_CACHE_NEGATIVE_TTL = float(
+    os.environ.get("SOS_METADATA_CACHE_NEGATIVE_TTL") or 1
+)
+# Invalidations are published here and applied by every worker, so a bucket
+# deleted through one worker stops being used by the others at once. Setting
+# it to an empty value turns this off, for a single worker
+CACHE_INVALIDATION_CHANNEL = os.environ.get(
+    "SOS_CACHE_INVALIDATION_CHANNEL", "sos-cache-invalidation"
+)
+# Seconds to wait before subscribing again after losing the channel
+INVALIDATION_RETRY_SECONDS = 1
+
+metadata_cache = cache.TTLCache("metadata", METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+
+async def close():
+    await pool.disconnect()
+
+
+# Open up to `connections` pooled connections ahead of the first requests,
+# so they do not pay for connecting. A Redis which is not up yet is connected
+# to on first use instead
+async def warm_up(connections: int):
+    opened = []
+    try:
+        for _ in range(min(connections, REDIS_POOL_SIZE)):
+            opened.append(await pool.get_connection())
+    except (RedisError, OSError) as e:
+        timing.log("redis_warm_up_failed", connected=len(opened), error=e)
+    finally:
+        for connection in opened:
+            await pool.release(connection)
 
 
-def get_ticket_count(object_id):
-    return redis.get(f"/objects/{object_id}/ticketCounter")
+# Whether Redis answers a PING within `timeout` seconds
+async def ping(timeout: float = 1) -> bool:
+    try:
+        return await asyncio.wait_for(redis.ping(), timeout)
+    except (RedisError, OSError, asyncio.TimeoutError):
+        return False
 
 
-def get_object_size(object_id):
-    return redis.get(f"/objects/{object_id}/size")
+async def cached(key, load):
+    value = metadata_cache.get(key)
+    if value is not cache.MISSING:
+        return value
+    version = metadata_cache.version
+    value = await load()
+    ttl = METADATA_CACHE_NEGATIVE_TTL if not value else None
+    metadata_cache.set(key, value, version=version, ttl=ttl)
+    return value
+
+
+# Keys of ("object", objectID) drop an object from the object cache; the
+# others are metadata cache keys
+def apply_invalidation(key):
+    if key[0] == "object":
+        object_cache.invalidate(key[1])
+    else:
+        metadata_cache.invalidate(key)
+
+
+async def invalidate(key):
+    apply_invalidation(key)
+    if CACHE_INVALIDATION_CHANNEL:
+        await redis.publish(CACHE_INVALIDATION_CHANNEL, json.dumps(key))
+
+
+# Apply invalidations published by other workers until cancelled.
+# Invalidations published while the worker is not subscribed are lost, so the
+# caches are emptied each time the subscription starts
+async def listen_for_invalidations():
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            metadata_cache.clear()
+            object_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                try:
+                    apply_invalidation(tuple(json.loads(message["data"])))
+                except (IndexError, TypeError, ValueError):
+                    timing.log("cache_invalidation_ignored", message=message["data"])
+        except (RedisError, OSError) as e:
+            timing.log("cache_invalidation_listener_failed", error=e)
+        finally:
+            await pubsub.aclose()
+        metadata_cache.clear()
+        object_cache.clear()
+        await asyncio.sleep(INVALIDATION_RETRY_SECONDS)
+
+
+def start_invalidation_listener():
+    if not CACHE_INVALIDATION_CHANNEL:
+        return None
+    return asyncio.ensure_future(listen_for_invalidations())
+
+
+# One page of the objectIDs data-putter has stored, read with SSCAN from
+# `cursor`. Redis takes `count` as a hint, so a page may hold a few more or
+# fewer ids; pages which come back empty are skipped. Returns the ids and the
+# cursor of the next page, 0 once the listing is complete
+@timed
+async def list_object_page(cursor: int, count: int) -> Tuple[List[str], int]:
+    while True:
+        cursor, object_ids = await redis.sscan("objects", cursor, count=count)
+        if len(object_ids) > 0 or cursor == 0:
+            return [object_id.decode("UTF-8") for object_id in object_ids], cursor
+
+
+@timed
+async def get_ticket_count(object_id):
+    return await redis.get(f"/objects/{object_id}/ticketCounter")
+
+
+@timed
+async def get_object_size(object_id):
+    return await redis.get(f"/objects/{object_id}/size")
 
 
 # Return a list of tickets for an object
-def get_object_tickets(object_id):
-    return redis.smembers(f"objectTickets/{object_id}")
-
-
-def get_object_nodes(object_id):
-    return redis.smembers(f"objectNodes/{object_id}")
+@timed
+async def get_object_tickets(object_id):
+    return await redis.smembers(f"objectTickets/{object_id}")
+
+
+@timed
+async def get_object_nodes(object_id):
+    return await redis.smembers(f"objectNodes/{object_id}")
+
+
+def digest_key(digest: str, account_id):
+    return f"/digests/{account_id}/{digest}"
+
+
+def object_digest_key(object_id: str):
+    return f"/objectDigests/{object_id}"
+
+
+# Refer to the object the account stored with these bytes, given their
+# SHA-256 hex digest. Returns its objectID and encoded storage, or None when
+# there is no such object; `object_id` and `storage`, when given, are then
+# recorded as the object for the digest
+@timed
+async def reference_digest(
+    digest: str, account_id, object_id: Optional[str] = None, storage: str = ""
+) -> Optional[Tuple[bytes, str]]:
+    keys = [digest_key(digest, account_id)]
+    args = []
+    if object_id is not None:
+        keys.append(object_digest_key(object_id))
+        args = [object_id, storage]
+    existing = await reference_digest_script(keys=keys, args=args)
+    if existing is None:
+        return None
+    existing_id, existing_storage = existing
+    return existing_id, existing_storage.decode("UTF-8")
+
+
+# Drop the references keys held to objects being deleted, in two
+# round-trips for the whole batch. Returns the objects no longer referred to,
+# which can be deleted; objects which were never deduplicated have only the
+# one reference and no digest record
+@timed
+async def release_objects(object_ids: List[str]) -> List[str]:
+    if len(object_ids) == 0:
+        return []
+    keys = [object_digest_key(object_id) for object_id in object_ids]
+    records = await redis.mget(keys)
+    shared = [i for i, record in enumerate(records) if record is not None]
+    released = [1] * len(object_ids)
+    if len(shared) > 0:
+        async with redis.pipeline(transaction=False) as pipe:
+            for i in shared:
+                await release_object_script(
+                    keys=[keys[i], records[i].decode("UTF-8")], client=pipe
+                )
+            for i, result in zip(shared, await pipe.execute()):
+                released[i] = result
+    return [object_id for object_id, r in zip(object_ids, released) if r == 1]
+
+
+# Ticket count, nodes, tickets, size and content type of many objects, in
+# one round-trip. Details are returned in the order of `object_ids`; values
+# data-putter has not recorded are None, or empty for nodes and tickets
+@timed
+async def get_object_details(object_ids: List[str]) -> List[Dict]:
+    if len(object_ids) == 0:
+        return []
+    async with redis.pipeline(transaction=False) as pipe:
+        for field in ("ticketCounter", "size", "contentType"):
+            pipe.mget([f"/objects/{object_id}/{field}" for object_id in object_ids])
+        for object_id in object_ids:
+            pipe.smembers(f"objectNodes/{object_id}")
+            pipe.smembers(f"objectTickets/{object_id}")
+        ticket_counts, sizes, content_types, *members = await pipe.execute()
+
+    def decoded(value):
+        return value.decode("UTF-8") if value is not None else None
+
+    return [
+        {
+            "ticket_count": decoded(ticket_count),
+            "nodes": [node.decode("UTF-8") for node in members[2 * i]],
+            "tickets": [ticket.decode("UTF-8") for ticket in members[2 * i + 1]],
+            "size": decoded(size),
+            "content_type": decoded(content_type),
+        }
+        for i, (ticket_count, size, content_type) in enumerate(
+            zip(ticket_counts, sizes, content_types)
+        )
+    ]
 
 
-def set_content_type(object_id, content_type):
-    return redis.set(f"/objects/{object_id}/contentType", content_type)
+@timed
+async def set_content_type(object_id, content_type):
+    return await redis.set(f"/objects/{object_id}/contentType", content_type)
 
 
-def get_content_type(object_id):
-    content_type = redis.get(f"/objects/{object_id}/contentType")
+@timed
+async def get_content_type(object_id):
+    content_type = await redis.get(f"/objects/{object_id}/contentType")
     if content_type is None:
         return "text/plain"
     return content_type.decode("UTF-8")
 
 
 # Add a bucket to the set of buckets owned by ACCOUNT_ID
-def create_bucket(bucket, account_id):
+@timed
+async def create_bucket(bucket, account_id):
     # Every authorized entity can have buckets
     # Authorized entities often are members of groups
     key = f"/accounts/{account_id}/buckets"
-    return redis.sadd(key, bucket)
+    added = await redis.sadd(key, bucket)
+    await invalidate(("bucket", account_id, bucket))
+    return added
 
 
-def set_bucket_creation_date(bucket, account_id):
+@timed
+async def set_bucket_creation_date(bucket, account_id):
     key = f"/buckets/{account_id}/{bucket}/creationDate"
     creation_date = str(datetime.now())
-    print(f"Creation date of {bucket}: {creation_date}")
-    return redis.set(key, creation_date)
+    timing.log_sampled("bucket_created", bucket=bucket, creation_date=creation_date)
+    return await redis.set(key, creation_date)
 
 
-def get_bucket_creation_date(bucket, account_id):
-    key = f"/buckets/{account_id}/{bucket}/creationDate"
-    return redis.get(key).decode("UTF-8")
+def bucket_compression_key(bucket, account_id):
+    return f"/buckets/{account_id}/{bucket}/compression"
 
 
-def list_bucket_names(account_id):
-    key = f"/accounts/{account_id}/buckets"
-    return [v.decode("UTF-8") for v in redis.smembers(key)]
+# The codec new objects in a bucket are compressed with, or None to store
+# them as written
+@timed
+async def get_bucket_compression(bucket, account_id) -> Optional[str]:
+    async def load():
+        codec = await redis.get(bucket_compression_key(bucket, account_id))
+        return codec.decode("UTF-8") if codec is not None else None
 
+    return await cached(("compression", account_id, bucket), load)
 
-def list_buckets(account_id):
-    buckets = []
-    for bucket_name in list_bucket_names(account_id):
-        buckets.append(
-            {
-                "name": bucket_name,
-                "creation_date": get_bucket_creation_date(bucket_name, account_id,),
-            }
-        )
-    return buckets
+
+@timed
+async def set_bucket_compression(bucket, codec: Optional[str], account_id):
+    key = bucket_compression_key(bucket, account_id)
+    if codec is None:
+        await redis.delete(key)
+    else:
+        await redis.set(key, codec)
+    await invalidate(("compression", account_id, bucket))
+
+
+@timed
+async def get_bucket_creation_date(bucket, account_id):
+    key = f"/buckets/{account_id}/{bucket}/creationDate"
+    return (await redis.get(key)).decode("UTF-8")
 
 
-def is_existing_bucket(bucket, account_id):
+@timed
+async def list_bucket_names(account_id):
     key = f"/accounts/{account_id}/buckets"
-    return redis.sismember(key, bucket)
+    return [v.decode("UTF-8") for v in await redis.smembers(key)]
+
+
+@timed
+async def list_buckets(account_id):
+    bucket_names = await list_bucket_names(account_id)
+    if len(bucket_names) == 0:
+        return []
+    creation_dates = await redis.mget(
+        [f"/buckets/{account_id}/{bucket}/creationDate" for bucket in bucket_names]
+    )
+    return [
+        {
+            "name": bucket_name,
+            "creation_date": (creation_date or b"").decode("UTF-8"),
+        }
+        for bucket_name, creation_date in zip(bucket_names, creation_dates)
+    ]
+
 
+@timed
+async def is_existing_bucket(bucket, account_id):
+    key = f"/accounts/{account_id}/buckets"
+    return await cached(
+        ("bucket", account_id, bucket), lambda: redis.sismember(key, bucket)
+    )
 
-def is_existing_key(bucket, key, account_id):
-    if not is_existing_bucket(bucket, account_id):
+
+@timed
+async def is_existing_key(bucket, key, account_id):
+    if not await is_existing_bucket(bucket, account_id):
         return False
     prefix = f"/keys/{account_id}/{bucket}"
-    return redis.sismember(prefix, key)
+    return await redis.sismember(prefix, key)
 
 
-def set_account_display_name(account_id):
+@timed
+async def set_account_display_name(account_id):
     key = f"/accounts/{account_id}/name"
-    return redis.set(key, account_id)
+    result = await redis.set(key, account_id)
+    await invalidate(("name", account_id))
+    return result
 
 
-def get_account_display_name(account_id):
+@timed
+async def get_account_display_name(account_id):
     key = f"/accounts/{account_id}/name"
-    try:
-        return redis.get(key).decode("UTF-8")
-    except AttributeError:
-        set_account_display_name(account_id)
+    display_name = await cached(("name", account_id), lambda: redis.get(key))
+    if display_name is None:
+        await set_account_display_name(account_id)
         return account_id
+    return display_name.decode("UTF-8")
 
 
-def get_bucket_owner(account_id):
+@timed
+async def get_bucket_owner(account_id):
     return {
-        "display_name": get_account_display_name(account_id),
+        "display_name": await get_account_display_name(account_id),
         "id": account_id,
     }
 
 
-def set_key_size(bucket, key, size, account_id):
-    size_key = f"/keys/{account_id}/{bucket}/{key}/size"
-    return redis.set(size_key, size)
-
-
-def get_key_size(bucket, key, account_id):
+@timed
+async def get_key_size(bucket, key, account_id):
     key = f"/keys/{account_id}/{bucket}/{key}/size"
-    return redis.get(key).decode("UTF-8")
+    return (await redis.get(key)).decode("UTF-8")
 
 
-# Add the key to the bucket
-def add_key_to_bucket(bucket, key, account_id):
-    prefix = f"/keys/{account_id}/{bucket}"
-    return redis.sadd(prefix, key)
+# The Redis keys holding a key's metadata: its objectID set followed by
+# KEY_METADATA_FIELDS
+KEY_METADATA_FIELDS = ["size", "parts", "etag", "lastModified", "storage"]
 
 
-# Add objectID to a key
-def add_object_to_key(bucket, key, object_id, account_id):
+def key_metadata_keys(bucket, key, account_id) -> List[str]:
     prefix = f"/keys/{account_id}/{bucket}/{key}"
-    return redis.sadd(prefix, object_id)
+    return [prefix] + [f"{prefix}/{field}" for field in KEY_METADATA_FIELDS]
+
+
+def bucket_stats_key(bucket, account_id):
+    return f"/buckets/{account_id}/{bucket}/stats"
+
+
+# WRITE_KEY_SCRIPT's KEYS and ARGV for pointing a key at `object_ids`
+def write_key_arguments(
+    bucket,
+    key,
+    object_ids: List[str],
+    parts: List[str],
+    size,
+    etag,
+    last_modified,
+    account_id,
+    deleted_keys: List[str] = [],
+    storage: str = "",
+) -> Tuple[List[str], List]:
+    keys = [
+        f"/keys/{account_id}/{bucket}",
+        key_index(bucket, account_id),
+        bucket_stats_key(bucket, account_id),
+    ]
+    keys += key_metadata_keys(bucket, key, account_id) + deleted_keys
+    args = [key, size, etag, last_modified, storage, len(object_ids)]
+    args += object_ids + parts
+    return keys, args
+
+
+# Point a key at a single objectID, dropping any objects and parts it had
+# before, and add it to its bucket. `last_modified` is in seconds since the
+# epoch; `storage` is the encoded codec and stored size of a compressed
+# object. Returns the objectIDs it replaced
+@timed
+async def put_key(
+    bucket, key, object_id, size, etag, last_modified, account_id, storage=""
+) -> List[bytes]:
+    keys, args = write_key_arguments(
+        bucket,
+        key,
+        [object_id],
+        [],
+        size,
+        etag,
+        last_modified,
+        account_id,
+        storage=storage,
+    )
+    return await write_key_script(keys=keys, args=args)
 
 
 # List objectIDs of a key
-def list_objects_of_key(bucket, key, account_id):
+@timed
+async def list_objects_of_key(bucket, key, account_id):
     prefix = f"/keys/{account_id}/{bucket}/{key}"
-    return redis.smembers(prefix)
+    return await redis.smembers(prefix)
 
 
-# List keys in a bucket
-def list_bucket_keys(bucket, account_id):
-    # TODO: Support prefix and delimiter
-    prefix = f"/keys/{account_id}/{bucket}"
-    return [v.decode("UTF-8") for v in redis.smembers(prefix)]
+# Parts are stored as "<size>:<objectID>" so a key's layout is one list read
+def encode_part(object_id: str, size: int) -> str:
+    return f"{size}:{object_id}"
 
 
-# Get the objectID for a bucket's key
-def get_key_object(bucket, key, account_id):
-    prefix = f"/keys/{account_id}/{bucket}/{key}"
+def decode_part(part: bytes) -> Tuple[str, int]:
+    size, _, object_id = part.decode("UTF-8").partition(":")
+    return object_id, int(size)
 
 
-def delete_key_object(object_id, bucket, key, account_id):
+# Everything needed to read a key, in one round-trip: its objectIDs in the
+# order its bytes are read, each with its size, and the key's size, ETag,
+# last-modified time and storage. Keys written by a multipart upload keep an
+# ordered `/parts` list; other keys are a single object whose size is not
+# needed to read it. Keys written before ETags were stored have none. A
+# compressed key has the codec its object was stored with and the object's
+# size; the key's size is always that of the data as written. Returns None
+# when the key does not exist
+@timed
+async def get_key_metadata(bucket, key, account_id) -> Optional[Dict]:
     prefix = f"/keys/{account_id}/{bucket}/{key}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.lrange(f"{prefix}/parts", 0, -1)
+        pipe.smembers(prefix)
+        pipe.mget(
+            f"{prefix}/size",
+            f"{prefix}/etag",
+            f"{prefix}/lastModified",
+            f"{prefix}/storage",
+        )
+        parts, object_ids, metadata = await pipe.execute()
+    size, etag, last_modified, storage = metadata
+    if len(object_ids) == 0:
+        return None
+    if len(parts) > 0:
+        parts = [decode_part(part) for part in parts]
+    elif len(object_ids) == 1:
+        parts = [(next(iter(object_ids)).decode("UTF-8"), int(size or 0))]
+    else:
+        parts = [(object_id.decode("UTF-8"), None) for object_id in object_ids]
+    codec, stored_size = None, None
+    if storage is not None:
+        codec, stored_size = compression.decode_storage(storage)
+    return {
+        "parts": parts,
+        "size": int(size or 0),
+        "etag": etag.decode("UTF-8") if etag is not None else None,
+        "last_modified": float(last_modified) if last_modified is not None else None,
+        "codec": codec,
+        "stored_size": stored_size,
+    }
 
-    return redis.srem(prefix, object_id)
+
+@timed
+async def delete_key(bucket, key, account_id):
+    return await delete_keys(bucket, [key], account_id)
+
+
+# Multipart uploads
+#
+# An upload records the key it was created for and a hash of its parts by
+# part number. Each part is its own data-putter object, so completing an
+# upload only writes the key's ordered part list; no bytes are copied
+def upload_prefix(bucket, upload_id, account_id):
+    return f"/uploads/{account_id}/{bucket}/{upload_id}"
+
+
+@timed
+async def create_upload(bucket, key, account_id) -> str:
+    upload_id = uuid.uuid4().hex
+    await redis.set(upload_prefix(bucket, upload_id, account_id), key)
+    return upload_id
+
+
+@timed
+async def get_upload_key(bucket, upload_id, account_id) -> Optional[str]:
+    key = await redis.get(upload_prefix(bucket, upload_id, account_id))
+    if key is None:
+        return None
+    return key.decode("UTF-8")
+
+
+# Record a part of an upload. Returns the objectID of the part it replaces,
+# if the same part number was uploaded before
+@timed
+async def set_upload_part(
+    bucket, upload_id, part_number, object_id, size, account_id
+) -> Optional[str]:
+    parts = upload_prefix(bucket, upload_id, account_id) + "/parts"
+    async with redis.pipeline() as pipe:
+        pipe.hget(parts, part_number)
+        pipe.hset(parts, part_number, encode_part(object_id, size))
+        previous, _ = await pipe.execute()
+    if previous is None:
+        return None
+    return decode_part(previous)[0]
+
+
+# Parts of an upload by part number
+@timed
+async def list_upload_parts(
+    bucket, upload_id, account_id
+) -> Dict[int, Tuple[str, int]]:
+    parts = upload_prefix(bucket, upload_id, account_id) + "/parts"
+    return {
+        int(part_number): decode_part(part)
+        for part_number, part in (await redis.hgetall(parts)).items()
+    }
 
 
-def delete_key(bucket, key, account_id):
-    prefixes = [
-        f"/keys/{account_id}/{bucket}/{key}/size",
-        f"/keys/{account_id}/{bucket}/{key}",
+@timed
+async def delete_upload(bucket, upload_id, account_id):
+    prefix = upload_prefix(bucket, upload_id, account_id)
+    return await redis.delete(prefix, f"{prefix}/parts")
+
+
+# Point a key at the ordered parts of an upload and close the upload, in one
+# step. Returns the objectIDs the key had before
+@timed
+async def complete_upload(
+    bucket,
+    key,
+    upload_id,
+    parts: List[Tuple[str, int]],
+    etag,
+    last_modified,
+    account_id,
+) -> List[bytes]:
+    upload = upload_prefix(bucket, upload_id, account_id)
+    keys, args = write_key_arguments(
+        bucket,
+        key,
+        [object_id for object_id, _ in parts],
+        [encode_part(object_id, size) for object_id, size in parts],
+        sum(size for _, size in parts),
+        etag,
+        last_modified,
+        account_id,
+        deleted_keys=[upload, f"{upload}/parts"],
+    )
+    return await write_key_script(keys=keys, args=args)
+
+
+# objectIDs of many keys, in one round-trip
+@timed
+async def list_objects_of_keys(bucket, keys, account_id) -> Dict[str, List[bytes]]:
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.smembers(f"/keys/{account_id}/{bucket}/{key}")
+        members = await pipe.execute()
+    return dict(zip(keys, members))
+
+
+# Remove deleted objectIDs from the keys they belonged to, in one round-trip
+@timed
+async def delete_keys_objects(bucket, object_ids: Dict[str, List[str]], account_id):
+    object_ids = {key: ids for key, ids in object_ids.items() if len(ids) > 0}
+    if len(object_ids) == 0:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for key, ids in object_ids.items():
+            pipe.srem(f"/keys/{account_id}/{bucket}/{key}", *ids)
+        await pipe.execute()
+
+
+# Remove keys and their metadata from a bucket, in one round-trip
+@timed
+async def delete_keys(bucket, keys, account_id):
+    if len(keys) == 0:
+        return
+    prefix = f"/keys/{account_id}/{bucket}"
+    key_names = [
+        prefix,
+        key_index(bucket, account_id),
+        bucket_stats_key(bucket, account_id),
     ]
+    for key in keys:
+        key_names += key_metadata_keys(bucket, key, account_id)
+    await delete_keys_script(keys=key_names, args=keys)
 
-    for prefix in prefixes:
-        redis.delete(prefix)
 
-    # Remove key from bucket
+@timed
+async def is_bucket_empty(bucket, account_id):
     prefix = f"/keys/{account_id}/{bucket}"
-    redis.srem(prefix, key)
-    return
+    return await redis.scard(prefix) == 0
 
 
-def is_bucket_empty(bucket, account_id):
-    keys = list_bucket_keys(bucket, account_id)
-    print(f"IsBucketEmpty.keys {len(keys)}", keys)
-    return len(keys) == 0
+# A bucket's key count and total bytes, from its counters
+@timed
+async def get_bucket_stats(bucket, account_id) -> Dict[str, int]:
+    stats_key = bucket_stats_key(bucket, account_id)
+    keys, size = await redis.hmget(stats_key, "keys", "bytes")
+    return {"keys": int(keys or 0), "bytes": int(size or 0)}
 
 
-def delete_bucket(bucket, account_id):
-    bucket_prefix = f"/keys/{account_id}/{bucket}"
-    bucket_set = f"/accounts/{account_id}/buckets"
+# Recount a bucket's keys and bytes from its key set and key sizes, and
+# replace its counters with the result. SSCAN may return a key twice, so
+# counted keys are remembered. Writes made while the scan runs can leave the
+# counters off by those writes, so run it on a quiet bucket
+@timed
+async def recompute_bucket_stats(bucket, account_id) -> Dict[str, int]:
+    prefix = f"/keys/{account_id}/{bucket}"
+    counted = set()
+    size = 0
+    cursor = 0
+    while True:
+        cursor, batch = await redis.sscan(prefix, cursor, count=1000)
+        batch = [key for key in batch if key not in counted]
+        if len(batch) > 0:
+            sizes = await redis.mget(
+                [f"{prefix}/{key.decode('UTF-8')}/size" for key in batch]
+            )
+            counted.update(batch)
+            size += sum(int(key_size or 0) for key_size in sizes)
+        if cursor == 0:
+            break
+    stats = {"keys": len(counted), "bytes": size}
+    await redis.hset(bucket_stats_key(bucket, account_id), mapping=stats)
+    return stats
+
+
+# Delete a bucket unless it still has keys. Returns whether it was deleted
+@timed
+async def delete_bucket(bucket, account_id):
     account_bucket = f"/accounts/{account_id}/buckets/{bucket}"
-    redis.srem(bucket_set, bucket)
-    redis.delete(account_bucket + "/creationDate")
-    redis.delete(account_bucket)
-    return True
+    deleted = await delete_bucket_script(
+        keys=[
+            f"/keys/{account_id}/{bucket}",
+            f"/accounts/{account_id}/buckets",
+            account_bucket + "/creationDate",
+            account_bucket,
+            f"/buckets/{account_id}/{bucket}/creationDate",
+            key_index(bucket, account_id),
+            bucket_stats_key(bucket, account_id),
+            bucket_compression_key(bucket, account_id),
+        ],
+        args=[bucket],
+    )
+    await invalidate(("bucket", account_id, bucket))
+    await invalidate(("compression", account_id, bucket))
+    return deleted == 1
+
+
+# Keys of a bucket in lexicographic order. Every member has score 0 so
+# ZRANGEBYLEX can page through them
+def key_index(bucket, account_id):
+    return f"/keyIndex/{account_id}/{bucket}"
+
+
+# Rebuild a bucket's key index from its key set, for buckets written before
+# the index existed
+@timed
+async def rebuild_key_index(bucket, account_id):
+    index = key_index(bucket, account_id)
+    keys = await redis.smembers(f"/keys/{account_id}/{bucket}")
+    async with redis.pipeline() as pipe:
+        pipe.delete(index)
+        if len(keys) > 0:
+            pipe.zadd(index, {key: 0 for key in keys})
+        await pipe.execute()
+    return len(keys)
+
+
+# No UTF-8 encoded key contains this byte, so it sorts after every key
+# sharing a prefix
+LEX_MAX_BYTE = b"\xff"
+
+
+class InvalidContinuationToken(Exception):
+    pass
+
+
+def encode_continuation_token(lower_bound: bytes) -> str:
+    return base64.urlsafe_b64encode(lower_bound).decode("ascii")
+
+
+def decode_continuation_token(token: str) -> bytes:
+    try:
+        lower_bound = base64.urlsafe_b64decode(token.encode("ascii"))
+    except (binascii.Error, UnicodeEncodeError):
+        raise InvalidContinuationToken(token)
+    if lower_bound[:1] not in (b"(", b"["):
+        raise InvalidContinuationToken(token)
+    return lower_bound
+
+
+# Page through a bucket's keys in order, starting after `lower_bound`.
+#
+# Keys containing `delimiter` after `prefix` are rolled up into common
+# prefixes, each counting once towards `max_keys`. Returns the page's keys,
+# its common prefixes and the lower bound to resume from, which is None once
+# the listing is complete. A page costs O(max_keys), not O(bucket size).
+# A page of no keys is empty and complete, as there is nothing to resume
+@timed
+async def list_key_page(
+    bucket, account_id, prefix="", lower_bound=None, max_keys=1000, delimiter=None
+):
+    if max_keys == 0:
+        return [], [], None
+    index = key_index(bucket, account_id)
+    prefix_bytes = prefix.encode("UTF-8")
+    upper_bound = b"[" + prefix_bytes + LEX_MAX_BYTE if prefix else b"+"
+    if lower_bound is None or lower_bound[1:] < prefix_bytes:
+        lower_bound = b"[" + prefix_bytes if prefix else b"-"
+
+    keys = []
+    common_prefixes = []
+    while True:
+        remaining = max_keys - len(keys) - len(common_prefixes)
+        # One key more than the page holds tells whether the listing goes on
+        batch = await redis.zrangebylex(
+            index, lower_bound, upper_bound, start=0, num=remaining + 1
+        )
+        if remaining == 0 or len(batch) == 0:
+            is_truncated = len(batch) > 0
+            break
+
+        rolled_up = False
+        for member in batch[:remaining]:
+            key = member.decode("UTF-8")
+            if delimiter:
+                position = key.find(delimiter, len(prefix))
+                if position != -1:
+                    common_prefix = key[: position + len(delimiter)]
+                    common_prefixes.append(common_prefix)
+                    # Skip every other key under the common prefix
+                    common_prefix_bytes = common_prefix.encode("UTF-8")
+                    lower_bound = b"(" + common_prefix_bytes + LEX_MAX_BYTE
+                    rolled_up = True
+                    break
+            keys.append(key)
+            lower_bound = b"(" + member
+        if not rolled_up:
+            is_truncated = len(batch) > remaining
+            break
+
+    return keys, common_prefixes, lower_bound if is_truncated else None
 
 
 # ListObjectsv2
-def get_bucket(bucket, account_id) -> List:
-    bucket_keys = []
-    display_name = get_account_display_name(account_id)
+#
+# Costs one round-trip per page of keys (plus one per common prefix when a
+# delimiter is used) and one pipeline for the display name and key metadata
+@timed
+async def get_bucket(
+    bucket,
+    account_id,
+    prefix="",
+    start_after=None,
+    continuation_token=None,
+    max_keys=1000,
+    delimiter=None,
+) -> Dict:
+    lower_bound = None
+    if continuation_token:
+        lower_bound = decode_continuation_token(continuation_token)
+    elif start_after:
+        lower_bound = b"(" + start_after.encode("UTF-8")
+
+    keys, common_prefixes, next_lower_bound = await list_key_page(
+        bucket, account_id, prefix or "", lower_bound, max_keys, delimiter
+    )
 
-    for key in list_bucket_keys(bucket, account_id):
-        bucket_keys.append(
+    prefix = f"/keys/{account_id}/{bucket}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.get(f"/accounts/{account_id}/name")
+        if len(keys) > 0:
+            for field in ("size", "etag", "lastModified"):
+                pipe.mget([f"{prefix}/{key}/{field}" for key in keys])
+        display_name, *fields = await pipe.execute()
+
+    if display_name is None:
+        await set_account_display_name(account_id)
+        display_name = account_id
+    else:
+        display_name = display_name.decode("UTF-8")
+    sizes, etags, last_modifieds = fields if fields else ([], [], [])
+
+    return {
+        "objects": [
             {
                 "display_name": display_name,
                 "id": account_id,
-                "size": get_key_size(bucket, key, account_id),
+                "size": (size or b"0").decode("UTF-8"),
                 "key": key,
+                "etag": etag.decode("UTF-8") if etag is not None else None,
+                "last_modified": float(last_modified)
+                if last_modified is not None
+                else None,
             }
-        )
-    return bucket_keys
+            for key, size, etag, last_modified in zip(
+                keys, sizes, etags, last_modifieds
+            )
+        ],
+        "common_prefixes": common_prefixes,
+        "is_truncated": next_lower_bound is not None,
+        "next_continuation_token": encode_continuation_token(next_lower_bound)
+        if next_lower_bound is not None
+        else None,
+    }
 
 
-def is_bucket_owner(bucket, account_id):
-    key = f"/accounts/{account_id}/buckets"
-    return redis.sismember(key, bucket) == 1
+# Buckets belong to the account whose set they are in, so ownership and
+# existence share a cache entry
+@timed
+async def is_bucket_owner(bucket, account_id):
+    return await is_existing_bucket(bucket, account_id) == 1
 
 
 # Capability checks
-def can_write_bucket(bucket, acount_id):
-    return is_bucket_owner(bucket, account_id)
+@timed
+async def can_write_bucket(bucket, account_id):
+    return await is_bucket_owner(bucket, account_id)
 
 
-def can_read_bucket(bucket, account_id):
-    return is_bucket_owner(bucket, account_id)
+@timed
+async def can_read_bucket(bucket, account_id):
+    return await is_bucket_owner(bucket, account_id)
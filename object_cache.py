@@ -0,0 +1,292 @@
+# A read-through cache of object bytes, keyed by object id.
+#
+# Objects are immutable once data-putter has assigned their id, so a cached
+# copy stays valid until the object is deleted. Small objects are kept in a
+# memory LRU; with SOS_OBJECT_CACHE_DIR set, objects up to a larger limit are
+# also written to local disk and read back through mmap. Both tiers are
+# bounded in bytes and per worker; each worker keeps its disk tier in its own
+# subdirectory, named by its pid.
+import asyncio
+import collections
+import mmap
+import os
+import shutil
+from typing import Iterator, List, Optional
+
+import metrics
+import timing
+
+# Bytes of objects held in memory; 0 disables the memory tier
+MEMORY_SIZE = int(os.environ.get("SOS_OBJECT_CACHE_SIZE") or 64 * 1024 * 1024)
+# Largest object admitted to the memory tier
+MEMORY_MAX_OBJECT_SIZE = int(
+    os.environ.get("SOS_OBJECT_CACHE_MAX_OBJECT_SIZE") or 1024 * 1024
+)
+# Directory of the disk tier; unset disables it
+DISK_DIRECTORY = os.environ.get("SOS_OBJECT_CACHE_DIR")
+# Bytes of objects held on disk
+DISK_SIZE = int(os.environ.get("SOS_OBJECT_CACHE_DISK_SIZE") or 1024 * 1024 * 1024)
+# Largest object admitted to the disk tier
+DISK_MAX_OBJECT_SIZE = int(
+    os.environ.get("SOS_OBJECT_CACHE_DISK_MAX_OBJECT_SIZE") or 64 * 1024 * 1024
+)
+# Bytes per chunk when serving a cached object
+CHUNK_SIZE = 256 * 1024
+
+CACHE_FILE_SUFFIX = ".object"
+
+
+class MemoryTier:
+    name = "memory"
+
+    def __init__(self, capacity: int, max_object_size: int):
+        self.capacity = capacity
+        self.max_object_size = min(max_object_size, capacity)
+        self.size = 0
+        self._objects = collections.OrderedDict()
+
+    def admits(self, size: int) -> bool:
+        return size <= self.max_object_size
+
+    def get(self, object_id: str) -> Optional[bytes]:
+        data = self._objects.get(object_id)
+        if data is not None:
+            self._objects.move_to_end(object_id)
+        return data
+
+    def put(self, object_id: str, data: bytes):
+        self.invalidate(object_id)
+        self._objects[object_id] = data
+        self.size += len(data)
+        while self.size > self.capacity:
+            _, evicted = self._objects.popitem(last=False)
+            self.size -= len(evicted)
+            metrics.object_cache_evictions_total.inc(self.name)
+        metrics.object_cache_bytes.set(self.name, value=self.size)
+
+    def invalidate(self, object_id: str):
+        data = self._objects.pop(object_id, None)
+        if data is not None:
+            self.size -= len(data)
+            metrics.object_cache_bytes.set(self.name, value=self.size)
+
+    def clear(self):
+        self._objects.clear()
+        self.size = 0
+        metrics.object_cache_bytes.set(self.name, value=self.size)
+
+
+# Objects stored as files named by object id. Files are written to a
+# temporary name and renamed, so readers never see a partial object; an
+# evicted file stays readable through any mmap already open on it
+class DiskTier:
+    name = "disk"
+
+    def __init__(self, directory: str, capacity: int, max_object_size: int):
+        self.directory = directory
+        self.capacity = capacity
+        self.max_object_size = min(max_object_size, capacity)
+        self.size = 0
+        self._objects = collections.OrderedDict()
+        # Objects being written, dropped if invalidated before the write ends
+        self._writing = set()
+        os.makedirs(directory, exist_ok=True)
+        # Files left by an earlier worker with this pid may belong to objects
+        # deleted since
+        for name in os.listdir(directory):
+            if name.endswith(CACHE_FILE_SUFFIX):
+                os.unlink(os.path.join(directory, name))
+
+    # An empty file cannot be mapped, so empty objects stay in memory only
+    def admits(self, size: int) -> bool:
+        return 0 < size <= self.max_object_size
+
+    def path(self, object_id: str) -> str:
+        name = object_id.encode().hex() + CACHE_FILE_SUFFIX
+        return os.path.join(self.directory, name)
+
+    # An mmap of the object, which the caller closes
+    def get(self, object_id: str) -> Optional[mmap.mmap]:
+        if object_id not in self._objects:
+            return None
+        try:
+            with open(self.path(object_id), "rb") as infile:
+                view = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._forget(object_id)
+            return None
+        self._objects.move_to_end(object_id)
+        return view
+
+    def _write(self, object_id: str, data: bytes):
+        path = self.path(object_id)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as outfile:
+            outfile.write(data)
+        os.replace(temporary, path)
+
+    async def put(self, object_id: str, data: bytes):
+        loop = asyncio.get_running_loop()
+        self._writing.add(object_id)
+        try:
+            await loop.run_in_executor(None, self._write, object_id, data)
+        except OSError as e:
+            timing.log("object_cache_write_failed", object_id=object_id, error=e)
+            self._writing.discard(object_id)
+            return
+        if object_id not in self._writing:
+            # Deleted while it was being written
+            self._unlink(object_id)
+            return
+        self._writing.discard(object_id)
+        self._forget(object_id)
+        self._objects[object_id] = len(data)
+        self.size += len(data)
+        while self.size > self.capacity:
+            evicted, _ = next(iter(self._objects.items()))
+            self.invalidate(evicted)
+            metrics.object_cache_evictions_total.inc(self.name)
+        metrics.object_cache_bytes.set(self.name, value=self.size)
+
+    def _forget(self, object_id: str):
+        size = self._objects.pop(object_id, None)
+        if size is not None:
+            self.size -= size
+            metrics.object_cache_bytes.set(self.name, value=self.size)
+
+    def _unlink(self, object_id: str):
+        try:
+            os.unlink(self.path(object_id))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, object_id: str):
+        self._writing.discard(object_id)
+        if object_id in self._objects:
+            self._forget(object_id)
+            self._unlink(object_id)
+
+    def clear(self):
+        for object_id in list(self._writing) + list(self._objects):
+            self.invalidate(object_id)
+
+
+# The disk tier directory of this worker. Workers share SOS_OBJECT_CACHE_DIR,
+# so each uses a subdirectory named by its pid, and the directories of workers
+# which are no longer running are removed
+def worker_directory(directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.isdigit() and not _running(int(name)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return os.path.join(directory, str(os.getpid()))
+
+
+def _running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+memory = MemoryTier(MEMORY_SIZE, MEMORY_MAX_OBJECT_SIZE) if MEMORY_SIZE > 0 else None
+disk = None
+if DISK_DIRECTORY:
+    disk = DiskTier(worker_directory(DISK_DIRECTORY), DISK_SIZE, DISK_MAX_OBJECT_SIZE)
+tiers = [tier for tier in (memory, disk) if tier is not None]
+
+# Disk writes still running, kept so they are not collected before finishing
+_writes = set()
+
+
+def _chunks(data) -> Iterator[bytes]:
+    if len(data) <= CHUNK_SIZE:
+        yield bytes(data)
+        return
+    for offset in range(0, len(data), CHUNK_SIZE):
+        yield data[offset : offset + CHUNK_SIZE]
+
+
+def _mapped_chunks(view: mmap.mmap) -> Iterator[bytes]:
+    try:
+        yield from _chunks(view)
+    finally:
+        view.close()
+
+
+# The cached chunks of an object, or None when it has to be read from
+# data-putter. A disk hit of a small object is promoted to memory
+def lookup(object_id: str) -> Optional[Iterator[bytes]]:
+    if len(tiers) == 0:
+        return None
+    if memory is not None:
+        data = memory.get(object_id)
+        if data is not None:
+            metrics.object_cache_hits_total.inc(memory.name)
+            return _chunks(data)
+    if disk is not None:
+        view = disk.get(object_id)
+        if view is not None:
+            metrics.object_cache_hits_total.inc(disk.name)
+            if memory is not None and memory.admits(len(view)):
+                data = view[:]
+                view.close()
+                memory.put(object_id, data)
+                return _chunks(data)
+            return _mapped_chunks(view)
+    metrics.object_cache_misses_total.inc()
+    return None
+
+
+# Gathers an object's chunks as it is read from data-putter and caches it
+# once it has been read completely. Only objects of a known, non-zero `size`
+# are gathered, and only if exactly that many bytes were read, so an unknown
+# object or one the object server cut short is never cached. Objects too
+# large for every tier are not gathered at all
+class Collector:
+    def __init__(self, object_id: str, size: Optional[int]):
+        self.object_id = object_id
+        self.expected_size = size
+        self.limit = max((tier.max_object_size for tier in tiers), default=0)
+        self.size = 0
+        self.chunks: Optional[List[bytes]] = None
+        if size is not None and 0 < size <= self.limit:
+            self.chunks = []
+        elif size is not None and self.limit > 0 and size > self.limit:
+            metrics.object_cache_rejections_total.inc()
+
+    def add(self, chunk: bytes):
+        if self.chunks is None:
+            return
+        self.size += len(chunk)
+        if self.size > self.expected_size:
+            self.chunks = None
+        else:
+            self.chunks.append(chunk)
+
+    def complete(self):
+        if self.chunks is None or self.size != self.expected_size:
+            return
+        data = b"".join(self.chunks)
+        self.chunks = None
+        if memory is not None and memory.admits(len(data)):
+            memory.put(self.object_id, data)
+        # The disk tier also holds small objects, so they survive memory
+        # evictions
+        if disk is not None and disk.admits(len(data)):
+            write = asyncio.ensure_future(disk.put(self.object_id, data))
+            _writes.add(write)
+            write.add_done_callback(_writes.discard)
+
+
+def invalidate(object_id: str):
+    for tier in tiers:
+        tier.invalidate(object_id)
+
+
+def clear():
+    for tier in tiers:
+        tier.clear()
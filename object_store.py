@@ -1,57 +1,883 @@
-import socket
+import asyncio
+import collections
+import contextlib
 import os
-from typing import List
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple, Union
+
+import compression
+import metrics
+import model
+import object_cache
+import timing
 
 OBJECT_ID_SIZE = 8
-SOS_DATAPUTTER_ROUTER = (
-    os.environ.get("SOS_DATAPUTTER_ROUTER_HOST") or "localhost",
+CONTENT_LENGTH_HEADER_SIZE = 8
+
+
+# Endpoints written as comma separated host[:port]
+def parse_endpoints(value: str, default_port: int) -> List[Tuple[str, int]]:
+    endpoints = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, separator, port = item.rpartition(":")
+        if not separator:
+            host, port = item, default_port
+        endpoints.append((host, int(port)))
+    return endpoints
+
+
+# data-putter routers, which take uploads and deletes
+SOS_DATAPUTTER_ROUTERS = parse_endpoints(
+    os.environ.get("SOS_DATAPUTTER_ROUTERS")
+    or os.environ.get("SOS_DATAPUTTER_ROUTER_HOST")
+    or "localhost",
     5001,
 )
-CONTENT_LENGTH_HEADER_SIZE = 8
+# SimpleObjectStore servers, which stream objects back
+SOS_OBJECT_SERVERS = parse_endpoints(
+    os.environ.get("SOS_OBJECT_SERVERS") or "127.0.0.1:5004", 5004
+)
 
-# SimpleObjectStore server
-SOS_OBJECT_SERVER = (
-    "127.0.0.1",
-    5004
+
+# Storage nodes written as comma separated node=host[:port]
+def parse_node_endpoints(value: str) -> Dict[str, Tuple[str, int]]:
+    nodes = {}
+    for item in value.split(","):
+        node, separator, endpoint = item.strip().partition("=")
+        if separator:
+            nodes[node] = parse_endpoints(endpoint, 5004)[0]
+    return nodes
+
+
+# Object servers of the storage nodes named in objectNodes. Nodes missing
+# here are not read from directly
+SOS_NODE_OBJECT_SERVERS = parse_node_endpoints(
+    os.environ.get("SOS_NODE_OBJECT_SERVERS") or ""
 )
+# Read objects from the storage nodes holding them, as recorded in
+# objectNodes, at the cost of a Redis lookup per uncached read; 0 reads
+# through SOS_OBJECT_SERVERS only
+REPLICA_READS = int(os.environ.get("SOS_REPLICA_READS") or 0)
+
+# Further endpoints a failed stream or delete is tried on
+RETRIES = int(os.environ.get("SOS_DATAPUTTER_RETRIES") or 1)
+# Consecutive failed requests after which an endpoint is taken out of rotation
+EJECTION_FAILURES = int(os.environ.get("SOS_EJECTION_FAILURES") or 3)
+# Seconds an endpoint stays out of rotation, growing with repeated ejections
+EJECTION_SECONDS = float(os.environ.get("SOS_EJECTION_SECONDS") or 10)
+MAX_EJECTION_SECONDS = 300
+# Weight of the newest sample in an endpoint's moving average latency
+LATENCY_SMOOTHING = 0.2
+# A read whose first byte has not arrived within this percentile of recent
+# first-byte times is sent to a second endpoint too; 0 disables hedging
+HEDGE_PERCENTILE = float(os.environ.get("SOS_HEDGE_PERCENTILE") or 0.95)
+# Shortest wait before a read is hedged
+HEDGE_MIN_DELAY = float(os.environ.get("SOS_HEDGE_MIN_DELAY") or 0.005)
+# Wait before a read is hedged until enough first-byte times are known
+HEDGE_INITIAL_DELAY = 0.05
+# First-byte times the hedging percentile is taken over
+LATENCY_WINDOW = 512
+# Seconds between connection checks of every endpoint; 0 disables them
+HEALTH_CHECK_INTERVAL = float(os.environ.get("SOS_HEALTH_CHECK_INTERVAL") or 5)
+# Seconds to wait for a TCP connection to a data-putter endpoint
+CONNECT_TIMEOUT = float(os.environ.get("SOS_CONNECT_TIMEOUT") or 5)
+# Seconds a data-putter endpoint may send nothing before a read fails
+READ_TIMEOUT = float(os.environ.get("SOS_READ_TIMEOUT") or 30)
+# Maximum open connections per data-putter endpoint
+POOL_SIZE = int(os.environ.get("SOS_POOL_SIZE") or 32)
+# Keep router connections open between uploads and deletes. Only for routers
+# known to serve several requests per connection; a connection the router has
+# closed while idle fails the next request, and an upload failing once its
+# body has been read cannot be retried
+REUSE_CONNECTIONS = int(os.environ.get("SOS_DATAPUTTER_REUSE_CONNECTIONS") or 0)
+# Bytes handed on per chunk while streaming an object. Reads from the object
+# server fill pooled buffers of this size, so larger chunks mean fewer
+# iterations and ASGI sends per object (64 KB to 1 MB is sensible)
+STREAM_CHUNK_SIZE = int(os.environ.get("SOS_STREAM_CHUNK_SIZE") or 256 * 1024)
+# Reads are coalesced into full chunks. A partly filled buffer is handed on
+# once no more data has arrived for this many seconds, or the object ends
+STREAM_FLUSH_DELAY = 0.002
+# Full chunks buffered per stream before reading from the socket pauses
+STREAM_MAX_QUEUED_CHUNKS = 2
+# Receive buffers kept for reuse between streams
+STREAM_FREE_BUFFERS = 64
+# Bytes buffered in a data-putter socket before a writer waits for it to drain
+WRITE_BUFFER_HIGH_WATER = 256 * 1024
+
+
+class DataPutterError(Exception):
+    pass
+
+
+# The body of an upload was shorter or longer than the length declared for
+# it, which is the client's error rather than data-putter's
+class BodyLengthError(DataPutterError):
+    pass
+
+
+# An endpoint could not be reached or stopped answering part way through a
+# request, so the request may succeed on another
+class EndpointError(DataPutterError):
+    pass
+
+
+# One data-putter router or object server, as seen by this worker
+class Endpoint:
+    def __init__(self, address: Tuple[str, int]):
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        # Requests sent and not yet answered
+        self.outstanding = 0
+        # Consecutive failed requests
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Result of the last connection check
+        self.healthy = True
+        # Moving average of seconds to the first byte of a reply, None until
+        # a reply has been timed
+        self.latency: Optional[float] = None
+
+    def available(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+    def observe_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    # Count a request against the endpoint while the block runs, and its
+    # outcome once it ends
+    @contextlib.contextmanager
+    def request(self):
+        self.outstanding += 1
+        try:
+            yield
+        except EndpointError:
+            self.failed()
+            raise
+        else:
+            self.succeeded()
+        finally:
+            self.outstanding -= 1
+
+    def failed(self):
+        self.failures += 1
+        if self.failures < EJECTION_FAILURES:
+            return
+        self.failures = 0
+        self.ejections += 1
+        ejection = EJECTION_SECONDS * 2 ** (self.ejections - 1)
+        self.ejected_until = time.monotonic() + min(ejection, MAX_EJECTION_SECONDS)
+        metrics.dataputter_ejections_total.inc(self.name)
+        metrics.dataputter_endpoint_up.set(self.name, value=0)
+        timing.log("dataputter_endpoint_ejected", endpoint=self.name)
+
+    def succeeded(self):
+        self.failures = 0
+        self.ejections = 0
+
+
+# Spreads requests over a set of equivalent endpoints.
+#
+# Each request goes to the less busy of two endpoints picked at random
+# ("power of two choices"), which avoids both herding onto one endpoint and
+# keeping shared counts. Endpoints failing EJECTION_FAILURES requests in a
+# row, or a connection check, are left out until they recover; if every
+# endpoint is out, all of them are tried rather than failing outright.
+class EndpointSet:
+    def __init__(self, addresses: Sequence[Tuple[str, int]]):
+        self.endpoints = [Endpoint(address) for address in addresses]
+        for endpoint in self.endpoints:
+            metrics.dataputter_endpoint_up.set(endpoint.name, value=1)
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    # The endpoint at `address`, added to the set if it is not one already
+    def add(self, address: Tuple[str, int]) -> Endpoint:
+        for endpoint in self.endpoints:
+            if endpoint.address == address:
+                return endpoint
+        endpoint = Endpoint(address)
+        self.endpoints.append(endpoint)
+        metrics.dataputter_endpoint_up.set(endpoint.name, value=1)
+        return endpoint
+
+    def choose(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude]
+        available = [e for e in candidates if e.available(now)]
+        candidates = available or candidates or self.endpoints
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.outstanding <= second.outstanding else second
+
+    # Whether a request which failed on the `tried` endpoints may be sent to
+    # another one
+    def can_retry(self, tried: Sequence[Endpoint]) -> bool:
+        return len(tried) <= RETRIES and len(tried) < len(self.endpoints)
 
-# Stream 1500-bytes at a time of an object
-# from data-putter to here
-async def stream(object_id):
-    s = socket.socket(
-        socket.AF_INET,
-        socket.SOCK_STREAM,
-    )
+    # Try to connect to every endpoint, taking those which refuse out of
+    # rotation and returning those which answer
+    async def check(self):
+        async def check_endpoint(endpoint: Endpoint):
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*endpoint.address), CONNECT_TIMEOUT
+                )
+                writer.close()
+                endpoint.healthy = True
+            except (OSError, asyncio.TimeoutError):
+                if endpoint.healthy:
+                    timing.log("dataputter_endpoint_unhealthy", endpoint=endpoint.name)
+                endpoint.healthy = False
+            up = endpoint.available(time.monotonic())
+            metrics.dataputter_endpoint_up.set(endpoint.name, value=int(up))
 
-    s.connect(SOS_OBJECT_SERVER)
-    s.send(object_id.encode())
+        await asyncio.gather(*[check_endpoint(e) for e in self.endpoints])
 
+
+routers = EndpointSet(SOS_DATAPUTTER_ROUTERS)
+object_servers = EndpointSet(SOS_OBJECT_SERVERS)
+# Object servers of storage nodes, added as objectNodes names them
+replicas = EndpointSet([])
+
+
+# The most recent first-byte times of reads, for the hedging delay
+class LatencyWindow:
+    def __init__(self, size: int):
+        self._samples = collections.deque(maxlen=size)
+        self._percentiles: Dict[float, float] = {}
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+        # Percentiles are recomputed every so often rather than per read
+        if len(self._samples) % 32 == 0:
+            self._percentiles.clear()
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        if len(self._samples) < 32:
+            return None
+        value = self._percentiles.get(fraction)
+        if value is None:
+            ordered = sorted(self._samples)
+            index = min(int(fraction * len(ordered)), len(ordered) - 1)
+            value = self._percentiles[fraction] = ordered[index]
+        return value
+
+
+first_byte_times = LatencyWindow(LATENCY_WINDOW)
+
+
+def hedge_delay() -> float:
+    delay = first_byte_times.percentile(HEDGE_PERCENTILE)
+    if delay is None:
+        return HEDGE_INITIAL_DELAY
+    return max(delay, HEDGE_MIN_DELAY)
+
+
+# A bounded pool of connections to one data-putter endpoint.
+#
+# At most `size` connections are open at once; callers beyond that wait for
+# a slot. With REUSE_CONNECTIONS, connections which finish a request cleanly
+# (fixed-length replies) are kept idle and reused by the next caller;
+# otherwise each request has its own connection.
+class ConnectionPool:
+    def __init__(self, endpoint: Tuple[str, int], size: int = POOL_SIZE):
+        self.endpoint = endpoint
+        self.size = size
+        self._idle = collections.deque()
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self, connect):
+        endpoint = f"{self.endpoint[0]}:{self.endpoint[1]}"
+        try:
+            with metrics.dataputter_connect_seconds.time(endpoint):
+                return await asyncio.wait_for(connect(), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise EndpointError(f"Unable to connect to {endpoint}: {e!r}")
+
+    async def _open(self):
+        return await self._connect(lambda: asyncio.open_connection(*self.endpoint))
+
+    # Open a connection driven by a protocol instead of streams. It counts
+    # against the pool's size while the block holding `slot()` runs
+    @timing.timed_stage("dataputter")
+    async def open_protocol(self, factory):
+        loop = asyncio.get_running_loop()
+        return await self._connect(
+            lambda: loop.create_connection(factory, *self.endpoint)
+        )
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        with timing.stage("dataputter"):
+            await self._slots.acquire()
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    @timing.timed_stage("dataputter")
+    async def acquire(self):
+        await self._slots.acquire()
+        try:
+            while self._idle:
+                reader, writer = self._idle.pop()
+                if reader.at_eof() or writer.is_closing():
+                    writer.close()
+                    continue
+                return reader, writer
+            return await self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, reusable: bool = False):
+        reader, writer = conn
+        if (
+            REUSE_CONNECTIONS
+            and reusable
+            and not reader.at_eof()
+            and not writer.is_closing()
+        ):
+            self._idle.append(conn)
+        else:
+            writer.close()
+        self._slots.release()
+
+    # Borrow a connection for the duration of the block. The connection is
+    # returned to the pool only when the caller marks it reusable
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        lease = {"reusable": False}
+        try:
+            yield conn, lease
+        finally:
+            self.release(conn, lease["reusable"])
+
+    # Open idle connections until there are `count`, or the pool is full
+    async def warm_up(self, count: int):
+        missing = min(count, self.size) - len(self._idle)
+        opened = await asyncio.gather(
+            *[self._open() for _ in range(missing)], return_exceptions=True
+        )
+        failures = []
+        for conn in opened:
+            if isinstance(conn, BaseException):
+                failures.append(conn)
+            else:
+                self._idle.append(conn)
+        if failures:
+            raise failures[0]
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+_pools = {}
+
+
+def get_pool(endpoint: Tuple[str, int]) -> ConnectionPool:
+    pool = _pools.get(endpoint)
+    if pool is None:
+        pool = _pools[endpoint] = ConnectionPool(endpoint)
+    return pool
+
+
+async def close_pools():
+    for pool in _pools.values():
+        await pool.close()
+
+
+# Connect to the data-putter routers ahead of the first uploads, when their
+# connections are reused. Object server connections never are, so there is
+# nothing to open in advance for them
+async def warm_up(connections: int):
+    if not REUSE_CONNECTIONS:
+        return
+    for endpoint in routers.endpoints:
+        try:
+            await get_pool(endpoint.address).warm_up(connections)
+        except DataPutterError as e:
+            timing.log("dataputter_warm_up_failed", error=e)
+
+
+# Check every endpoint each HEALTH_CHECK_INTERVAL seconds until cancelled
+async def check_endpoints():
     while True:
-        chunk = s.recv(1500)
-        if len(chunk) == 0:
-            break
-        yield chunk
-    
-    s.close()
-
-async def put(data: List[bytes], content_length: int):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(SOS_DATAPUTTER_ROUTER)
-        s.send(content_length.to_bytes(CONTENT_LENGTH_HEADER_SIZE, "big"),)
-        s.send(data)
-
-        object_id = s.recv(OBJECT_ID_SIZE)
+        await asyncio.gather(
+            routers.check(), object_servers.check(), replicas.check()
+        )
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def start_health_checks():
+    if HEALTH_CHECK_INTERVAL <= 0:
+        return None
+    return asyncio.ensure_future(check_endpoints())
+
+
+async def _read_exactly(reader, size: int) -> bytes:
+    try:
+        return await asyncio.wait_for(reader.readexactly(size), READ_TIMEOUT)
+    except asyncio.IncompleteReadError as e:
+        raise EndpointError(
+            f"Connection closed after {len(e.partial)} of {size} bytes"
+        )
+    except asyncio.TimeoutError:
+        raise EndpointError(f"Timed out reading {size} bytes")
+    except OSError as e:
+        raise EndpointError(f"Connection lost reading {size} bytes: {e!r}")
+
+
+async def _drain(writer):
+    try:
+        await writer.drain()
+    except OSError as e:
+        raise EndpointError(f"Connection lost while sending: {e!r}")
+
+
+# Time a data-putter operation and count it as failed if it raises
+@contextlib.contextmanager
+def _measured(operation: str):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.dataputter_errors_total.inc(operation)
+        raise
+    finally:
+        metrics.dataputter_request_seconds.observe(
+            time.perf_counter() - started, operation
+        )
+
+
+# Fixed-size receive buffers shared by every stream
+class BufferPool:
+    def __init__(self, buffer_size: int, max_free: int):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self._free = []
+
+    def acquire(self) -> bytearray:
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        if len(self._free) < self.max_free and len(buffer) == self.buffer_size:
+            self._free.append(buffer)
+
+
+stream_buffers = BufferPool(STREAM_CHUNK_SIZE, STREAM_FREE_BUFFERS)
+
+
+# Receives an object straight into a pooled buffer (recv_into, no per-read
+# allocation) and hands it on in chunks of up to STREAM_CHUNK_SIZE bytes.
+#
+# Each chunk is copied out of the buffer once, because the ASGI server may
+# keep a reference to it after sending. Reading pauses while consumers fall
+# behind by STREAM_MAX_QUEUED_CHUNKS chunks. A read fails once the object
+# server has sent nothing for READ_TIMEOUT seconds, however slowly chunks fill
+class ObjectStreamProtocol(asyncio.BufferedProtocol):
+    def __init__(self):
+        self.transport = None
+        self._buffer = stream_buffers.acquire()
+        self._view = memoryview(self._buffer)
+        self._filled = 0
+        self._chunks = collections.deque()
+        self._eof = False
+        self._error = None
+        self._paused = False
+        self._waiter = None
+        # When bytes last arrived, or the connection was opened
+        self._received = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self._view[self._filled :]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+        self._received = time.monotonic()
+        if self._filled == len(self._buffer):
+            self._flush()
+            if len(self._chunks) >= STREAM_MAX_QUEUED_CHUNKS and not self._paused:
+                self._paused = True
+                self.transport.pause_reading()
+        self._wake()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake()
+        return False
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._error = exc
+        self._wake()
+
+    def _flush(self):
+        if self._filled > 0:
+            self._chunks.append(bytes(self._view[: self._filled]))
+            self._filled = 0
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    # Wait until woken by the transport, or for `timeout` seconds. Returns
+    # whether it was woken
+    async def _wait(self, timeout: float) -> bool:
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self._waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiter = None
+
+    async def _wait_for_data(self):
+        remaining = READ_TIMEOUT - (time.monotonic() - self._received)
+        if remaining <= 0:
+            raise EndpointError("Timed out reading from the object server")
+        await self._wait(remaining)
+
+    # Wait for the object server to start answering, with its first bytes or
+    # the end of the connection
+    async def answered(self):
+        while self._filled == 0 and not self._chunks and not self._eof:
+            await self._wait_for_data()
+
+    # The next chunk of the object, or b"" once it has all been read
+    async def read(self) -> bytes:
+        while True:
+            if self._eof:
+                self._flush()
+            if self._chunks:
+                chunk = self._chunks.popleft()
+                if self._paused and len(self._chunks) < STREAM_MAX_QUEUED_CHUNKS:
+                    self._paused = False
+                    self.transport.resume_reading()
+                return chunk
+            if self._eof:
+                if self._error is not None:
+                    raise EndpointError(f"Connection lost: {self._error!r}")
+                return b""
+            if self._filled == 0:
+                await self._wait_for_data()
+            elif not await self._wait(STREAM_FLUSH_DELAY):
+                # Reads have paused, so hand on what has arrived
+                self._flush()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self._view is not None:
+            self._view.release()
+            stream_buffers.release(self._buffer)
+            self._view = self._buffer = None
+
+
+# Stream an object, from the object cache when it holds it. Objects read
+# from data-putter are offered to the cache when `size`, the object's size as
+# stored, is known and that many bytes were read. An object stored
+# compressed is decompressed with `codec` as it is read; the cache holds it
+# as stored.
+#
+# Each chunk is passed on once the next has arrived, so the object is known
+# to be complete before its last chunk is sent; readers such as ranged GETs
+# stop as soon as they have the bytes they need
+def stream(object_id, codec: Optional[str] = None, size: Optional[int] = None):
+    if codec is None:
+        return _stream_stored(object_id, size)
+    return compression.decompress(_stream_stored(object_id, size), codec)
+
+
+async def _stream_stored(object_id, size: Optional[int]):
+    cached = object_cache.lookup(object_id)
+    if cached is not None:
+        for chunk in cached:
+            yield chunk
+        return
+
+    collector = object_cache.Collector(object_id, size)
+    chunks = stream_from_server(object_id)
+    previous = None
+    try:
+        async for chunk in chunks:
+            collector.add(chunk)
+            if previous is not None:
+                yield previous
+            previous = chunk
+    finally:
+        await chunks.aclose()
+    collector.complete()
+    if previous is not None:
+        yield previous
+
+
+def _latency_order(endpoint: Endpoint) -> float:
+    # Endpoints not timed yet go first, so every replica gets measured
+    return endpoint.latency if endpoint.latency is not None else 0.0
+
+
+# The endpoints to read an object from, best first: the storage nodes holding
+# it which have a known object server, by observed latency, then the object
+# servers. Endpoints out of rotation come last
+async def read_endpoints(object_id: str) -> List[Endpoint]:
+    holders = []
+    if REPLICA_READS and len(SOS_NODE_OBJECT_SERVERS) > 0:
+        for node in await model.get_object_nodes(object_id):
+            address = SOS_NODE_OBJECT_SERVERS.get(node.decode("UTF-8"))
+            if address is not None:
+                holders.append(replicas.add(address))
+    primary = object_servers.choose()
+    others = [e for e in object_servers.endpoints if e is not primary]
+    candidates = sorted(holders, key=_latency_order) + [primary]
+    candidates += sorted(others, key=_latency_order)
+
+    now = time.monotonic()
+    ordered = []
+    for endpoint in candidates:
+        if endpoint.available(now) and endpoint not in ordered:
+            ordered.append(endpoint)
+    for endpoint in candidates:
+        if endpoint not in ordered:
+            ordered.append(endpoint)
+    return ordered
+
+
+# Stream an object from data-putter to here, from the best endpoint holding
+# it. A read whose first byte is slower than recent reads is also sent to
+# the next endpoint, and whichever answers first is used. A read which fails
+# before its first chunk is retried on the next endpoints; once bytes have
+# been passed on it cannot be
+async def stream_from_server(object_id):
+    with _measured("stream"):
+        endpoints = await read_endpoints(object_id)
+        attempts = 0
+        while True:
+            attempts += 1
+            chunks = None
+            try:
+                chunks = await _open_hedged(endpoints, object_id)
+                first = await chunks.__anext__()
+                break
+            except StopAsyncIteration:
+                first = b""
+                break
+            except EndpointError:
+                if chunks is not None:
+                    await chunks.aclose()
+                if attempts > RETRIES or len(endpoints) == 0:
+                    raise
+                metrics.dataputter_retries_total.inc("stream")
+        try:
+            if len(first) > 0:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+
+# Read from the first of `endpoints`, removing it, and from the next too if
+# the first byte is slow to arrive. Returns the stream of chunks from
+# whichever endpoint answered first; the other read is closed
+async def _open_hedged(endpoints: List[Endpoint], object_id: str):
+    primary = asyncio.ensure_future(_open(endpoints.pop(0), object_id))
+    reads = [primary]
+    winner = None
+    try:
+        if HEDGE_PERCENTILE > 0 and len(endpoints) > 0:
+            await asyncio.wait(reads, timeout=hedge_delay())
+            if not primary.done():
+                metrics.dataputter_hedged_reads_total.inc()
+                hedge = asyncio.ensure_future(_open(endpoints.pop(0), object_id))
+                reads.append(hedge)
+        pending = set(reads)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for read in reads:
+                if read in done and read.exception() is None:
+                    winner = read
+                    if winner is not primary:
+                        metrics.dataputter_hedged_read_wins_total.inc()
+                    return winner.result()
+        # Every read failed; report the first endpoint's error
+        return primary.result()
+    finally:
+        for read in reads:
+            if read is not winner:
+                await _abandon(read)
+
+
+# Cancel a read which lost the race, or close its stream if it had opened
+async def _abandon(read: asyncio.Future):
+    if not read.done():
+        read.cancel()
+        with contextlib.suppress(asyncio.CancelledError, DataPutterError):
+            await read
+    elif not read.cancelled() and read.exception() is None:
+        await read.result().aclose()
+
+
+# Start reading an object from `endpoint`, timing its first byte, rather
+# than its first chunk, so that the time does not grow with the object's
+# size. Returns the stream of the object's chunks
+async def _open(endpoint: Endpoint, object_id: str):
+    chunks = _stream_counted(endpoint, object_id)
+    started = time.perf_counter()
+    try:
+        await chunks.__anext__()
+    except asyncio.CancelledError:
+        # Lost to a hedged read, which shows the endpoint to be at least this
+        # slow
+        endpoint.observe_latency(time.perf_counter() - started)
+        raise
+    elapsed = time.perf_counter() - started
+    endpoint.observe_latency(elapsed)
+    first_byte_times.observe(elapsed)
+    metrics.dataputter_first_byte_seconds.observe(elapsed, endpoint.name)
+    return chunks
+
+
+async def _stream_counted(endpoint: Endpoint, object_id: str):
+    with endpoint.request():
+        async for chunk in _stream_from(endpoint, object_id):
+            yield chunk
+
+
+# The object server closes the connection once the object has been sent, so
+# it is never reused. An empty chunk is yielded first, as soon as the server
+# starts answering, so that the first byte can be timed
+async def _stream_from(endpoint: Endpoint, object_id: str):
+    pool = get_pool(endpoint.address)
+    async with pool.slot():
+        _, protocol = await pool.open_protocol(ObjectStreamProtocol)
+        try:
+            protocol.transport.write(object_id.encode())
+            with timing.stage("dataputter"):
+                await protocol.answered()
+            yield b""
+            while True:
+                with timing.stage("dataputter"):
+                    chunk = await protocol.read()
+                if len(chunk) == 0:
+                    break
+                metrics.dataputter_bytes_total.inc("received", amount=len(chunk))
+                yield chunk
+        finally:
+            protocol.close()
+
+
+async def _as_chunks(data: bytes):
+    yield data
+
+
+# Send an object to a data-putter router. `data` may be bytes or an async
+# iterator of chunks; chunks are written as they arrive and the writer waits
+# for the socket to drain, so only a few chunks are ever buffered here. An
+# upload which fails before its first chunk is read, such as when the router
+# cannot be reached, is retried on another router; once the body has been
+# read from it cannot be
+async def put(data: Union[bytes, AsyncIterator[bytes]], content_length: int):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = _as_chunks(data)
+
+    body = {"read": False}
+    tried = []
+    with _measured("put"):
+        while True:
+            endpoint = routers.choose(exclude=tried)
+            tried.append(endpoint)
+            try:
+                with endpoint.request():
+                    object_id = await _put_to(endpoint, data, content_length, body)
+                break
+            except EndpointError:
+                if body["read"] or not routers.can_retry(tried):
+                    raise
+                metrics.dataputter_retries_total.inc("put")
     return object_id
 
+
+# Upload to one router, marking `body` read once the first chunk is taken
+async def _put_to(endpoint: Endpoint, data, content_length: int, body) -> bytes:
+    async with get_pool(endpoint.address).connection() as (conn, lease):
+        reader, writer = conn
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH_WATER)
+        writer.write(content_length.to_bytes(CONTENT_LENGTH_HEADER_SIZE, "big"))
+
+        body["read"] = True
+        sent = 0
+        async for chunk in data:
+            sent += len(chunk)
+            if sent > content_length:
+                raise BodyLengthError(
+                    f"Body exceeds declared content length {content_length}"
+                )
+            writer.write(chunk)
+            metrics.dataputter_bytes_total.inc("sent", amount=len(chunk))
+            with timing.stage("dataputter"):
+                await _drain(writer)
+        if sent != content_length:
+            raise BodyLengthError(f"Body ended after {sent} of {content_length} bytes")
+
+        with timing.stage("dataputter"):
+            object_id = await _read_exactly(reader, OBJECT_ID_SIZE)
+        lease["reusable"] = True
+    return object_id
+
+
 DELETE_COMMAND = "0DEL0DEL"
 DELETE_AUTHENTICITY_TOKEN = "ABadSharedToken!"
+# Delete an object through a data-putter router, trying another router if
+# the first cannot be reached or does not answer. Callers release the
+# object's deduplicated references first, see model.release_objects
 async def delete(object_id: str):
-    print(f"Store.delete {object_id}")
+    timing.log_sampled("dataputter_delete", object_id=object_id)
     request = f"{DELETE_COMMAND}{object_id}{DELETE_AUTHENTICITY_TOKEN}"
-    print(f"DataPutter delete request: {request}")
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(SOS_DATAPUTTER_ROUTER)
-        s.send(request.encode())
+    tried = []
+    with _measured("delete"), timing.stage("dataputter"):
+        while True:
+            endpoint = routers.choose(exclude=tried)
+            tried.append(endpoint)
+            try:
+                with endpoint.request():
+                    deleted = await _delete_from(endpoint, request)
+                break
+            except EndpointError:
+                if not routers.can_retry(tried):
+                    raise
+                metrics.dataputter_retries_total.inc("delete")
+    await model.invalidate(("object", object_id))
+    return deleted
+
+
+async def _delete_from(endpoint: Endpoint, request: str) -> bytes:
+    async with get_pool(endpoint.address).connection() as (conn, lease):
+        reader, writer = conn
+        writer.write(request.encode())
+        await _drain(writer)
 
-        object_id = s.recv(OBJECT_ID_SIZE)
-    return object_id
\ No newline at end of file
+        deleted = await _read_exactly(reader, OBJECT_ID_SIZE)
+        lease["reusable"] = True
+    return deleted
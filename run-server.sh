@@ -1,5 +1,3 @@
 #!/bin/bash
 
-uvicorn main:api --reload &
-
-uvicorn main:s3 --reload 
\ No newline at end of file
+exec python server.py "$@"
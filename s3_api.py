@@ -1,52 +1,106 @@
 # Error Codes:
 # https://docs.aws.amazon.com/AmazonS3/latest/API/ErrorResponses.html#ErrorCodeList
 
+import asyncio
+import base64
+import binascii
+import hashlib
 import re
+import time
 import traceback
-from dict2xml import dict2xml
+import xml.etree.ElementTree as ElementTree
+from email.utils import formatdate, parsedate_to_datetime
 
-from fastapi import APIRouter, Header, Response, File, Request, Depends
+from fastapi import APIRouter, Header, Response, File, Request, Depends, Query
 from fastapi import HTTPException
-from typing import Optional, Dict
+from fastapi.responses import StreamingResponse
+from typing import Optional, Dict, List, Tuple
+import compression
+import metrics
 import model
 import serializer
 import socket
 import os
+import tempfile
 import object_store as store
+import timing
 
 api = APIRouter()
 
-XML_PRAGMA = '<?xml version="1.0" encoding="UTF-8"?>\n'
+XML_PRAGMA = serializer.XML_PRAGMA
 XML_HEADERS = {"Content-Type": "application/xml"}
+GZIP_HEADERS = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
 
 
 class S3ApiException(Exception):
-    def __init__(self, body: str, status_code: int):
+    def __init__(self, body: str, status_code: int, code: Optional[str] = None):
         self.body = body
         self.status_code = status_code
+        self.code = code
+
+
+# Build the exception for an S3 error response. Detail fields such as
+# Resource follow Code and Message in the order given, then the RequestId
+def s3_error(
+    code: str, message: str, status_code: int, fields: Optional[Dict] = None
+) -> S3ApiException:
+    fields = dict(fields or {})
+    request_id = timing.request_id()
+    if request_id is not None:
+        fields.setdefault("RequestId", request_id)
+    return S3ApiException(
+        serializer.error(code, message, fields), status_code, code=code,
+    )
 
 
 def is_authorizable(authorization: Optional[str] = Header(None)):
     if authorization is None:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "AccessDenied",
-                        "Message": f"Access to resource denied",
-                    }
-                }
-            ),
-            status_code=403,
+        raise s3_error("AccessDenied", "Access to resource denied", 403)
+
+
+# Tag of an XML element without its namespace
+def xml_local_name(element) -> str:
+    return element.tag.rsplit("}", 1)[-1]
+
+
+def malformed_xml(message: Optional[str] = None):
+    return s3_error(
+        "MalformedXML",
+        message or "The XML you provided was not well-formed or did not validate",
+        400,
+    )
+
+
+# Send serializer fragments as they are rendered
+async def xml_stream(fragments):
+    fragments = iter(fragments)
+    while True:
+        with timing.stage("xml"):
+            fragment = next(fragments, None)
+        if fragment is None:
+            return
+        yield fragment.encode("UTF-8")
+
+
+# Stream an XML listing, gzipped when the client accepts it
+def xml_response(fragments, accept_encoding: Optional[str]) -> StreamingResponse:
+    body = xml_stream(fragments)
+    if compression.accepts_gzip(accept_encoding):
+        return StreamingResponse(
+            compression.gzip_stream(body), headers={**XML_HEADERS, **GZIP_HEADERS}
         )
+    return StreamingResponse(body, headers=XML_HEADERS)
 
 
 # Provides first 7 chars of AWS_API_KEY as account ID
+@timing.timed_stage("auth")
 def simple_aws_account_id(authz_header: Header):
     try:
         (credential, signed_headers, signature) = authz_header.split(",")
-        print(
-            f"Authz:\n\tCredential: {credential}\n\tSigned: {signed_headers}\n\tSignature: {signature}"
+        timing.log_sampled(
+            "authorization",
+            credential=credential.strip(),
+            signed_headers=signed_headers.strip(),
         )
 
         (algo_spec, cred_var) = credential.split(" ")
@@ -54,21 +108,26 @@ def simple_aws_account_id(authz_header: Header):
         (_, cred_val) = cred_var.split("=")
         return cred_val[0:7]
     except AttributeError:
-        print(f"Unable to split header {authz_header}")
+        timing.log("unparsable_authorization", header=authz_header)
         return DEFAULT_BUCKET_OWNER
 
 
 DEFAULT_BUCKET_OWNER = "default-bucket-owner"
 BUCKET_NAME_EXP = r"^[a-z0-9]+(.?[-a-z0-9]+)*$"
 BUCKET_NAME_RANGE = (3, 63)
+# Most keys returned by one ListObjectsV2 page
+MAX_KEYS = 1000
 
 
 @api.get("/", dependencies=[Depends(is_authorizable)])
-async def list_buckets(authorization: Optional[str] = Header(None)):
+async def list_buckets(
+    authorization: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+):
     account_id = simple_aws_account_id(authorization)
-    buckets = model.list_buckets(account_id)
-    owner = model.get_bucket_owner(account_id)
-    return Response(serializer.list_buckets(buckets, owner), headers=XML_HEADERS,)
+    buckets = await model.list_buckets(account_id)
+    owner = await model.get_bucket_owner(account_id)
+    return xml_response(serializer.iter_list_buckets(buckets, owner), accept_encoding)
 
 
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_CreateBucket.html
@@ -88,71 +147,70 @@ async def create_bucket(
 ):
 
     if re.match(BUCKET_NAME_EXP, bucket) is None:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "InvalidBucketName",
-                        "Message": f"The bucket name {bucket} must match {BUCKET_NAME_EXP}",
-                        "Resource": f"/{bucket}",
-                        "RequestId": "SomeRequestID",  # TODO: Support Reqest ID
-                    }
-                }
-            ),
+        raise s3_error(
+            "InvalidBucketName",
+            f"The bucket name {bucket} must match {BUCKET_NAME_EXP}",
             400,
+            {"Resource": f"/{bucket}"},
         )
     if len(bucket) < BUCKET_NAME_RANGE[0] or len(bucket) > BUCKET_NAME_RANGE[1]:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "InvalidBucketName",
-                        "Message": f"The bucket name {bucket} must be between {BUCKET_NAME_RANGE[0]} and {BUCKET_NAME_RANGE[1]} characters long",
-                        "Resource": f"/{bucket}",
-                        "RequestID": "SomeRequestID",
-                    }
-                }
-            ),
+        raise s3_error(
+            "InvalidBucketName",
+            f"The bucket name {bucket} must be between {BUCKET_NAME_RANGE[0]} and {BUCKET_NAME_RANGE[1]} characters long",
             400,
+            {"Resource": f"/{bucket}"},
         )
     account_id = simple_aws_account_id(authorization)
     try:
-        result = model.create_bucket(bucket, account_id)
-        model.set_bucket_creation_date(bucket, account_id)
+        result = await model.create_bucket(bucket, account_id)
+        await model.set_bucket_creation_date(bucket, account_id)
         # result == 1 ? new : existed
         return Response(headers={"Location": f"/{bucket}"})
     except Exception as e:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "InternalError",
-                        "Message": "Unexpected server error while creating bucket",
-                    }
-                }
-            ),
+        raise s3_error(
+            "InternalError",
+            "Unexpected server error while creating bucket",
             503,
         )
 
 
+# GET /{bucket}?stats
+# The key count and total bytes of a bucket, read from its counters without
+# listing it
+async def bucket_stats(bucket: str, account_id: str):
+    if not await model.can_read_bucket(bucket, account_id):
+        raise s3_error("NoSuchBucket", f"s3://{bucket} does not exist", 404)
+    stats = await model.get_bucket_stats(bucket, account_id)
+    return Response(
+        serializer.bucket_stats(bucket, stats["keys"], stats["bytes"]),
+        headers=XML_HEADERS,
+    )
+
+
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListObjectsV2.html
 # ListBucketV2: List objects in a bucket
 # aws s3 ls s3://$BUCKET
 @api.get("/{bucket}", dependencies=[Depends(is_authorizable)])
 async def get_bucket(
     bucket: str,
-    continuation_token: Optional[str] = None,
+    req: Request,
+    continuation_token: Optional[str] = Query(None, alias="continuation-token"),
     delimiter: Optional[str] = None,
-    encoding_type: Optional[str] = None,
-    fetch_owner: Optional[str] = None,
-    max_keys: Optional[str] = None,
+    encoding_type: Optional[str] = Query(None, alias="encoding-type"),
+    fetch_owner: Optional[str] = Query(None, alias="fetch-owner"),
+    max_keys: Optional[str] = Query(None, alias="max-keys"),
     prefix: Optional[str] = None,
-    start_after: Optional[str] = None,
+    start_after: Optional[str] = Query(None, alias="start-after"),
     x_amz_expected_bucket_owner: Optional[str] = None,
     x_amz_request_payer: Optional[str] = None,
+    stats: Optional[str] = None,
     authorization: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
 ):
     account_id = simple_aws_account_id(authorization)
+    if stats is not None:
+        metrics.set_operation(req.scope, "bucket_stats")
+        return await bucket_stats(bucket, account_id)
     config = {
         "list-type": 2,
         "continuation-token": continuation_token,
@@ -167,41 +225,54 @@ async def get_bucket(
     }
 
     try:
-        if model.is_existing_bucket(bucket, account_id) and model.can_read_bucket(
-            bucket, account_id
-        ):
-            bucket_objects = model.get_bucket(bucket, account_id)
-            body = serializer.list_bucket_objects(
-                bucket, bucket_objects, config=config,
+        page_size = min(int(max_keys or MAX_KEYS), MAX_KEYS)
+        if page_size < 0:
+            raise ValueError(max_keys)
+    except ValueError:
+        raise s3_error(
+            "InvalidArgument",
+            "max-keys must be a non-negative integer",
+            400,
+            {"ArgumentName": "max-keys", "ArgumentValue": max_keys},
+        )
+    config["max-keys"] = page_size
+
+    try:
+        # Buckets are owned per account, so a readable bucket is an existing one
+        if await model.can_read_bucket(bucket, account_id):
+            page = await model.get_bucket(
+                bucket,
+                account_id,
+                prefix=prefix,
+                start_after=start_after,
+                continuation_token=continuation_token,
+                max_keys=page_size,
+                delimiter=delimiter,
+            )
+            body = serializer.iter_list_bucket_objects(
+                bucket,
+                page["objects"],
+                config=config,
+                common_prefixes=page["common_prefixes"],
+                next_continuation_token=page["next_continuation_token"],
             )
-            return Response(body, headers=XML_HEADERS)
+            return xml_response(body, accept_encoding)
         else:
-            if model.is_existing_bucket(bucket, account_id):
-                raise S3ApiException(
-                    dict2xml(
-                        {
-                            "Error": {
-                                "Code": "AccessDenied",
-                                "Message": f"Access to s3://{bucket} denied",
-                            }
-                        }
-                    ),
-                    403,
-                )
             return Response(
                 serializer.list_bucket_objects(bucket, [], config=config),
                 headers=XML_HEADERS,
             )
+    except model.InvalidContinuationToken:
+        raise s3_error(
+            "InvalidArgument",
+            "The continuation token provided is incorrect",
+            400,
+            {"ArgumentName": "continuation-token"},
+        )
     except Exception as e:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "InternalError",
-                        "Message": f"Unexpected server error while getting bucket {bucket}",
-                    }
-                }
-            ),
+        raise s3_error(
+            "InternalError",
+            f"Unexpected server error while getting bucket {bucket}",
             503,
         )
 
@@ -209,12 +280,13 @@ async def get_bucket(
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObject.html
 # DeleteObject
 #
-@api.delete("/{bucket}/{key}", dependencies=[Depends(is_authorizable)])
+@api.delete("/{bucket}/{key:path}", dependencies=[Depends(is_authorizable)])
 async def delete_object(
     bucket: str,
     key: str,
     req: Request,
     version_id: Optional[str] = None,
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
     authorization: Optional[str] = Header(None),
     x_amz_mfa: Optional[str] = Header(None),
     x_amz_request_payer: Optional[str] = Header(None),
@@ -222,53 +294,168 @@ async def delete_object(
     x_amz_expected_bucket_owner: Optional[str] = Header(None),
 ):
     account_id = simple_aws_account_id(authorization)
+    if upload_id is not None:
+        metrics.set_operation(req.scope, "abort_multipart_upload")
+        return await abort_multipart_upload(bucket, key, upload_id, account_id)
     has_errors = False
-    if model.is_bucket_owner(bucket, account_id):
-        if model.is_existing_bucket(bucket, account_id) and model.is_existing_key(
-            bucket, key, account_id
-        ):
-            for object_id in model.list_objects_of_key(bucket, key, account_id):
+    if await model.is_bucket_owner(bucket, account_id):
+        if await model.is_existing_bucket(
+            bucket, account_id
+        ) and await model.is_existing_key(bucket, key, account_id):
+            object_ids = [
+                object_id.decode("UTF-8")
+                for object_id in await model.list_objects_of_key(
+                    bucket, key, account_id
+                )
+            ]
+            # Objects other keys still share only lose this key's reference
+            released = await model.release_objects(object_ids)
+            deleted = [o for o in object_ids if o not in released]
+            for object_id in released:
                 # Send DataPutter "Delete ObjectId"
-                response = await store.delete(object_id.decode("UTF-8"))
-                print(f"Delete {bucket}/{key} yielded {response}")
-                if response.decode("UTF-8") == object_id.decode("UTF-8"):
-                    model.delete_key_object(
-                        object_id.decode("UTF-8"), bucket, key, account_id,
+                try:
+                    response = await store.delete(object_id)
+                except store.DataPutterError as e:
+                    timing.log(
+                        "delete_failed",
+                        bucket=bucket,
+                        key=key,
+                        object_id=object_id,
+                        error=e,
                     )
+                    has_errors = True
+                    continue
+                timing.log_sampled(
+                    "object_deleted",
+                    bucket=bucket,
+                    key=key,
+                    object_id=response.decode("UTF-8"),
+                )
+                if response.decode("UTF-8") == object_id:
+                    deleted.append(object_id)
                 else:
                     has_errors = True
         else:
-            if model.is_existing_bucket(bucket, account_id):
-                raise S3ApiException(
-                    dict2xml(
-                        {
-                            "Error": {
-                                "Code": "NoSuchKey",
-                                "Message": f"s3://{bucket}/{key} does not exist",
-                            }
-                        }
-                    ),
-                    404,
-                )
+            if await model.is_existing_bucket(bucket, account_id):
+                raise s3_error("NoSuchKey", f"s3://{bucket}/{key} does not exist", 404)
             else:
-                raise S3ApiException(
-                    dict2xml(
-                        {
-                            "Error": {
-                                "Code": "NoSuchBucket",
-                                "Message": f"s3://{bucket} does not exist",
-                            }
-                        }
-                    ),
-                    404,
-                )
+                raise s3_error("NoSuchBucket", f"s3://{bucket} does not exist", 404)
         if not has_errors:
-            model.delete_key(bucket, key, account_id)
+            await model.delete_key(bucket, key, account_id)
             return Response(status_code=200)
-        print(f"Error deleting object {object_id.decode('UTF-8')}")
+        # Keep the key pointing at the objects data-putter still has
+        await model.delete_keys_objects(bucket, {key: deleted}, account_id)
+        timing.log("delete_incomplete", bucket=bucket, key=key, deleted=deleted)
         return Response(status_code=503)
 
 
+# Most keys one DeleteObjects request may name
+MAX_DELETE_KEYS = 1000
+# Data-putter deletes run at once by one DeleteObjects request
+DELETE_CONCURRENCY = int(os.environ.get("SOS_DELETE_CONCURRENCY") or 16)
+
+
+# Read the keys and Quiet flag of a DeleteObjects request body
+def parse_delete_request(body: bytes) -> Tuple[List[str], bool]:
+    try:
+        root = ElementTree.fromstring(body)
+    except ElementTree.ParseError:
+        raise malformed_xml()
+    keys = []
+    quiet = False
+    for child in root:
+        name = xml_local_name(child)
+        if name == "Quiet":
+            quiet = (child.text or "").strip().lower() == "true"
+        elif name == "Object":
+            key = [f.text for f in child if xml_local_name(f) == "Key"]
+            if len(key) != 1 or not key[0]:
+                raise malformed_xml()
+            keys.append(key[0])
+    if len(keys) == 0 or len(keys) > MAX_DELETE_KEYS:
+        raise malformed_xml(
+            f"A DeleteObjects request names between 1 and {MAX_DELETE_KEYS} keys"
+        )
+    # A key named twice is deleted once and reported once
+    return list(dict.fromkeys(keys)), quiet
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObjects.html
+# DeleteObjects
+# aws s3 rm --recursive s3://$BUCKET
+#
+# Every object of every key is deleted from data-putter concurrently, at most
+# DELETE_CONCURRENCY at a time, and key metadata is read and removed with one
+# pipeline each. A key is reported deleted once all of its objects are gone
+@api.post("/{bucket}", dependencies=[Depends(is_authorizable)])
+async def delete_objects(
+    bucket: str,
+    req: Request,
+    delete: Optional[str] = None,
+    authorization: Optional[str] = Header(None),
+    x_amz_mfa: Optional[str] = Header(None),
+    x_amz_request_payer: Optional[str] = Header(None),
+    x_amz_bypass_governance_retention: Optional[bool] = Header(None),
+    x_amz_expected_bucket_owner: Optional[str] = Header(None),
+):
+    if delete is None:
+        raise s3_error("InvalidRequest", "POST on a bucket needs ?delete", 400)
+    account_id = simple_aws_account_id(authorization)
+    if not await model.is_existing_bucket(bucket, account_id):
+        raise s3_error("NoSuchBucket", f"s3://{bucket} does not exist", 404)
+    if not await model.can_write_bucket(bucket, account_id):
+        raise s3_error("AccessDenied", "Access denied", 403)
+    keys, quiet = parse_delete_request(await req.body())
+
+    key_objects = await model.list_objects_of_keys(bucket, keys, account_id)
+    object_ids = [(key, o.decode("UTF-8")) for key in keys for o in key_objects[key]]
+    # Objects other keys still share only lose these keys' references
+    released = set(await model.release_objects([o for _, o in object_ids]))
+    slots = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def delete_object_id(object_id: str) -> bool:
+        if object_id not in released:
+            return True
+        async with slots:
+            try:
+                response = await store.delete(object_id)
+            except store.DataPutterError as e:
+                timing.log(
+                    "delete_failed", bucket=bucket, object_id=object_id, error=e
+                )
+                return False
+        return response.decode("UTF-8") == object_id
+
+    results = await asyncio.gather(
+        *[delete_object_id(object_id) for _, object_id in object_ids]
+    )
+
+    failed = set()
+    removed = {key: [] for key in keys}
+    for (key, object_id), ok in zip(object_ids, results):
+        if ok:
+            removed[key].append(object_id)
+        else:
+            failed.add(key)
+    deleted = [key for key in keys if key not in failed]
+    # Keys which kept some objects lose only the ones that are gone, so
+    # deleting them again retries the rest
+    await model.delete_keys_objects(
+        bucket, {key: removed[key] for key in failed}, account_id
+    )
+    await model.delete_keys(bucket, deleted, account_id)
+
+    errors = [
+        (key, "InternalError", "Unable to delete every object of the key")
+        for key in keys
+        if key in failed
+    ]
+    return Response(
+        serializer.delete_result([] if quiet else deleted, errors),
+        headers=XML_HEADERS,
+    )
+
+
 @api.delete("/{bucket}", dependencies=[Depends(is_authorizable)])
 async def delete_bucket(
     bucket: str,
@@ -276,53 +463,271 @@ async def delete_bucket(
     x_amz_expected_bucket_owner: Optional[str] = None,
 ):
     account_id = simple_aws_account_id(authorization)
-    if model.is_existing_bucket(bucket, account_id):
-        if model.is_bucket_owner(bucket, account_id) and model.is_bucket_empty(
+    if await model.is_existing_bucket(bucket, account_id):
+        if await model.is_bucket_owner(
             bucket, account_id
-        ):
-            print(f"Deleting bucket {bucket}")
-            if model.delete_bucket(bucket, account_id):
-                return Response(
-                    headers={
-                        "x-amz-id-2": "OpaqueString",
-                        "x-amz-request-id": "OpaqueRequestId",
-                    }
-                )
+        ) and await model.is_bucket_empty(bucket, account_id):
+            timing.log_sampled("bucket_deleting", bucket=bucket)
+            if await model.delete_bucket(bucket, account_id):
+                return Response()
             else:
-                raise S3ApiException(
-                    dict2xml(
-                        {
-                            "Error": {
-                                "Code": "InternalError",
-                                "Message": f"Failed to delete bucket {bucket}",
-                            }
-                        }
-                    ),
-                    503,
+                # A key was written after the emptiness check
+                raise s3_error(
+                    "BucketNotEmpty",
+                    f"Bucket {bucket} is not empty",
+                    409,
                 )
         else:
-            raise S3ApiException(
-                dict2xml(
-                    {"Error": {"Code": "AccessDenied", "Message": f"Access denied",}}
-                ),
-                403,
-            )
-    raise S3ApiException(
-        dict2xml(
-            {
-                "Error": {
-                    "Code": "NoSuchBucket",
-                    "Message": f"Bucket {bucket} does not exist",
-                }
-            }
-        ),
-        404,
+            raise s3_error("AccessDenied", "Access denied", 403)
+    raise s3_error("NoSuchBucket", f"Bucket {bucket} does not exist", 404)
+
+
+# Store each account's identical PutObject bodies once
+DEDUP = int(os.environ.get("SOS_DEDUP") or 0)
+
+# Bodies of unknown length are spooled here before being sent to data-putter,
+# which needs the length up front. Spools beyond this size move to disk
+SPOOL_MEMORY_SIZE = 1024 * 1024
+SPOOL_READ_SIZE = 64 * 1024
+
+
+def is_aws_chunked(content_encoding: Optional[str], content_sha256: Optional[str]):
+    if content_sha256 is not None and content_sha256.startswith("STREAMING-"):
+        return True
+    if content_encoding is None:
+        return False
+    return "aws-chunked" in [e.strip() for e in content_encoding.split(",")]
+
+
+# Longest aws-chunked chunk header accepted. Signed headers are under 100
+# bytes; a longer one would otherwise be buffered until its line ends
+MAX_CHUNK_HEADER_SIZE = 4096
+
+
+# Decode an aws-chunked body into its payload bytes as chunks arrive
+# https://docs.aws.amazon.com/AmazonS3/latest/API/sigv4-streaming.html
+#
+# Each chunk is "<hex-size>[;chunk-signature=...]\r\n<data>\r\n" and the body
+# ends with a zero-sized chunk, optionally followed by trailers. A body which
+# does not follow this is the client's error
+async def aws_chunked_body(chunks):
+    buffer = bytearray()
+    remaining = None
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            if remaining is None:
+                end = buffer.find(b"\r\n", 0, MAX_CHUNK_HEADER_SIZE + 2)
+                if end == -1 and len(buffer) > MAX_CHUNK_HEADER_SIZE:
+                    raise s3_error(
+                        "InvalidRequest", "aws-chunked chunk header is too long", 400
+                    )
+                if end == -1:
+                    break
+                header = bytes(buffer[:end]).split(b";")[0]
+                del buffer[: end + 2]
+                try:
+                    remaining = int(header, 16)
+                except ValueError:
+                    remaining = -1
+                if remaining < 0:
+                    raise s3_error(
+                        "InvalidRequest", "Malformed aws-chunked chunk header", 400
+                    )
+                if remaining == 0:
+                    return
+            if remaining > 0:
+                if len(buffer) == 0:
+                    break
+                data = bytes(buffer[:remaining])
+                del buffer[: len(data)]
+                remaining -= len(data)
+                yield data
+            if remaining == 0:
+                if len(buffer) < 2:
+                    break
+                del buffer[:2]
+                remaining = None
+    raise s3_error(
+        "IncompleteBody", "The aws-chunked body ended before its final chunk", 400
+    )
+
+
+# A body which did not match its declared length
+def incomplete_body(error: Exception):
+    return s3_error(
+        "IncompleteBody",
+        f"The body did not match the length specified for it: {error}",
+        400,
     )
 
 
+# Spool a body of unknown length so its size can be sent ahead of it.
+# Returns the spool file, positioned at the start, and the body size
+async def spool_body(chunks):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+    size = 0
+    async for chunk in chunks:
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return spool, size
+
+
+async def spooled_chunks(spool):
+    try:
+        while True:
+            chunk = spool.read(SPOOL_READ_SIZE)
+            if len(chunk) == 0:
+                break
+            yield chunk
+    finally:
+        spool.close()
+
+
+# Whether a PutObject payload may be stored compressed with the bucket's
+# codec. Bodies the client has content-coded already are left as they are
+def is_compression_candidate(
+    codec: Optional[str], content_length: int, content_encoding: Optional[str]
+) -> bool:
+    if codec is None or codec not in compression.CODECS:
+        return False
+    if content_length < compression.MIN_SIZE:
+        return False
+    if content_encoding is not None:
+        codings = [e.strip().lower() for e in content_encoding.split(",")]
+        if any(coding not in ("", "aws-chunked", "identity") for coding in codings):
+            return False
+    return True
+
+
+# Compress a payload for storage when a sample from its front shows it is
+# worth it. data-putter needs the stored size ahead of the bytes, so a
+# compressed payload is spooled. Returns the chunks to store, their size and
+# the key's encoded storage, which is "" for a payload stored as written
+async def storage_payload(chunks, content_length: int, codec: str):
+    sample, chunks = await compression.peek(chunks, compression.SAMPLE_SIZE)
+    if not compression.is_compressible(codec, sample):
+        return chunks, content_length, ""
+    spool, stored_size = await spool_body(compression.compress(chunks, codec))
+    return (
+        spooled_chunks(spool),
+        stored_size,
+        compression.encode_storage(codec, stored_size),
+    )
+
+
+# Store a PutObject payload, compressed when its bucket asks for it. Returns
+# the objectID and the key's encoded storage
+async def stored_payload(
+    chunks, content_length: int, content_encoding: Optional[str], bucket, account_id
+):
+    stored_size, storage = content_length, ""
+    codec = await model.get_bucket_compression(bucket, account_id)
+    if is_compression_candidate(codec, content_length, content_encoding):
+        chunks, stored_size, storage = await storage_payload(
+            chunks, content_length, codec
+        )
+    return await store.put(chunks, stored_size), storage
+
+
+async def sha256_body(chunks, digest):
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+# Store a PutObject payload unless the account has stored the same bytes
+# already, in which case the key shares that object. Whether the payload
+# needs sending to data-putter is only known once all of it has been hashed,
+# so it is spooled meanwhile
+async def deduplicated_payload(
+    chunks, content_length: int, content_encoding: Optional[str], bucket, account_id
+):
+    digest = hashlib.sha256()
+    spool, _ = await spool_body(sha256_body(chunks, digest))
+    digest = digest.hexdigest()
+    existing = await model.reference_digest(digest, account_id)
+    if existing is not None:
+        spool.close()
+        metrics.dedup_lookups_total.inc("hit")
+        metrics.dedup_bytes_saved_total.inc(amount=content_length)
+        return existing
+    metrics.dedup_lookups_total.inc("miss")
+    object_id, storage = await stored_payload(
+        spooled_chunks(spool), content_length, content_encoding, bucket, account_id
+    )
+    existing = await model.reference_digest(
+        digest, account_id, object_id.decode("UTF-8"), storage
+    )
+    if existing is not None:
+        # A concurrent upload of the same bytes was recorded first
+        await reclaim_objects([object_id.decode("UTF-8")], "duplicate")
+        return existing
+    return object_id, storage
+
+
+# Provide the payload of a PutObject request as an async iterator of chunks
+# and its length, streaming from the client wherever the length is known
+async def request_payload(
+    req: Request,
+    content_length: Optional[int],
+    content_encoding: Optional[str],
+    x_amz_content_sha256: Optional[str],
+    x_amz_decoded_content_length: Optional[int],
+):
+    chunks = req.stream()
+    if is_aws_chunked(content_encoding, x_amz_content_sha256):
+        chunks = aws_chunked_body(chunks)
+        content_length = x_amz_decoded_content_length
+    if content_length is None:
+        spool, content_length = await spool_body(chunks)
+        chunks = spooled_chunks(spool)
+    return chunks, content_length
+
+
+# The 16-byte digest a Content-MD5 header carries as base64
+def content_md5_digest(content_md5: Optional[str]) -> Optional[bytes]:
+    if content_md5 is None:
+        return None
+    try:
+        digest = base64.b64decode(content_md5, validate=True)
+    except binascii.Error:
+        digest = b""
+    if len(digest) != 16:
+        raise s3_error(
+            "InvalidDigest", "The Content-MD5 you specified is not valid", 400
+        )
+    return digest
+
+
+# Pass a payload through, adding its bytes to the MD5 `digest` as they go by.
+# When the client sent Content-MD5 the last chunk is held back until the
+# digest has been checked, so a corrupted body fails before data-putter
+# stores it
+async def md5_body(chunks, digest, expected: Optional[bytes]):
+    held = None
+    async for chunk in chunks:
+        digest.update(chunk)
+        if expected is None:
+            yield chunk
+            continue
+        if held is not None:
+            yield held
+        held = chunk
+    if expected is not None and digest.digest() != expected:
+        raise s3_error(
+            "BadDigest",
+            "The Content-MD5 you specified did not match what was received",
+            400,
+        )
+    if held is not None:
+        yield held
+
+
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_PutObject.html
 # PutObject
-@api.put("/{bucket}/{key}", dependencies=[Depends(is_authorizable)])
+@api.put("/{bucket}/{key:path}", dependencies=[Depends(is_authorizable)])
 async def put_object(
     bucket: str,
     key: str,
@@ -355,40 +760,556 @@ async def put_object(
     x_amz_object_lock_retain_until_date: Optional[str] = Header(None),
     x_amz_object_lock_legal_hold: Optional[str] = Header(None),
     x_amz_expected_bucket_owner: Optional[str] = Header(None),
+    x_amz_content_sha256: Optional[str] = Header(None),
+    x_amz_decoded_content_length: Optional[int] = Header(None),
+    part_number: Optional[int] = Query(None, alias="partNumber"),
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
 ):
 
-    body = await req.body()
     # No headers are used 😎
     account_id = simple_aws_account_id(authorization)
-    if model.is_bucket_owner(bucket, account_id):
-        object_id = await store.put(body, content_length)
+    if await model.is_bucket_owner(bucket, account_id):
+        if upload_id is not None:
+            metrics.set_operation(req.scope, "upload_part")
+            return await upload_part(
+                bucket,
+                key,
+                account_id,
+                upload_id,
+                part_number,
+                req,
+                content_length,
+                content_encoding,
+                content_md5,
+                x_amz_content_sha256,
+                x_amz_decoded_content_length,
+            )
+        expected_md5 = content_md5_digest(content_md5)
+        digest = hashlib.md5()
+        try:
+            body, content_length = await request_payload(
+                req,
+                content_length,
+                content_encoding,
+                x_amz_content_sha256,
+                x_amz_decoded_content_length,
+            )
+            body = md5_body(body, digest, expected_md5)
+            store_payload = deduplicated_payload if DEDUP else stored_payload
+            object_id, storage = await store_payload(
+                body, content_length, content_encoding, bucket, account_id
+            )
+        except store.BodyLengthError as e:
+            raise incomplete_body(e)
+        except store.DataPutterError as e:
+            timing.log("put_failed", bucket=bucket, key=key, error=e)
+            object_id = None
 
         if object_id is None:
-            raise S3ApiException(
-                dict2xml(
-                    {
-                        "Error": {
-                            "Code": "InternalError",
-                            "Message": f"Unable to create object ID for {bucket}/{key}",
-                        }
-                    }
-                ),
+            raise s3_error(
+                "InternalError",
+                f"Unable to create object ID for {bucket}/{key}",
                 503,
             )
         else:
-            model.add_key_to_bucket(bucket, key, account_id)
-            model.set_key_size(bucket, key, content_length, account_id)
-            model.add_object_to_key(bucket, key, object_id, account_id)
-            return Response()
+            etag = f'"{digest.hexdigest()}"'
+            previous_objects = await model.put_key(
+                bucket,
+                key,
+                object_id,
+                content_length,
+                etag,
+                round(time.time(), 3),
+                account_id,
+                storage=storage,
+            )
+            # Reclaim the objects of an overwritten key. A key rewritten with
+            # the bytes it had gained a second reference to its object
+            previous_objects = [
+                previous_object.decode("UTF-8")
+                for previous_object in previous_objects
+                if previous_object != object_id or DEDUP
+            ]
+            await reclaim_objects(
+                await model.release_objects(previous_objects), "overwritten"
+            )
+            return Response(headers={"ETag": etag})
     else:
-        raise S3ApiException(
-            dict2xml(
-                {
-                    "Error": {
-                        "Code": "AccessDenied",
-                        "Message": f"Access denied for putObject to {bucket}/{key} by {account_id}",
-                    }
-                }
-            ),
+        raise s3_error(
+            "AccessDenied",
+            f"Access denied for putObject to {bucket}/{key} by {account_id}",
             403,
         )
+
+
+# Multipart upload
+#
+# Every part is streamed to data-putter as its own object while the client
+# uploads the others over separate connections. Completing the upload writes
+# the key's ordered list of parts, so no bytes are copied
+MAX_PART_NUMBER = 10000
+
+
+# Delete objects no key refers to. Only PutObject payloads are deduplicated,
+# so multipart parts and a losing duplicate upload have no references to
+# release first
+async def reclaim_objects(object_ids, reason: str):
+    for object_id in object_ids:
+        try:
+            await store.delete(object_id)
+        except store.DataPutterError as e:
+            timing.log("delete_failed", reason=reason, object_id=object_id, error=e)
+
+
+def no_such_upload(upload_id: str):
+    return s3_error(
+        "NoSuchUpload",
+        "The specified multipart upload does not exist",
+        404,
+        {"UploadId": upload_id},
+    )
+
+
+# Parts have no MD5 here, so a part's ETag is its objectID. The ETag sent back
+# at completion therefore identifies exactly the part that was uploaded
+def part_etag(object_id: str) -> str:
+    return f'"{object_id}"'
+
+
+# S3 style ETag of a multipart object: a digest over the part ETags followed
+# by the number of parts
+def multipart_etag(etags: List[str]) -> str:
+    digest = hashlib.md5("".join(etags).encode("UTF-8")).hexdigest()
+    return f'"{digest}-{len(etags)}"'
+
+
+# Read the (PartNumber, ETag) list of a CompleteMultipartUpload request body
+def parse_completed_parts(body: bytes) -> List[Tuple[int, str]]:
+    try:
+        root = ElementTree.fromstring(body)
+        parts = []
+        for part in root:
+            if xml_local_name(part) != "Part":
+                continue
+            fields = {
+                xml_local_name(field): (field.text or "").strip() for field in part
+            }
+            parts.append((int(fields["PartNumber"]), fields["ETag"]))
+    except (ElementTree.ParseError, KeyError, ValueError):
+        raise malformed_xml()
+    if len(parts) == 0:
+        raise malformed_xml("A multipart upload needs at least one part")
+    return parts
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_CreateMultipartUpload.html
+# CreateMultipartUpload
+async def create_multipart_upload(bucket: str, key: str, account_id: str):
+    upload_id = await model.create_upload(bucket, key, account_id)
+    return Response(
+        serializer.initiate_multipart_upload(bucket, key, upload_id),
+        headers=XML_HEADERS,
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_UploadPart.html
+# UploadPart
+async def upload_part(
+    bucket: str,
+    key: str,
+    account_id: str,
+    upload_id: str,
+    part_number: Optional[int],
+    req: Request,
+    content_length: Optional[int],
+    content_encoding: Optional[str],
+    content_md5: Optional[str],
+    x_amz_content_sha256: Optional[str],
+    x_amz_decoded_content_length: Optional[int],
+):
+    if part_number is None or not 1 <= part_number <= MAX_PART_NUMBER:
+        raise s3_error(
+            "InvalidArgument",
+            f"Part number must be an integer between 1 and {MAX_PART_NUMBER}",
+            400,
+            {"ArgumentName": "partNumber", "ArgumentValue": part_number},
+        )
+    if await model.get_upload_key(bucket, upload_id, account_id) != key:
+        raise no_such_upload(upload_id)
+
+    expected_md5 = content_md5_digest(content_md5)
+    try:
+        body, content_length = await request_payload(
+            req,
+            content_length,
+            content_encoding,
+            x_amz_content_sha256,
+            x_amz_decoded_content_length,
+        )
+        body = md5_body(body, hashlib.md5(), expected_md5)
+        object_id = (await store.put(body, content_length)).decode("UTF-8")
+    except store.BodyLengthError as e:
+        raise incomplete_body(e)
+    except store.DataPutterError as e:
+        timing.log(
+            "upload_part_failed",
+            bucket=bucket,
+            key=key,
+            part_number=part_number,
+            error=e,
+        )
+        raise s3_error(
+            "InternalError",
+            f"Unable to store part {part_number} of {bucket}/{key}",
+            503,
+        )
+
+    replaced = await model.set_upload_part(
+        bucket, upload_id, part_number, object_id, content_length, account_id
+    )
+    if replaced is not None and replaced != object_id:
+        await reclaim_objects([replaced], "replaced part")
+    return Response(headers={"ETag": part_etag(object_id)})
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_CompleteMultipartUpload.html
+# CompleteMultipartUpload
+async def complete_multipart_upload(
+    bucket: str, key: str, account_id: str, upload_id: str, req: Request
+):
+    if await model.get_upload_key(bucket, upload_id, account_id) != key:
+        raise no_such_upload(upload_id)
+    requested = parse_completed_parts(await req.body())
+    uploaded = await model.list_upload_parts(bucket, upload_id, account_id)
+
+    parts = []
+    etags = []
+    previous_part_number = 0
+    for part_number, etag in requested:
+        if part_number <= previous_part_number:
+            raise s3_error(
+                "InvalidPartOrder",
+                "The list of parts was not in ascending order",
+                400,
+            )
+        previous_part_number = part_number
+        part = uploaded.get(part_number)
+        if part is None or part[0] != etag.strip('"'):
+            raise s3_error(
+                "InvalidPart",
+                f"Part {part_number} was not uploaded or its ETag does not match",
+                400,
+                {"UploadId": upload_id, "PartNumber": part_number},
+            )
+        parts.append(part)
+        etags.append(part_etag(part[0]))
+
+    etag = multipart_etag(etags)
+    previous_objects = await model.complete_upload(
+        bucket, key, upload_id, parts, etag, round(time.time(), 3), account_id
+    )
+
+    # Parts left out of the completed object and the objects of an
+    # overwritten key are no longer reachable
+    kept = {object_id for object_id, _ in parts}
+    unused = [object_id for object_id, _ in uploaded.values()]
+    unused += [o.decode("UTF-8") for o in previous_objects]
+    unused = [object_id for object_id in unused if object_id not in kept]
+    await reclaim_objects(unused, "unused")
+
+    return Response(
+        serializer.complete_multipart_upload(f"/{bucket}/{key}", bucket, key, etag),
+        headers={**XML_HEADERS, "ETag": etag},
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_AbortMultipartUpload.html
+# AbortMultipartUpload
+async def abort_multipart_upload(
+    bucket: str, key: str, upload_id: str, account_id: str
+):
+    if not await model.is_bucket_owner(bucket, account_id):
+        raise s3_error("AccessDenied", "Access denied", 403)
+    if await model.get_upload_key(bucket, upload_id, account_id) != key:
+        raise no_such_upload(upload_id)
+    parts = await model.list_upload_parts(bucket, upload_id, account_id)
+    await model.delete_upload(bucket, upload_id, account_id)
+    await reclaim_objects([object_id for object_id, _ in parts.values()], "aborted")
+    return Response(status_code=204)
+
+
+# POST on a key starts (?uploads) or completes (?uploadId=...) a multipart
+# upload
+@api.post("/{bucket}/{key:path}", dependencies=[Depends(is_authorizable)])
+async def post_object(
+    bucket: str,
+    key: str,
+    req: Request,
+    uploads: Optional[str] = None,
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
+    authorization: Optional[str] = Header(None),
+):
+    account_id = simple_aws_account_id(authorization)
+    if not await model.is_bucket_owner(bucket, account_id):
+        raise s3_error(
+            "AccessDenied",
+            f"Access denied for multipart upload to {bucket}/{key} by {account_id}",
+            403,
+        )
+    if uploads is not None:
+        metrics.set_operation(req.scope, "create_multipart_upload")
+        return await create_multipart_upload(bucket, key, account_id)
+    if upload_id is not None:
+        metrics.set_operation(req.scope, "complete_multipart_upload")
+        return await complete_multipart_upload(
+            bucket, key, account_id, upload_id, req
+        )
+    raise s3_error(
+        "InvalidRequest", "POST on an object needs ?uploads or ?uploadId", 400
+    )
+
+
+RANGE_EXP = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Resolve a Range header against an object of `size` bytes into an inclusive
+# (first, last) byte range. Headers S3 would ignore, such as multiple ranges,
+# resolve to None and the whole object is served
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    if range_header is None:
+        return None
+    match = RANGE_EXP.match(range_header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise invalid_range(range_header, size)
+        return max(size - suffix_length, 0), size - 1
+    first = int(first)
+    if last != "" and int(last) < first:
+        return None
+    if first >= size:
+        raise invalid_range(range_header, size)
+    last = int(last) if last != "" else size - 1
+    return first, min(last, size - 1)
+
+
+def invalid_range(range_header: str, size: int):
+    return s3_error(
+        "InvalidRange",
+        "The requested range is not satisfiable",
+        416,
+        {"RangeRequested": range_header, "ActualObjectSize": size},
+    )
+
+
+# Stream bytes first..last (inclusive) of a key stored as a sequence of
+# objects, decompressing them with `codec` when the key was stored
+# compressed, as one object of `stored_size` bytes. Parts of known size which
+# end before `first` are skipped without being read
+async def stream_key(
+    parts: List[Tuple[str, Optional[int]]],
+    first: int,
+    last: int,
+    codec: Optional[str] = None,
+    stored_size: Optional[int] = None,
+):
+    position = 0
+    for object_id, size in parts:
+        if size is not None and position + size <= first:
+            position += size
+            continue
+        chunks = store.stream(object_id, codec, size if codec is None else stored_size)
+        try:
+            async for chunk in chunks:
+                chunk_end = position + len(chunk)
+                if chunk_end > first:
+                    yield chunk[max(first - position, 0) : last + 1 - position]
+                position = chunk_end
+                if position > last:
+                    return
+        finally:
+            await chunks.aclose()
+
+
+# Whether an If-Match or If-None-Match list names the ETag. "*" names any
+# existing object; weak tags compare by their opaque part
+def etag_matches(header: str, etag: Optional[str]) -> bool:
+    tags = [tag.strip() for tag in header.split(",")]
+    if "*" in tags:
+        return True
+    if etag is None:
+        return False
+    for tag in tags:
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag.strip('"') == etag.strip('"'):
+            return True
+    return False
+
+
+# Seconds since the epoch of an HTTP date, or None for an invalid date which
+# the condition using it ignores
+def parse_http_date(value: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def precondition_failed(condition: str):
+    return s3_error(
+        "PreconditionFailed",
+        "At least one of the pre-conditions you specified did not hold",
+        412,
+        {"Condition": condition},
+    )
+
+
+# Evaluate conditional request headers in the order of RFC 7232 section 6.
+# Returns whether the client's copy is current, for a 304; a failed
+# precondition raises PreconditionFailed. HTTP dates have whole seconds, so
+# the last-modified time is compared at that precision
+def is_not_modified(
+    etag: Optional[str],
+    last_modified: Optional[float],
+    if_match: Optional[str],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+    if_unmodified_since: Optional[str],
+) -> bool:
+    modified = int(last_modified) if last_modified is not None else None
+    if if_match is not None:
+        if not etag_matches(if_match, etag):
+            raise precondition_failed("If-Match")
+    elif if_unmodified_since is not None and modified is not None:
+        since = parse_http_date(if_unmodified_since)
+        if since is not None and modified > since:
+            raise precondition_failed("If-Unmodified-Since")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if if_modified_since is not None and modified is not None:
+        since = parse_http_date(if_modified_since)
+        return since is not None and modified <= since
+    return False
+
+
+# Resolve the metadata and requested byte range of a key for GetObject and
+# HeadObject. When the conditional headers find the client's copy current,
+# the status is 304 and nothing needs to be read
+async def key_read(
+    bucket: str,
+    key: str,
+    account_id: str,
+    range_header: Optional[str],
+    if_match: Optional[str],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str],
+    if_unmodified_since: Optional[str],
+):
+    if not await model.is_existing_bucket(bucket, account_id):
+        raise s3_error("NoSuchBucket", f"s3://{bucket} does not exist", 404)
+    metadata = await model.get_key_metadata(bucket, key, account_id)
+    if metadata is None:
+        raise s3_error("NoSuchKey", f"s3://{bucket}/{key} does not exist", 404)
+    size = metadata["size"]
+    etag, last_modified = metadata["etag"], metadata["last_modified"]
+
+    headers = {}
+    if etag is not None:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if is_not_modified(
+        etag,
+        last_modified,
+        if_match,
+        if_none_match,
+        if_modified_since,
+        if_unmodified_since,
+    ):
+        return metadata, 0, -1, headers, 304
+
+    byte_range = parse_range(range_header, size)
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Type"] = "binary/octet-stream"
+    if byte_range is None:
+        first, last = 0, size - 1
+        status_code = 200
+    else:
+        first, last = byte_range
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+        status_code = 206
+    headers["Content-Length"] = str(last - first + 1)
+    return metadata, first, last, headers, status_code
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+# GetObject
+# aws s3 cp s3://$BUCKET/$KEY .
+@api.get("/{bucket}/{key:path}", dependencies=[Depends(is_authorizable)])
+async def get_object(
+    bucket: str,
+    key: str,
+    authorization: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_match: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    if_unmodified_since: Optional[str] = Header(None),
+):
+    account_id = simple_aws_account_id(authorization)
+    metadata, first, last, headers, status_code = await key_read(
+        bucket,
+        key,
+        account_id,
+        range_header,
+        if_match,
+        if_none_match,
+        if_modified_since,
+        if_unmodified_since,
+    )
+    if status_code == 304:
+        return Response(status_code=status_code, headers=headers)
+    return StreamingResponse(
+        stream_key(
+            metadata["parts"],
+            first,
+            last,
+            metadata["codec"],
+            metadata["stored_size"],
+        ),
+        status_code=status_code,
+        headers=headers,
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_HeadObject.html
+# HeadObject
+@api.head("/{bucket}/{key:path}", dependencies=[Depends(is_authorizable)])
+async def head_object(
+    bucket: str,
+    key: str,
+    authorization: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_match: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    if_unmodified_since: Optional[str] = Header(None),
+):
+    account_id = simple_aws_account_id(authorization)
+    _, _, _, headers, status_code = await key_read(
+        bucket,
+        key,
+        account_id,
+        range_header,
+        if_match,
+        if_none_match,
+        if_modified_since,
+        if_unmodified_since,
+    )
+    return Response(status_code=status_code, headers=headers)
@@ -1,74 +1,248 @@
-from dict2xml import dict2xml
-from typing import List, Dict, Optional
-from datetime import datetime
+# S3 XML responses, written directly as text.
+#
+# Documents are produced as a sequence of string fragments so that large
+# listings can be streamed with `iter_*` functions while they are built, or
+# joined into a single string by the plain functions. Rendering a whole
+# document counts as the request's XML stage; streamed documents are timed
+# fragment by fragment as they are read.
+from typing import Callable, Dict, Iterator, List, Optional
+from datetime import datetime, timezone
+from urllib.parse import quote
 
+import timing
 
-def bucket_object(obj: Dict) -> Dict:
-    return {
-        "ETag": "eTag",
-        "Key": obj.get("key"),
-        "LastModified": str(datetime.now()),
-        "Owner": {"DisplayName": obj.get("display_name"), "ID": obj.get("id")},
-        "Size": obj.get("size"),
-        "StorageClass": "standard",
-    }
+XML_PRAGMA = '<?xml version="1.0" encoding="UTF-8"?>\n'
+S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+# Listing entries rendered per fragment when streaming
+ENTRIES_PER_FRAGMENT = 256
 
+_ESCAPES = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&apos;"}
+)
 
-def bucket_metadata(bucket: Dict) -> Dict:
-    return {
-        "Bucket": {
-            "Name": bucket.get("name"),
-            "CreationDate": bucket.get("creation_date"),
-        },
-    }
 
+def escape(value) -> str:
+    return str(value).translate(_ESCAPES)
 
-def bucket_owner(owner: Dict) -> Dict:
-    return {
-        "DisplayName": owner.get("display_name"),
-        "ID": owner.get("id"),
-    }
+
+def element(name: str, value) -> str:
+    return f"<{name}>{escape(value)}</{name}>"
+
+
+# Keys and prefixes of a listing requested with encoding-type=url, which
+# clients such as botocore decode again
+def url_encode(value) -> str:
+    return quote(str(value))
+
+
+def unencoded(value) -> str:
+    return str(value)
+
+
+# S3 timestamps are ISO 8601 in UTC with millisecond precision. Numbers are
+# seconds since the epoch
+def timestamp(value) -> str:
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value, timezone.utc)
+    elif isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="milliseconds") + "Z"
+
+
+# Keys written before their ETag and last-modified time were stored have no
+# ETag, and show `last_modified`, the time of the listing
+def bucket_object(
+    obj: Dict,
+    last_modified: str,
+    fetch_owner: bool = False,
+    encode: Callable[[object], str] = unencoded,
+) -> str:
+    owner = ""
+    if fetch_owner:
+        owner = (
+            f"<Owner><ID>{escape(obj.get('id'))}</ID>"
+            f"<DisplayName>{escape(obj.get('display_name'))}</DisplayName></Owner>"
+        )
+    if obj.get("last_modified") is not None:
+        last_modified = timestamp(obj["last_modified"])
+    etag = element("ETag", obj["etag"]) if obj.get("etag") is not None else ""
+    return (
+        f"<Contents><Key>{escape(encode(obj.get('key')))}</Key>"
+        f"<LastModified>{last_modified}</LastModified>"
+        f"{etag}"
+        f"<Size>{obj.get('size')}</Size>"
+        f"{owner}<StorageClass>STANDARD</StorageClass></Contents>"
+    )
+
+
+def bucket_metadata(bucket: Dict) -> str:
+    return (
+        f"<Bucket><Name>{escape(bucket.get('name'))}</Name>"
+        f"<CreationDate>{timestamp(bucket.get('creation_date'))}</CreationDate>"
+        f"</Bucket>"
+    )
+
+
+def bucket_owner(owner: Dict) -> str:
+    return (
+        f"<Owner><ID>{escape(owner.get('id'))}</ID>"
+        f"<DisplayName>{escape(owner.get('display_name'))}</DisplayName></Owner>"
+    )
+
+
+def common_prefix(prefix: str, encode: Callable[[object], str] = unencoded) -> str:
+    prefix = escape(encode(prefix))
+    return f"<CommonPrefixes><Prefix>{prefix}</Prefix></CommonPrefixes>"
+
+
+# Render entries a batch at a time so each yielded fragment is a useful size
+def _batched(render, entries: List) -> Iterator[str]:
+    for i in range(0, len(entries), ENTRIES_PER_FRAGMENT):
+        yield "".join(render(e) for e in entries[i : i + ENTRIES_PER_FRAGMENT])
 
 
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListBuckets.html
 # listBuckets
+def iter_list_buckets(
+    buckets: List, owner: Dict, config: Optional[Dict] = {}
+) -> Iterator[str]:
+    yield XML_PRAGMA
+    yield f'<ListAllMyBucketsResult xmlns="{S3_XMLNS}">'
+    yield bucket_owner(owner)
+    yield "<Buckets>"
+    yield from _batched(bucket_metadata, buckets)
+    yield "</Buckets></ListAllMyBucketsResult>"
+
+
+@timing.timed_stage("xml")
 def list_buckets(buckets: List, owner: Dict, config: Optional[Dict] = {}) -> str:
-    bucket_data = [bucket_metadata(bucket) for bucket in buckets]
-    list_buckets_response = {
-        "ListAllMyBucketsResult": {
-            "Buckets": bucket_data,
-            "Owner": bucket_owner(owner),
-        }
-    }
-    print("ListBucketResponse", list_buckets_response)
-    return dict2xml(list_buckets_response)
+    return "".join(iter_list_buckets(buckets, owner, config))
 
 
 # https://docs.aws.amazon.com/AmazonS3/latest/API/API_ListObjectsV2.html
 # ListObjectsV2 Response
-def list_bucket_objects(bucket: str, objects: List, config: Optional[Dict] = {}) -> str:
-    list_bucket_v2_response = {
-        "ListBucketResult": {
-            "@": {"xmlns": "http://doc.s3.amazonaws.com/2006-03-01/"},
-            "IsTruncated": False,
-            "KeyCount": len(objects),
-            "MaxKeys": len(objects),
-            "Name": bucket,
-            "Prefix": config.get("prefix") or "",
-            "Delimiter": config.get("delimiter") or "",
-            "MaxKeys": config.get("max-keys") or 1000,
-            # TODO: Support delimiter query parameter
-            # "CommonPrefixes": [
-            #     {"Prefix": "CommonPrefix"},
-            # ],
-            "EncodingType": "UTF-8",
-            "KeyCount": len(objects),
-            "ContinuationToken": config.get("continuation-token") or "",
-            "NextContinuationToken": "nextContinuationToken",
-            "StartAfter": config.get("start-after") or "",
-        }
-    }
-    if len(objects) > 0:
-        contents = [bucket_object(o) for o in objects]
-        list_bucket_v2_response["ListBucketResult"]["Contents"] = contents
-    return dict2xml(list_bucket_v2_response)
+def iter_list_bucket_objects(
+    bucket: str,
+    objects: List,
+    config: Optional[Dict] = {},
+    common_prefixes: Optional[List[str]] = None,
+    next_continuation_token: Optional[str] = None,
+) -> Iterator[str]:
+    common_prefixes = common_prefixes or []
+    is_truncated = "true" if next_continuation_token is not None else "false"
+    url_encoded = config.get("encoding-type") == "url"
+    encode = url_encode if url_encoded else unencoded
+    max_keys = config.get("max-keys")
+    header = [
+        XML_PRAGMA,
+        f'<ListBucketResult xmlns="{S3_XMLNS}">',
+        element("Name", bucket),
+        element("Prefix", encode(config.get("prefix") or "")),
+        element("KeyCount", len(objects) + len(common_prefixes)),
+        element("MaxKeys", max_keys if max_keys is not None else 1000),
+    ]
+    if config.get("delimiter"):
+        header.append(element("Delimiter", encode(config["delimiter"])))
+    header.append(element("IsTruncated", is_truncated))
+    if config.get("continuation-token"):
+        header.append(element("ContinuationToken", config["continuation-token"]))
+    if next_continuation_token is not None:
+        header.append(element("NextContinuationToken", next_continuation_token))
+    if config.get("start-after"):
+        header.append(element("StartAfter", encode(config["start-after"])))
+    if url_encoded:
+        header.append(element("EncodingType", "url"))
+    yield "".join(header)
+
+    fetch_owner = str(config.get("fetch-owner")).lower() == "true"
+    last_modified = timestamp(datetime.now(timezone.utc))
+    yield from _batched(
+        lambda o: bucket_object(o, last_modified, fetch_owner, encode), objects
+    )
+    yield from _batched(lambda p: common_prefix(p, encode), common_prefixes)
+    yield "</ListBucketResult>"
+
+
+@timing.timed_stage("xml")
+def list_bucket_objects(
+    bucket: str,
+    objects: List,
+    config: Optional[Dict] = {},
+    common_prefixes: Optional[List[str]] = None,
+    next_continuation_token: Optional[str] = None,
+) -> str:
+    return "".join(
+        iter_list_bucket_objects(
+            bucket, objects, config, common_prefixes, next_continuation_token
+        )
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_CreateMultipartUpload.html
+# InitiateMultipartUploadResult
+@timing.timed_stage("xml")
+def initiate_multipart_upload(bucket: str, key: str, upload_id: str) -> str:
+    return (
+        f'{XML_PRAGMA}<InitiateMultipartUploadResult xmlns="{S3_XMLNS}">'
+        f"{element('Bucket', bucket)}{element('Key', key)}"
+        f"{element('UploadId', upload_id)}</InitiateMultipartUploadResult>"
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_CompleteMultipartUpload.html
+# CompleteMultipartUploadResult
+@timing.timed_stage("xml")
+def complete_multipart_upload(location: str, bucket: str, key: str, etag: str) -> str:
+    return (
+        f'{XML_PRAGMA}<CompleteMultipartUploadResult xmlns="{S3_XMLNS}">'
+        f"{element('Location', location)}{element('Bucket', bucket)}"
+        f"{element('Key', key)}{element('ETag', etag)}"
+        f"</CompleteMultipartUploadResult>"
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/API_DeleteObjects.html
+# DeleteResult: errors are (Key, Code, Message). Quiet requests pass no
+# deleted keys
+@timing.timed_stage("xml")
+def delete_result(deleted: List[str], errors: List) -> str:
+    return "".join(
+        [
+            XML_PRAGMA,
+            f'<DeleteResult xmlns="{S3_XMLNS}">',
+            *(f"<Deleted>{element('Key', key)}</Deleted>" for key in deleted),
+            *(
+                f"<Error>{element('Key', key)}{element('Code', code)}"
+                f"{element('Message', message)}</Error>"
+                for key, code, message in errors
+            ),
+            "</DeleteResult>",
+        ]
+    )
+
+
+# Key count and total bytes of a bucket; not part of the S3 API
+@timing.timed_stage("xml")
+def bucket_stats(bucket: str, keys: int, size: int) -> str:
+    return (
+        f'{XML_PRAGMA}<BucketStats xmlns="{S3_XMLNS}">'
+        f"{element('Name', bucket)}{element('KeyCount', keys)}"
+        f"{element('Size', size)}</BucketStats>"
+    )
+
+
+# https://docs.aws.amazon.com/AmazonS3/latest/API/ErrorResponses.html#RESTErrorResponses
+# Error Response: Code and Message followed by any detail fields in order
+@timing.timed_stage("xml")
+def error(code: str, message: str, fields: Optional[Dict] = None) -> str:
+    details = "".join(element(k, v) for k, v in (fields or {}).items())
+    return (
+        f"{XML_PRAGMA}<Error>{element('Code', code)}{element('Message', message)}"
+        f"{details}</Error>"
+    )
+
@@ -0,0 +1,179 @@
+# Serve the S3 API and the UI API from one command, with a worker process
+# per core.
+#
+# Every worker listens on both ports. On platforms with SO_REUSEPORT each
+# worker binds its own sockets and the kernel spreads new connections across
+# them; elsewhere a single worker serves. With --metrics-port, worker N also
+# serves its own /metrics on that port plus N, since a scrape of the UI API
+# reaches only one worker. Workers start listening only once
+# they have loaded the Redis scripts and opened their connection pools, and
+# on SIGTERM or SIGINT they stop accepting connections and finish the
+# requests in flight before exiting. uvicorn picks uvloop and httptools
+# whenever they are installed.
+#
+#   python server.py --workers 4 --s3-port 8000 --api-port 8001
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+from typing import Dict, Tuple
+
+import timing
+
+# Queued connections per listening socket
+BACKLOG = 2048
+# Seconds a worker must have run for its exit to be treated as a crash to
+# restart at once, rather than a failure to start which is retried slowly
+RESTART_DELAY = 1
+
+
+def bind(host: str, port: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # asyncio starts listening once uvicorn has run the lifespan startup, so
+    # no connections are queued for a worker which is still warming up
+    sock.bind((host, port))
+    return sock
+
+
+# Hand each request to the app serving the port it arrived on. The apps share
+# the worker's connection pools, which main.lifespan opens and closes, so
+# lifespan events go to the S3 app alone for that to happen once
+class PortDispatcher:
+    def __init__(self, apps: Dict[int, object], lifespan_app):
+        self.apps = apps
+        self.lifespan_app = lifespan_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan_app(scope, receive, send)
+            return
+        await self.apps[scope["server"][1]](scope, receive, send)
+
+
+def run_worker(args, reuse_port: bool, index: int = 0):
+    # Imported here so the supervisor never creates the apps' connection
+    # pools, which cannot be shared with the workers it forks
+    import uvicorn
+
+    import main
+    import metrics
+
+    metrics.worker = str(index)
+    # Forked workers inherit the supervisor's handlers; uvicorn installs its
+    # own while serving and raises the signal again against these afterwards
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    s3_socket = bind(args.host, args.s3_port, reuse_port)
+    api_socket = bind(args.host, args.api_port, reuse_port)
+    sockets = [s3_socket, api_socket]
+    apps = {
+        s3_socket.getsockname()[1]: main.s3,
+        api_socket.getsockname()[1]: main.api,
+    }
+    if args.metrics_port:
+        metrics_socket = bind(args.host, args.metrics_port + index, False)
+        sockets.append(metrics_socket)
+        apps[metrics_socket.getsockname()[1]] = main.worker_metrics
+    app = PortDispatcher(apps, lifespan_app=main.s3)
+    config = uvicorn.Config(
+        app,
+        loop="auto",
+        http="auto",
+        lifespan="on",
+        backlog=BACKLOG,
+        access_log=args.access_log,
+        timeout_graceful_shutdown=args.shutdown_timeout,
+    )
+    try:
+        uvicorn.Server(config).run(sockets=sockets)
+    except KeyboardInterrupt:
+        pass
+
+
+# Keep `args.workers` workers running until told to stop, then wait for them
+# to finish their requests. A restarted worker takes the index of the one it
+# replaces
+def supervise(args):
+    context = multiprocessing.get_context()
+    workers: Dict[object, Tuple[int, float]] = {}
+    stopping = False
+
+    def start_worker(index: int):
+        process = context.Process(target=run_worker, args=(args, True, index))
+        process.start()
+        workers[process] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        start_worker(index)
+
+    while workers:
+        sentinels = {process.sentinel: process for process in workers}
+        exited = multiprocessing.connection.wait(list(sentinels), timeout=1)
+        for sentinel in exited:
+            process = sentinels[sentinel]
+            index, started = workers.pop(process)
+            process.join()
+            if stopping:
+                continue
+            timing.log("worker_exited", pid=process.pid, exitcode=process.exitcode)
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            start_worker(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default=os.environ.get("SOS_HOST") or "0.0.0.0")
+    parser.add_argument(
+        "--s3-port", type=int, default=int(os.environ.get("SOS_S3_PORT") or 8000)
+    )
+    parser.add_argument(
+        "--api-port", type=int, default=int(os.environ.get("SOS_API_PORT") or 8001)
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("SOS_WORKERS") or os.cpu_count() or 1),
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=float,
+        default=float(os.environ.get("SOS_SHUTDOWN_TIMEOUT") or 30),
+        help="Seconds to let requests in flight finish when stopping",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.environ.get("SOS_METRICS_PORT") or 0),
+        help="First port of the per-worker /metrics endpoints, 0 to disable",
+    )
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        timing.log("reuse_port_unavailable", workers=1)
+        args.workers = 1
+    if args.workers == 1:
+        run_worker(args, reuse_port=False)
+    else:
+        supervise(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# Per-request stage timing, request ids and structured logging.
+#
+# Each request gets a RequestTiming in a context variable. Code doing work
+# of a known kind, such as Redis calls or data-putter I/O, runs it inside
+# `stage(name)`, which adds the wall time to the request's total for that
+# stage. Stages which nest or overlap, as concurrent deletes do, are counted
+# once for as long as any of them is running.
+#
+# The stage totals so far are sent in a Server-Timing header when the
+# response starts. Streamed bodies are read after that, so their data-putter
+# and XML time only appears in the slow-request log line, written once the
+# whole response has been sent.
+# https://www.w3.org/TR/server-timing/
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import random
+import time
+from typing import Dict, Optional
+
+# Requests taking longer than this many seconds are logged with their stages
+SLOW_REQUEST_SECONDS = float(os.environ.get("SOS_SLOW_REQUEST_SECONDS") or 1)
+# Fraction of routine events which are logged
+LOG_SAMPLE_RATE = float(os.environ.get("SOS_LOG_SAMPLE_RATE") or 0.01)
+
+
+class RequestTiming:
+    __slots__ = ("request_id", "started", "durations", "_depths", "_entered")
+
+    def __init__(self):
+        self.request_id = os.urandom(8).hex().upper()
+        self.started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+        self._depths: Dict[str, int] = {}
+        self._entered: Dict[str, float] = {}
+
+    def enter(self, name: str):
+        depth = self._depths.get(name, 0)
+        if depth == 0:
+            self._entered[name] = time.perf_counter()
+        self._depths[name] = depth + 1
+
+    def exit(self, name: str):
+        depth = self._depths[name] - 1
+        self._depths[name] = depth
+        if depth == 0:
+            elapsed = time.perf_counter() - self._entered[name]
+            self.durations[name] = self.durations.get(name, 0) + elapsed
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        entries = [
+            f"{name};dur={duration * 1000:.3f}"
+            for name, duration in self.durations.items()
+        ]
+        entries.append(f"total;dur={self.elapsed() * 1000:.3f}")
+        return ", ".join(entries)
+
+
+current: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar(
+    "request_timing", default=None
+)
+
+
+# The id of the request being served, or None outside a request
+def request_id() -> Optional[str]:
+    timing = current.get()
+    return timing.request_id if timing is not None else None
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    timing = current.get()
+    if timing is None:
+        yield
+        return
+    timing.enter(name)
+    try:
+        yield
+    finally:
+        timing.exit(name)
+
+
+# Decorate a function or coroutine function to run as a stage
+def timed_stage(name: str):
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def timed_coroutine(*args, **kwargs):
+                timing = current.get()
+                if timing is None:
+                    return await function(*args, **kwargs)
+                timing.enter(name)
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    timing.exit(name)
+
+            return timed_coroutine
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return timed
+
+    return decorate
+
+
+# Write an event as one line of JSON, tagged with the current request id
+def log(event: str, **fields):
+    record = {"event": event}
+    request = request_id()
+    if request is not None:
+        record["request_id"] = request
+    record.update(fields)
+    print(json.dumps(record, default=str))
+
+
+# log() a routine event for a sample of LOG_SAMPLE_RATE of the times it
+# happens
+def log_sampled(event: str, **fields):
+    if LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE:
+        log(event, **fields)
+
+
+# ASGI middleware giving each request a RequestTiming. The request id and
+# Server-Timing headers are added as the response starts, and requests over
+# SLOW_REQUEST_SECONDS are logged once the response has been sent
+class TimingMiddleware:
+    def __init__(self, app, request_id_header: str):
+        self.app = app
+        self.request_id_header = request_id_header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = current.set(timing)
+        status = {"code": 500}
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((self.request_id_header, timing.request_id.encode()))
+                headers.append((b"server-timing", timing.server_timing().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current.reset(token)
+            elapsed = timing.elapsed()
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                record = {
+                    "event": "slow_request",
+                    "request_id": timing.request_id,
+                    "method": scope.get("method"),
+                    "path": scope.get("path"),
+                    "status": status["code"],
+                    "duration_ms": round(elapsed * 1000, 3),
+                    "stages_ms": {
+                        name: round(duration * 1000, 3)
+                        for name, duration in timing.durations.items()
+                    },
+                }
+                print(json.dumps(record))